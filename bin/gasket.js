@@ -5,7 +5,7 @@ const fs = require('fs');
 const path = require('path');
 const os = require('os');
 const v8 = require('v8')
-const { execSync, spawnSync } = require('child_process');
+const { execSync, execFileSync, spawn, spawnSync } = require('child_process');
 const { randomUUID } = require('crypto');
 
 const {SimplePropertyRetriever} = require('gasket-tools/ffdir');
@@ -16,6 +16,12 @@ if (process.env.GASKET_ROOT) {
   RESOLVE_SCRIPT_PATH = 'resolve-syms'
 }
 
+RESOLVER_START_TIMEOUT_MS = 30000
+RESOLVER_REPLY_TIMEOUT_MS = 600000
+
+resolver = null
+demangled = new Map()
+
 objects_examined = 0
 callable_objects = 0
 foreign_callable_objects = 0
@@ -41,6 +47,12 @@ addr2sym = {}
 cbs_set = new Set()
 cbs = []
 
+defer_resolve = false
+deferred = {
+    'cfuncs': {},
+    'overloads': {},
+}
+
 final_result = {
     'objects_examined': 0,
     'callable_objects': 0,
@@ -50,6 +62,7 @@ final_result = {
     'modules': [],
     'jump_libs': [],
     'bridges': [],
+    'module_stats': {},
 }
 
 function sleepSync(seconds) {
@@ -70,6 +83,18 @@ function parse_args() {
         type: 'string',
         description: 'output file',
       })
+      .option('defer-resolve', {
+        type: 'boolean',
+        default: false,
+        description: 'Do not resolve final C function addresses; record them together with a '
+                     + 'snapshot of the process mappings for resolve_syms.py --snapshot',
+      })
+      .option('module', {
+        alias: 'm',
+        type: 'array',
+        string: true,
+        description: 'Only analyze these native modules (paths under the package root)',
+      })
       .help()
       .argv;
 }
@@ -109,43 +134,188 @@ function deduplicate_paths(paths) {
     return result;
 }
 
+function demangle_local(names) {
+    const out = spawnSync('c++filt', [], { input: names.join('\n') + '\n', encoding: 'utf-8' });
+    if (out.status !== 0) {
+        console.error(out.stderr);
+        throw new Error(`c++filt exited with ${out.status}`);
+    }
+    return out.stdout.split('\n').slice(0, names.length);
+}
+
+/*
+ * Demangle a batch of names with one request, preferably through the
+ * resolver session (which keeps a c++filt co-process around), and
+ * remember the results for the rest of the run.
+ */
+function demangle_many(names) {
+    const todo = Array.from(new Set(names.filter(n => !demangled.has(n))));
+    if (todo.length > 0) {
+        var out = null;
+        if (resolver !== false && process.env.GASKET_RESOLVER_SESSION !== '0') {
+            try {
+                out = session_request({ 'demangle': todo })['names'];
+            } catch (error) {
+                console.error(`Resolver session failed, demangling locally: ${error}`);
+                stop_resolver()
+                resolver = false
+            }
+        }
+        if (out === null || out === undefined)
+            out = demangle_local(todo);
+        todo.forEach((n, i) => demangled.set(n, out[i]));
+    }
+    return names.map(n => demangled.get(n));
+}
+
 function demangle_cpp(mangled) {
-    const cmd = `c++filt '${mangled}'`;
+    return demangle_many([mangled])[0];
+}
+
+function dir(obj) {
+    return SimplePropertyRetriever.getOwnAndPrototypeEnumAndNonEnumProps(obj);
+}
+
+function sleep_ms(ms) {
+    Atomics.wait(new Int32Array(new SharedArrayBuffer(4)), 0, 0, ms);
+}
+
+function resolver_args(pid) {
+    args = [RESOLVE_SCRIPT_PATH, '-p', String(pid)]
+    if (process.env.GASKET_RESOLVER_BACKEND)
+        args.push('-b', process.env.GASKET_RESOLVER_BACKEND)
+    return args
+}
+
+/*
+ * Start a long-lived resolve_syms.py session for this process.
+ * Requests and replies go over a pair of FIFOs, so that we can talk
+ * to it synchronously with plain fs calls.
+ */
+function start_resolver() {
+    const dir = fs.mkdtempSync(path.join(os.tmpdir(), 'gasket-'));
+    const req_path = path.join(dir, 'req');
+    const res_path = path.join(dir, 'res');
+    execFileSync('mkfifo', [req_path, res_path]);
+
+    const res_fd = fs.openSync(res_path, fs.constants.O_RDONLY | fs.constants.O_NONBLOCK);
+    const args = resolver_args(process.pid).concat(
+        ['--serve', '--fifo-in', req_path, '--fifo-out', res_path]);
+    const child = spawn('python3', args, { stdio: ['ignore', 'ignore', 'inherit'] });
+
+    // XXX: Opening the write side of a FIFO with O_NONBLOCK fails with
+    //      ENXIO until the session has opened its read side.
+    var req_fd = null;
+    const deadline = Date.now() + RESOLVER_START_TIMEOUT_MS;
+    while (req_fd === null) {
+        try {
+            req_fd = fs.openSync(req_path, fs.constants.O_WRONLY | fs.constants.O_NONBLOCK);
+        } catch (err) {
+            if (err.code !== 'ENXIO' || Date.now() > deadline) {
+                fs.closeSync(res_fd);
+                child.kill();
+                fs.rmSync(dir, { recursive: true, force: true });
+                throw err;
+            }
+            sleep_ms(10);
+        }
+    }
+    return { child: child, dir: dir, req_fd: req_fd, res_fd: res_fd, pending: '' };
+}
+
+function stop_resolver() {
+    if (resolver === null || resolver === false)
+        return
     try {
-      const out = execSync(cmd, { encoding: 'utf-8', shell: true });
-      return out.trim();
+        fs.closeSync(resolver.req_fd);
+        fs.closeSync(resolver.res_fd);
     } catch (err) {
-      console.error(err);
-      throw err;
     }
+    fs.rmSync(resolver.dir, { recursive: true, force: true });
+    resolver = null
 }
 
-function dir(obj) {
-    return SimplePropertyRetriever.getOwnAndPrototypeEnumAndNonEnumProps(obj);
+function session_write(fd, data) {
+    var buf = Buffer.from(data, 'utf-8');
+    var off = 0;
+    while (off < buf.length) {
+        try {
+            off += fs.writeSync(fd, buf, off, buf.length - off);
+        } catch (err) {
+            if (err.code !== 'EAGAIN')
+                throw err;
+            sleep_ms(1);
+        }
+    }
 }
 
-function gdb_resolve(addresses) {
+function session_read_line(session) {
+    const buf = Buffer.alloc(65536);
+    const deadline = Date.now() + RESOLVER_REPLY_TIMEOUT_MS;
+    while (!session.pending.includes('\n')) {
+        var n;
+        try {
+            n = fs.readSync(session.res_fd, buf, 0, buf.length, null);
+        } catch (err) {
+            if (err.code !== 'EAGAIN')
+                throw err;
+            if (Date.now() > deadline)
+                throw new Error('resolver session timed out');
+            sleep_ms(1);
+            continue;
+        }
+        if (n === 0)
+            throw new Error('resolver session exited');
+        session.pending += buf.toString('utf-8', 0, n);
+    }
+    const idx = session.pending.indexOf('\n');
+    const line = session.pending.slice(0, idx);
+    session.pending = session.pending.slice(idx + 1);
+    return line;
+}
+
+function session_request(request) {
+    if (resolver === null)
+        resolver = start_resolver()
+    session_write(resolver.req_fd, JSON.stringify(request) + '\n');
+    return JSON.parse(session_read_line(resolver));
+}
+
+function oneshot_resolve(addresses) {
     const tmp_dir = os.tmpdir();
     const addr_file = path.join(tmp_dir, `addr_${randomUUID()}.json`);
     const res_file = path.join(tmp_dir, `res_${randomUUID()}.json`);
 
     pid = process.pid
 
-	fs.writeFileSync(addr_file, JSON.stringify(addresses, null, 2));
+	fs.writeFileSync(addr_file, JSON.stringify(addresses));
 
-    args = [RESOLVE_SCRIPT_PATH,
-            '-p', String(pid),
-            '-i', addr_file,
-            '-o', res_file]
+    args = resolver_args(pid).concat(['-i', addr_file, '-o', res_file])
 
 	var result = spawnSync('python3', args, { encoding: 'utf-8' });
 
 	const raw = fs.readFileSync(res_file, 'utf-8');
 	result = JSON.parse(raw);
 
+    fs.rmSync(addr_file, { force: true });
+    fs.rmSync(res_file, { force: true });
+
 	return result
 }
 
+function gdb_resolve(addresses) {
+    if (resolver !== false && process.env.GASKET_RESOLVER_SESSION !== '0') {
+        try {
+            return session_request(addresses)
+        } catch (error) {
+            console.error(`Resolver session failed, falling back to one-shot mode: ${error}`)
+            stop_resolver()
+            resolver = false
+        }
+    }
+    return oneshot_resolve(addresses)
+}
+
 function extract_fcb_invoke(fqn) {
     obj = fqn2obj[fqn]
 	res = v8.extract_fcb_invoke(v8.jid(obj))
@@ -316,6 +486,11 @@ function analyze_single(mod_file, pkg_root) {
     var resolve_addresses = new Set(cbs)
 
     for (let key in fqn2overloadsaddr) {
+        if (defer_resolve) {
+            if (fqn2overloadsaddr[key].length > 0)
+                deferred['overloads'][key] = { 'addresses': fqn2overloadsaddr[key], 'module': mod_file }
+            continue
+        }
         fqn2overloadsaddr[key].forEach(item => resolve_addresses.add(item))
     }
 
@@ -327,6 +502,8 @@ function analyze_single(mod_file, pkg_root) {
 	}
 
     for (let fqn in fqn2overloadsaddr) {
+        if (defer_resolve)
+            break
         for (let addr of fqn2overloadsaddr[fqn]) {
             try {
                 lib = addr2sym[addr].library
@@ -392,6 +569,12 @@ function analyze_single(mod_file, pkg_root) {
         resolve_addresses.add(addr_dec)
     }
 
+    if (defer_resolve) {
+        for (let fqn in fqn2cfuncaddr)
+            deferred['cfuncs'][fqn] = { 'address': fqn2cfuncaddr[fqn], 'module': mod_file }
+        return
+    }
+
 	if (resolve_addresses.size > 0) {
 		var res3 = gdb_resolve(Array.from(resolve_addresses))
 		for (let addr in res3) {
@@ -400,6 +583,15 @@ function analyze_single(mod_file, pkg_root) {
 		}
 	}
 
+    var to_demangle = []
+    for (let fqn in fqn2cfuncaddr) {
+        addr = fqn2cfuncaddr[fqn]
+        if (addr2sym[addr] !== undefined)
+            to_demangle.push(addr2sym[addr].cfunc)
+    }
+    if (to_demangle.length > 0)
+        demangle_many(to_demangle)
+
     for (let fqn in fqn2cfuncaddr) {
         addr = fqn2cfuncaddr[fqn]
         try {
@@ -420,6 +612,35 @@ function analyze_single(mod_file, pkg_root) {
     }
 }
 
+/*
+ * Capture what resolve_syms.py needs to symbolize the deferred
+ * addresses after we are gone: our mappings, plus the identity of
+ * every mapped file so that changes on disk can be detected.
+ */
+function process_snapshot() {
+    const maps = fs.readFileSync('/proc/self/maps', 'utf-8')
+    const files = {}
+    for (const line of maps.split('\n')) {
+        const fields = line.trim().split(/\s+/)
+        if (fields.length < 6)
+            continue
+        const p = fields.slice(5).join(' ')
+        if (!p.startsWith('/') || p in files)
+            continue
+        try {
+            const st = fs.statSync(p, { bigint: true })
+            files[p] = {
+                'dev': st.dev.toString(),
+                'ino': st.ino.toString(),
+                'size': st.size.toString(),
+                'mtime_ns': st.mtimeNs.toString(),
+            }
+        } catch (err) {
+        }
+    }
+    return { 'pid': process.pid, 'maps': maps, 'files': files }
+}
+
 function locate_so_modules(packagePath) {
     const soFiles = [];
 
@@ -527,19 +748,32 @@ function recursive_inspect(obj, jsname) {
 }
 
 function main() {
+    process.on('exit', stop_resolver)
     var start = Date.now()
     const args = parse_args();
     var output_file = args.output
+    defer_resolve = args.deferResolve
 
     console.log(`Package root = ${args.root}`)
 
-    so_files = locate_so_modules(args.root)
+    if (args.module !== undefined)
+        so_files = args.module.map(m => path.resolve(m))
+    else
+        so_files = locate_so_modules(args.root)
     console.log(`Native extension files :\n${so_files.join('\n')}`)
 
 
     for (const so_file of so_files) {
+      var before = [objects_examined, callable_objects, foreign_callable_objects,
+                    final_result['bridges'].length]
       analyze_single(so_file, args.root);
       final_result['modules'].push(so_file)
+      final_result['module_stats'][so_file] = {
+          'objects_examined': objects_examined - before[0],
+          'callable_objects': callable_objects - before[1],
+          'foreign_callable_objects': foreign_callable_objects - before[2],
+          'count': final_result['bridges'].length - before[3],
+      }
     }
 
     var end = Date.now()
@@ -552,6 +786,10 @@ function main() {
     final_result['count'] = final_result['bridges'].length
 
     final_result['failed'] = fqn2failed
+    if (defer_resolve) {
+        deferred['snapshot'] = process_snapshot()
+        final_result['deferred'] = deferred
+    }
     if (output_file !== undefined) {
 	    fs.writeFileSync(output_file, JSON.stringify(final_result, null, 2));
         console.log(`Wrote bridges to ${output_file}`)
@@ -0,0 +1,309 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import tracemalloc
+
+import utils
+
+log = logging.getLogger(__name__)
+
+GASKET_ROOT = os.getenv("GASKET_ROOT")
+
+DEFAULT_THRESHOLD = 0.2
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Micro-benchmarks for the Python pipeline stages.')
+    p.add_argument(
+        "-l",
+        "--log",
+        default="warning",
+        help=("Provide logging level. Example --log debug"),
+    )
+    p.add_argument(
+        "-s",
+        "--scale",
+        default=1.0,
+        type=float,
+        help=("Scale all fixture sizes by this factor. Example --scale 0.1"),
+    )
+    p.add_argument(
+        "-k",
+        "--only",
+        default=None,
+        help=("Comma-separated list of benchmarks to run."),
+    )
+    p.add_argument(
+        "-r",
+        "--repeat",
+        default=3,
+        type=int,
+        help=("Time each benchmark this many times and keep the fastest run."),
+    )
+    p.add_argument(
+        "-b",
+        "--baseline",
+        default=None,
+        help=("Baseline JSON file. Defaults to data/bench_baseline.json under GASKET_ROOT."),
+    )
+    p.add_argument(
+        "--save-baseline",
+        default=False,
+        action='store_true',
+        help=("Store the results of this run as the new baseline."),
+    )
+    p.add_argument(
+        "-t",
+        "--threshold",
+        default=DEFAULT_THRESHOLD,
+        type=float,
+        help=("Relative slowdown or memory growth that counts as a regression."),
+    )
+    p.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help=("Also write the results as JSON to this file."),
+    )
+    return p.parse_args()
+
+
+def rand_name(rng, prefix, n):
+    return prefix + ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz_') for _ in range(n))
+
+
+def gen_cfunc(rng):
+    ns = rand_name(rng, 'ns', 6)
+    fn = rand_name(rng, 'fn', 10)
+    return f"{ns}::{fn}(Napi::CallbackInfo const&)"
+
+
+def gen_gdb_output(rng, n):
+    lines = []
+    for i in range(n):
+        addr = 0x7f0000000000 + i * 16
+        r = rng.random()
+        if r < 0.05:
+            lines.append(f'___ADDRESS___{addr}___ADDRESS______FUNC___NOTFOUND___FUNC___')
+        elif r < 0.10:
+            lines.append(f'Reading symbols from /usr/lib/lib{i}.so...')
+        else:
+            sym = '_ZN' + rand_name(rng, 'f', 12) + 'Ev'
+            lines.append(f'___ADDRESS___{addr}___ADDRESS______FUNC___{sym} in section .text'
+                         f' of /tmp/install/pkg___1.0/node_modules/pkg/build/Release/addon{i % 7}.node___FUNC___')
+    return '\n'.join(lines) + '\n'
+
+
+def gen_bridges(rng, n, n_failed):
+    bridges = []
+    for i in range(n):
+        bridges.append({
+            'jsname': f'pkg/build/Release/addon.{rand_name(rng, "obj", 5)}.{rand_name(rng, "m", 8)}',
+            'cfunc': gen_cfunc(rng),
+            'library': '/tmp/install/pkg___1.0/node_modules/pkg/build/Release/addon.node',
+        })
+    failed = {}
+    for i in range(n_failed):
+        failed[f'pkg/build/Release/addon.{rand_name(rng, "f", 8)}'] = rng.choice(
+            ['NULL_CB', 'EXTRACT_NAPI', 'OVERLOAD_RESOLUTION'])
+    return {
+        'objects_examined': n * 10,
+        'callable_objects': n * 2,
+        'foreign_callable_objects': n,
+        'duration_sec': 12,
+        'count': n,
+        'modules': ['/tmp/install/pkg___1.0/node_modules/pkg/build/Release/addon.node'],
+        'jump_libs': ['/tmp/install/pkg___1.0/node_modules/pkg/build/Release/addon.node'],
+        'bridges': bridges,
+        'failed': failed,
+    }
+
+
+class Fixtures():
+    def __init__(self, scale, workdir):
+        self.scale = scale
+        self.workdir = workdir
+        self.rng = random.Random(1234)
+
+    def size(self, n):
+        return max(1, int(n * self.scale))
+
+
+def bench_parse_gdb_line(fx):
+    import resolve_syms
+    n = fx.size(100000)
+    lines = gen_gdb_output(fx.rng, n).splitlines()
+    def run():
+        for line in lines:
+            resolve_syms.parse_gdb_line(line)
+    return n, run
+
+
+def bench_analyzer_process(fx):
+    import resolve_syms
+    n = fx.size(100000)
+    output = gen_gdb_output(fx.rng, n)
+    addresses = [str(0x7f0000000000 + i * 16) for i in range(n)]
+    input_file = os.path.join(fx.workdir, 'addresses.json')
+    output_file = os.path.join(fx.workdir, 'resolved.json')
+    with open(input_file, 'w') as outfile:
+        outfile.write(json.dumps(addresses))
+    # XXX: Feed canned GDB output instead of attaching to a process.
+    resolve_syms.run_gdb = lambda symbol_addresses, target_pid: output
+    def run():
+        analyzer = resolve_syms.Analyzer(input_file, os.getpid(), output_file,
+                                         backend='gdb', cache=None)
+        analyzer.process()
+    return n, run
+
+
+def make_bridger(fx, n, n_failed):
+    import find_bridges
+    find_bridges.GASKET_ROOT = fx.workdir
+    bridger = find_bridges.JavascriptBridger(f'pkg{n}:1.0.0', fx.workdir, True)
+    with open(bridger.bridges_path, 'w') as outfile:
+        outfile.write(json.dumps(gen_bridges(fx.rng, n, n_failed), indent=2))
+    return bridger
+
+
+def uncached(fn):
+    import objects
+    # XXX: Measure a cold parse of bridges.json, not the shared cache.
+    def run():
+        objects._load_bridges.cache_clear()
+        fn()
+    return run
+
+
+def bench_check_bridges(fx):
+    n = fx.size(200000)
+    bridger = make_bridger(fx, n, fx.size(20000))
+    return n, uncached(bridger.check_bridges)
+
+
+def bench_generate_bridges_csv(fx):
+    n = fx.size(200000)
+    bridger = make_bridger(fx, n, 0)
+    return n, uncached(bridger.generate_bridges_csv)
+
+
+def bench_load_csv(fx):
+    n = fx.size(1000000)
+    path = os.path.join(fx.workdir, 'input.csv')
+    with open(path, 'w') as outfile:
+        for i in range(n):
+            outfile.write(f'package-{i}:1.{i % 10}.{i % 7}\n')
+            if i % 100 == 0:
+                outfile.write('\n')
+    def run():
+        utils.load_csv(path)
+    return n, run
+
+
+BENCHMARKS = {
+    'parse_gdb_line': bench_parse_gdb_line,
+    'analyzer_process': bench_analyzer_process,
+    'check_bridges': bench_check_bridges,
+    'generate_bridges_csv': bench_generate_bridges_csv,
+    'load_csv': bench_load_csv,
+}
+
+
+def run_benchmark(name, setup, fx, repeat):
+    items, fn = setup(fx)
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # XXX: tracemalloc slows allocation-heavy code down; time untraced
+    #      runs for the throughput figure and keep the fastest.
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = min(elapsed, time.perf_counter() - start)
+    return {
+        'name': name,
+        'items': items,
+        'seconds': round(elapsed, 4),
+        'items_per_sec': round(items / elapsed, 1) if elapsed > 0 else None,
+        'peak_mem_bytes': peak,
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for r in results:
+        b = baseline.get(r['name'])
+        if b is None or b['items'] != r['items']:
+            continue
+        if b['items_per_sec'] and r['items_per_sec'] < b['items_per_sec'] * (1 - threshold):
+            regressions.append(f"{r['name']}: throughput {r['items_per_sec']}/s"
+                               f" vs baseline {b['items_per_sec']}/s")
+        if r['peak_mem_bytes'] > b['peak_mem_bytes'] * (1 + threshold):
+            regressions.append(f"{r['name']}: peak memory {r['peak_mem_bytes']}"
+                               f" vs baseline {b['peak_mem_bytes']}")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    utils.setup_logging(args)
+
+    names = list(BENCHMARKS)
+    if args.only is not None:
+        names = [n.strip() for n in args.only.split(',')]
+        for n in names:
+            if n not in BENCHMARKS:
+                log.error(f"Unknown benchmark {n}, must be one of: {' | '.join(BENCHMARKS)}")
+                sys.exit(1)
+
+    baseline_path = args.baseline
+    if baseline_path is None and GASKET_ROOT is not None:
+        baseline_path = os.path.join(GASKET_ROOT, 'data', 'bench_baseline.json')
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='gasket-bench-') as workdir:
+        fx = Fixtures(args.scale, workdir)
+        for name in names:
+            r = run_benchmark(name, BENCHMARKS[name], fx, args.repeat)
+            results.append(r)
+            print(f"{name:<24} {r['items']:>10} items {r['seconds']:>9.3f} s"
+                  f" {r['items_per_sec']:>14.1f} items/s {r['peak_mem_bytes'] / 2**20:>9.1f} MiB peak")
+
+    if args.output is not None:
+        with open(args.output, 'w') as outfile:
+            outfile.write(json.dumps(results, indent=2))
+
+    ret = 0
+    if baseline_path is not None and os.path.exists(baseline_path) and not args.save_baseline:
+        with open(baseline_path, 'r') as infile:
+            baseline = {r['name']: r for r in json.loads(infile.read())}
+        regressions = compare(results, baseline, args.threshold)
+        for r in regressions:
+            log.error(f"REGRESSION {r}")
+        if regressions:
+            ret = 1
+        else:
+            print(f"No regressions against {baseline_path}")
+
+    if args.save_baseline:
+        if baseline_path is None:
+            log.error("No baseline path: set GASKET_ROOT or pass --baseline")
+            sys.exit(1)
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+        with open(baseline_path, 'w') as outfile:
+            outfile.write(json.dumps(results, indent=2))
+        print(f"Saved baseline to {baseline_path}")
+
+    sys.exit(ret)
+
+
+if __name__ == "__main__":
+    main()
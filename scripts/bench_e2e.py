@@ -0,0 +1,508 @@
+import os
+import io
+import sys
+import json
+import math
+import time
+import shutil
+import tarfile
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import resource
+
+import bench
+import diskgc
+import tracing
+import registry
+import utils
+
+log = logging.getLogger(__name__)
+
+GASKET_ROOT = os.getenv("GASKET_ROOT")
+
+KINDS = ('pure-js', 'napi', 'nan', 'stripped', 'build-from-source')
+
+DEFAULT_PER_KIND = 4
+DEFAULT_SAMPLE_SEC = 0.5
+PERCENTILES = (50, 90, 99)
+
+# XXX: Files find_bridges.py hashes into its tool version; the benchmark
+#      root links to them so that it runs the code under test.
+ROOT_LINKS = ('package.json', 'bin', 'src', 'scripts')
+
+NAPI_SRC = r'''
+#include <node_api.h>
+static const char *pkg_id = PKG_ID;
+static napi_value Hello(napi_env env, napi_callback_info info) {
+  napi_value r;
+  napi_create_string_utf8(env, pkg_id, NAPI_AUTO_LENGTH, &r);
+  return r;
+}
+static napi_value Twice(napi_env env, napi_callback_info info) {
+  size_t argc = 1;
+  napi_value argv[1];
+  double x = 0;
+  napi_value r;
+  napi_get_cb_info(env, info, &argc, argv, NULL, NULL);
+  if (argc > 0)
+    napi_get_value_double(env, argv[0], &x);
+  napi_create_double(env, 2 * x, &r);
+  return r;
+}
+static napi_property_descriptor desc[] = {
+  {"hello", NULL, Hello, NULL, NULL, NULL, napi_default, NULL},
+  {"twice", NULL, Twice, NULL, NULL, NULL, napi_default, NULL},
+};
+NAPI_MODULE_INIT() {
+  napi_define_properties(env, exports, 2, desc);
+  return exports;
+}
+'''
+
+NAN_SRC = r'''
+#include <nan.h>
+NAN_METHOD(Hello) {
+  info.GetReturnValue().Set(Nan::New(PKG_ID).ToLocalChecked());
+}
+NAN_MODULE_INIT(Init) {
+  Nan::SetMethod(target, "hello", Hello);
+}
+NODE_MODULE(NODE_GYP_MODULE_NAME, Init)
+'''
+
+# XXX: What NAN expands to, for when the nan headers are not around.
+V8_SRC = r'''
+#include <node.h>
+static void Hello(const v8::FunctionCallbackInfo<v8::Value>& args) {
+  args.GetReturnValue().Set(v8::String::NewFromUtf8(args.GetIsolate(), PKG_ID).ToLocalChecked());
+}
+static void Init(v8::Local<v8::Object> exports) {
+  NODE_SET_METHOD(exports, "hello", Hello);
+}
+NODE_MODULE(NODE_GYP_MODULE_NAME, Init)
+'''
+
+# XXX: Like prebuild-install || node-gyp rebuild: keep the shipped binary
+#      unless npm was asked to build from source.
+INSTALL_JS = r'''
+const fs = require('fs');
+const { execSync } = require('child_process');
+if (process.env.npm_config_build_from_source === 'true' ||
+    !fs.existsSync('build/Release/addon.node'))
+  execSync('node-gyp rebuild', { stdio: 'inherit' });
+'''
+
+
+def parse_args():
+    p = argparse.ArgumentParser(
+        description='End-to-end benchmark: run find_bridges.py over a fixture corpus'
+                    ' served from a local registry.')
+    p.add_argument(
+        "-l",
+        "--log",
+        default="info",
+        help=("Provide logging level. Example --log debug"),
+    )
+    p.add_argument(
+        "-n",
+        "--per-kind",
+        default=DEFAULT_PER_KIND,
+        type=int,
+        help=(f"Number of packages of each kind ({', '.join(KINDS)})."),
+    )
+    p.add_argument(
+        "-k",
+        "--kinds",
+        default=None,
+        help=("Comma-separated list of fixture kinds to include."),
+    )
+    p.add_argument(
+        "-w",
+        "--workdir",
+        default=None,
+        help=("Keep fixtures, data and trace in this directory instead of a temporary one."),
+    )
+    p.add_argument(
+        "--nan-dir",
+        default=None,
+        help=("Directory with nan.h. Without it, NAN fixtures use the plain V8 API instead."),
+    )
+    p.add_argument(
+        "--sample-interval",
+        default=DEFAULT_SAMPLE_SEC,
+        type=float,
+        help=("Seconds between disk and memory samples."),
+    )
+    p.add_argument(
+        "-b",
+        "--baseline",
+        default=None,
+        help=("Baseline JSON file. Defaults to data/bench_e2e_baseline.json under GASKET_ROOT."),
+    )
+    p.add_argument(
+        "--save-baseline",
+        default=False,
+        action='store_true',
+        help=("Store the results of this run as the new baseline."),
+    )
+    p.add_argument(
+        "-t",
+        "--threshold",
+        default=bench.DEFAULT_THRESHOLD,
+        type=float,
+        help=("Relative slowdown or disk/memory growth that counts as a regression."),
+    )
+    p.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help=("Also write the results as JSON to this file."),
+    )
+    p.add_argument(
+        "pipeline_args",
+        nargs=argparse.REMAINDER,
+        help=("Extra find_bridges.py arguments, after --. Example: -- -j 4 --static"),
+    )
+    return p.parse_args()
+
+
+def node_prefix():
+    out = subprocess.run(['node', '-p', 'process.execPath'], check=True,
+                         capture_output=True, text=True).stdout.strip()
+    return os.path.dirname(os.path.dirname(os.path.realpath(out)))
+
+
+def compile_addon(src, out_path, pkg_id, include_dirs, cxx=False):
+    ext = '.cc' if cxx else '.c'
+    with tempfile.NamedTemporaryFile('w', suffix=ext, delete=False) as srcfile:
+        srcfile.write(src)
+    try:
+        cmd = ['c++', '-std=c++17'] if cxx else ['cc']
+        cmd += ['-O2', '-shared', '-fPIC', f'-DPKG_ID="{pkg_id}"',
+                '-DNODE_GYP_MODULE_NAME=addon', '-o', out_path, srcfile.name]
+        for d in include_dirs:
+            cmd.append(f'-I{d}')
+        subprocess.run(cmd, check=True)
+    finally:
+        os.remove(srcfile.name)
+
+
+def add_file(tar, name, data, mode=0o644):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    info = tarfile.TarInfo('package/' + name)
+    info.size = len(data)
+    info.mode = mode
+    info.mtime = 0
+    tar.addfile(info, io.BytesIO(data))
+
+
+def binding_gyp(pkg_id, source):
+    target = {
+        'target_name': 'addon',
+        'sources': [source],
+        'defines': [f'PKG_ID="{pkg_id}"'],
+    }
+    return json.dumps({'targets': [target]}, indent=2)
+
+
+class Corpus():
+    def __init__(self, root, nan_dir=None):
+        self.root = root
+        self.tarball_dir = os.path.join(root, 'registry')
+        self.nan_dir = nan_dir
+        self.include = os.path.join(node_prefix(), 'include', 'node')
+        os.makedirs(self.tarball_dir, exist_ok=True)
+
+    def make(self, kind, i):
+        name = f'bench-{kind}-{i}'
+        version = '1.0.0'
+        pkg_id = f'{name}@{version}'
+        pkg = {'name': name, 'version': version, 'main': 'index.js'}
+        files = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            binary = os.path.join(tmp, 'addon.node')
+            if kind == 'pure-js':
+                files['index.js'] = f"module.exports = {{ id: () => '{pkg_id}' }};\n"
+            elif kind in ('napi', 'stripped'):
+                compile_addon(NAPI_SRC, binary, pkg_id, [self.include])
+                if kind == 'stripped':
+                    subprocess.run(['strip', binary], check=True)
+                    # XXX: find_bridges.py rebuilds stripped modules from source.
+                    files['addon.c'] = NAPI_SRC
+                    files['binding.gyp'] = binding_gyp(pkg_id, 'addon.c')
+                    files['install.js'] = INSTALL_JS
+                    pkg['scripts'] = {'install': 'node install.js'}
+            elif kind == 'nan':
+                if self.nan_dir is not None:
+                    compile_addon(NAN_SRC, binary, pkg_id, [self.include, self.nan_dir], cxx=True)
+                else:
+                    compile_addon(V8_SRC, binary, pkg_id, [self.include], cxx=True)
+            elif kind == 'build-from-source':
+                files['addon.c'] = NAPI_SRC
+                files['binding.gyp'] = binding_gyp(pkg_id, 'addon.c')
+                pkg['gypfile'] = True
+            if os.path.exists(binary):
+                with open(binary, 'rb') as infile:
+                    files['build/Release/addon.node'] = infile.read()
+            if kind != 'pure-js':
+                files['index.js'] = "module.exports = require('./build/Release/addon.node');\n"
+        path = os.path.join(self.tarball_dir, f'{name}-{version}.tgz')
+        with tarfile.open(path, 'w:gz') as tar:
+            add_file(tar, 'package.json', json.dumps(pkg, indent=2))
+            for fname, data in sorted(files.items()):
+                add_file(tar, fname, data, 0o755 if fname.endswith('.node') else 0o644)
+        return f'{name}:{version}'
+
+    def build(self, kinds, per_kind):
+        specs = []
+        for i in range(per_kind):
+            for kind in kinds:
+                specs.append(self.make(kind, i))
+        return specs
+
+
+def tree_rss(root_pid):
+    # XXX: Sum of RSS over root_pid and all of its descendants.
+    children = {}
+    rss = {}
+    page = os.sysconf('SC_PAGE_SIZE')
+    for d in os.listdir('/proc'):
+        if not d.isdigit():
+            continue
+        try:
+            with open(f'/proc/{d}/stat', 'r') as infile:
+                stat = infile.read()
+            with open(f'/proc/{d}/statm', 'r') as infile:
+                resident = int(infile.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(d))
+        rss[int(d)] = resident * page
+    total = 0
+    todo = [root_pid]
+    while todo:
+        pid = todo.pop()
+        total += rss.get(pid, 0)
+        todo.extend(children.get(pid, []))
+    return total
+
+
+class Sampler():
+    def __init__(self, pid, data_dir, interval):
+        self.pid = pid
+        self.data_dir = data_dir
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_rss = max(self.peak_rss, tree_rss(self.pid))
+            self.peak_disk = max(self.peak_disk, diskgc.disk_usage(self.data_dir))
+            self.samples += 1
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak_disk = max(self.peak_disk, diskgc.disk_usage(self.data_dir))
+
+
+def percentile(values, p):
+    # XXX: Nearest rank.
+    values = sorted(values)
+    k = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[k]
+
+
+def stage_latencies(records):
+    stages = {}
+    for r in records:
+        stages.setdefault(r['stage'], []).append(r['duration_sec'])
+    out = {}
+    for stage, durations in sorted(stages.items()):
+        out[stage] = {'n': len(durations), 'max': round(max(durations), 4)}
+        for p in PERCENTILES:
+            out[stage][f'p{p}'] = round(percentile(durations, p), 4)
+    return out
+
+
+def make_root(workdir):
+    root = os.path.join(workdir, 'root')
+    os.makedirs(root, exist_ok=True)
+    for f in ROOT_LINKS:
+        dst = os.path.join(root, f)
+        if not os.path.lexists(dst):
+            os.symlink(os.path.join(GASKET_ROOT, f), dst)
+    data = os.path.join(root, 'data')
+    if os.path.exists(data):
+        shutil.rmtree(data)
+    os.makedirs(data)
+    return root
+
+
+def run_pipeline(root, specs, url, pipeline_args, sample_interval):
+    csv_path = os.path.join(root, 'corpus.csv')
+    with open(csv_path, 'w') as outfile:
+        for s in specs:
+            outfile.write(s + '\n')
+    trace_path = os.path.join(root, 'data', 'trace.jsonl')
+    env = dict(os.environ)
+    env['GASKET_ROOT'] = root
+    env['npm_config_registry'] = url + '/'
+    # XXX: node-gyp would otherwise download headers.
+    env['npm_config_nodedir'] = node_prefix()
+    env['npm_config_audit'] = 'false'
+    env['npm_config_fund'] = 'false'
+    env['npm_config_update_notifier'] = 'false'
+    cmd = [sys.executable, os.path.join(root, 'scripts', 'find_bridges.py'),
+           '-i', csv_path, '--trace', trace_path,
+           '--log-dir', os.path.join(root, 'data', 'logs')] + pipeline_args
+    log.info(cmd)
+    start = time.perf_counter()
+    with open(os.path.join(root, 'find_bridges.log'), 'w') as logfile:
+        proc = subprocess.Popen(cmd, env=env, stdout=logfile, stderr=subprocess.STDOUT)
+        sampler = Sampler(proc.pid, os.path.join(root, 'data'), sample_interval)
+        sampler.start()
+        ret = proc.wait()
+        sampler.stop()
+    wall = time.perf_counter() - start
+    records = tracing.load(trace_path) if os.path.exists(trace_path) else []
+    return ret, wall, records, sampler
+
+
+def summarize(specs, ret, wall, records, sampler):
+    package_spans = {}
+    for r in records:
+        if r['stage'] in ('package', 'analyze') and r.get('exit_code') is not None:
+            package_spans[r['package']] = r['exit_code']
+    failed = sorted(p for p, code in package_spans.items() if code != 0)
+    return {
+        'packages': len(specs),
+        'exit_code': ret,
+        'failed': failed,
+        'wall_sec': round(wall, 3),
+        'packages_per_hour': round(len(specs) / wall * 3600, 1) if wall > 0 else None,
+        'stages': stage_latencies(records),
+        'peak_disk_bytes': sampler.peak_disk,
+        'peak_rss_bytes': sampler.peak_rss,
+        # XXX: Largest single descendant, from the kernel; catches peaks
+        #      between samples.
+        'max_child_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        'samples': sampler.samples,
+    }
+
+
+def compare(result, baseline, threshold):
+    regressions = []
+    if baseline.get('packages') != result['packages']:
+        return regressions
+    if result['packages_per_hour'] < baseline['packages_per_hour'] * (1 - threshold):
+        regressions.append(f"throughput {result['packages_per_hour']}/h"
+                           f" vs baseline {baseline['packages_per_hour']}/h")
+    for key in ('peak_disk_bytes', 'peak_rss_bytes'):
+        if result[key] > baseline[key] * (1 + threshold):
+            regressions.append(f"{key} {result[key]} vs baseline {baseline[key]}")
+    return regressions
+
+
+def print_result(result):
+    print(f"Packages:      {result['packages']} ({len(result['failed'])} failed)")
+    print(f"Wall time:     {result['wall_sec']:.1f} s")
+    print(f"Throughput:    {result['packages_per_hour']:.1f} packages/hour")
+    print(f"Peak disk:     {diskgc.format_size(result['peak_disk_bytes'])}")
+    print(f"Peak RSS:      {diskgc.format_size(result['peak_rss_bytes'])} (process tree),"
+          f" {diskgc.format_size(result['max_child_rss_bytes'])} (largest process)")
+    print(f"{'stage':<20} {'n':>6} " + ' '.join(f"{'p%d' % p:>9}" for p in PERCENTILES) + f" {'max':>9}")
+    for stage, s in result['stages'].items():
+        print(f"{stage:<20} {s['n']:>6} " + ' '.join(f"{s['p%d' % p]:>9.3f}" for p in PERCENTILES)
+              + f" {s['max']:>9.3f}")
+    for p in result['failed']:
+        print(f"FAILED {p}")
+
+
+def main():
+    args = parse_args()
+    utils.setup_logging(args)
+
+    if GASKET_ROOT is None:
+        log.error("GASKET_ROOT must point to the gasket checkout under test")
+        sys.exit(1)
+
+    kinds = KINDS
+    if args.kinds is not None:
+        kinds = [k.strip() for k in args.kinds.split(',')]
+        for k in kinds:
+            if k not in KINDS:
+                log.error(f"Unknown fixture kind {k}, must be one of: {' | '.join(KINDS)}")
+                sys.exit(1)
+    if 'nan' in kinds and args.nan_dir is None:
+        log.warning("No --nan-dir; NAN fixtures use the plain V8 API instead")
+
+    pipeline_args = args.pipeline_args
+    if pipeline_args and pipeline_args[0] == '--':
+        pipeline_args = pipeline_args[1:]
+
+    baseline_path = args.baseline or os.path.join(GASKET_ROOT, 'data', 'bench_e2e_baseline.json')
+
+    tmp = None
+    workdir = args.workdir
+    if workdir is None:
+        tmp = tempfile.TemporaryDirectory(prefix='gasket-bench-e2e-')
+        workdir = tmp.name
+    try:
+        corpus = Corpus(workdir, args.nan_dir)
+        specs = corpus.build(kinds, args.per_kind)
+        log.info(f"Built {len(specs)} fixture packages")
+        server, url = registry.serve(corpus.tarball_dir)
+        try:
+            root = make_root(workdir)
+            ret, wall, records, sampler = run_pipeline(root, specs, url, pipeline_args,
+                                                       args.sample_interval)
+        finally:
+            server.shutdown()
+        result = summarize(specs, ret, wall, records, sampler)
+        result['pipeline_args'] = pipeline_args
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+    print_result(result)
+    if args.output is not None:
+        with open(args.output, 'w') as outfile:
+            outfile.write(json.dumps(result, indent=2))
+
+    ret = 0 if result['exit_code'] == 0 else 1
+    if os.path.exists(baseline_path) and not args.save_baseline:
+        with open(baseline_path, 'r') as infile:
+            baseline = json.loads(infile.read())
+        regressions = compare(result, baseline, args.threshold)
+        for r in regressions:
+            log.error(f"REGRESSION {r}")
+        if regressions:
+            ret = 1
+        else:
+            print(f"No regressions against {baseline_path}")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+        with open(baseline_path, 'w') as outfile:
+            outfile.write(json.dumps(result, indent=2))
+        print(f"Saved baseline to {baseline_path}")
+
+    sys.exit(ret)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import argparse
+
+import utils
+import demangle
+import objects
+
+log = logging.getLogger(__name__)
+
+GASKET_ROOT = os.getenv("GASKET_ROOT")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS strings (
+    id INTEGER PRIMARY KEY,
+    s  TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS packages (
+    id          INTEGER PRIMARY KEY,
+    name        TEXT NOT NULL,
+    version     TEXT NOT NULL,
+    source_hash TEXT,
+    ingested_at INTEGER,
+    UNIQUE (name, version)
+);
+CREATE TABLE IF NOT EXISTS bridges (
+    pkg         INTEGER NOT NULL,
+    jsname      INTEGER NOT NULL,
+    cfunc       INTEGER NOT NULL,
+    cfunc_short INTEGER,
+    library     INTEGER NOT NULL,
+    lib_base    INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bridges_pkg ON bridges (pkg);
+CREATE INDEX IF NOT EXISTS bridges_cfunc ON bridges (cfunc);
+CREATE INDEX IF NOT EXISTS bridges_cfunc_short ON bridges (cfunc_short);
+CREATE INDEX IF NOT EXISTS bridges_library ON bridges (library);
+CREATE INDEX IF NOT EXISTS bridges_lib_base ON bridges (lib_base);
+"""
+
+QUERY_COLUMNS = """
+SELECT p.name, p.version, j.s, c.s, l.s
+FROM bridges b
+JOIN packages p ON p.id = b.pkg
+JOIN strings j ON j.id = b.jsname
+JOIN strings c ON c.id = b.cfunc
+JOIN strings l ON l.id = b.library
+"""
+
+
+def default_store_path():
+    return os.path.join(GASKET_ROOT, 'data', 'bridges.sqlite')
+
+
+def normalize_library(library):
+    # XXX: Libraries inside a package's private install tree differ only
+    #      by the install prefix; keep the part after node_modules/ so
+    #      that the same addon interns to the same string.
+    marker = '/node_modules/'
+    idx = library.rfind(marker)
+    if idx >= 0 and '/data/install/' in library[:idx]:
+        return library[idx + len(marker):]
+    return library
+
+
+class BridgeStore():
+    def __init__(self, path=None):
+        if path is None:
+            path = default_store_path()
+        self.path = path
+        d = os.path.dirname(path)
+        if d:
+            utils.create_dir(d)
+        self.db = sqlite3.connect(path, timeout=120)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self._ids = {}
+        # XXX: Ids interned by the transaction in progress; they only go
+        #      into _ids once it commits, since a rollback undoes them.
+        self._pending = {}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def intern(self, s):
+        sid = self._ids.get(s)
+        if sid is None:
+            sid = self._pending.get(s)
+        if sid is not None:
+            return sid
+        self.db.execute("INSERT OR IGNORE INTO strings (s) VALUES (?)", (s,))
+        sid = self.db.execute("SELECT id FROM strings WHERE s = ?", (s,)).fetchone()[0]
+        self._pending[s] = sid
+        return sid
+
+    def _lookup(self, s):
+        row = self.db.execute("SELECT id FROM strings WHERE s = ?", (s,)).fetchone()
+        return row[0] if row is not None else None
+
+    def ingest(self, name, version, bridges_path):
+        source_hash = utils.sha256_file(bridges_path)
+        row = self.db.execute("SELECT id, source_hash FROM packages WHERE name = ? AND version = ?",
+                              (name, version)).fetchone()
+        if row is not None and row[1] == source_hash:
+            log.debug(f"{name}:{version} already ingested")
+            return 0
+        model = objects.load_bridges(bridges_path)
+        try:
+            return self._ingest(model, name, version, source_hash, row)
+        finally:
+            self._pending = {}
+
+    def _ingest(self, model, name, version, source_hash, row):
+        with self.db:
+            if row is not None:
+                pkg_id = row[0]
+                self.db.execute("DELETE FROM bridges WHERE pkg = ?", (pkg_id,))
+                self.db.execute("UPDATE packages SET source_hash = ?, ingested_at = ? WHERE id = ?",
+                                (source_hash, int(time.time()), pkg_id))
+            else:
+                cur = self.db.execute(
+                    "INSERT INTO packages (name, version, source_hash, ingested_at) VALUES (?, ?, ?, ?)",
+                    (name, version, source_hash, int(time.time())))
+                pkg_id = cur.lastrowid
+            rows = []
+            for b in model.bridges:
+                library = normalize_library(b.library)
+                short = demangle.short_name(b.cfunc)
+                rows.append((
+                    pkg_id,
+                    self.intern(b.jsname),
+                    self.intern(b.cfunc),
+                    self.intern(short) if short is not None else None,
+                    self.intern(library),
+                    self.intern(os.path.basename(library)),
+                ))
+            self.db.executemany("INSERT INTO bridges VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self._ids.update(self._pending)
+        return len(rows)
+
+    def ingest_tree(self, bridges_apps_root):
+        # XXX: Layout is <root>/<x>/<sanitized name>/<sanitized version>/bridges.json
+        total = 0
+        for dirpath, dirs, files in os.walk(bridges_apps_root):
+            if 'bridges.json' not in files:
+                continue
+            rel = os.path.relpath(dirpath, bridges_apps_root).split(os.sep)
+            if len(rel) != 3:
+                continue
+            name = rel[1].replace('~', '/')
+            version = rel[2].replace('~', '/')
+            try:
+                total += self.ingest(name, version, os.path.join(dirpath, 'bridges.json'))
+            except (ValueError, KeyError) as e:
+                log.warning(f"Skipping {dirpath}: {e}")
+        return total
+
+    def by_cfunc(self, cfunc):
+        sid = self._lookup(cfunc)
+        if sid is None:
+            return []
+        return self.db.execute(QUERY_COLUMNS + " WHERE b.cfunc = ? OR b.cfunc_short = ?",
+                               (sid, sid)).fetchall()
+
+    def packages_reaching(self, cfunc):
+        return sorted({(r[0], r[1]) for r in self.by_cfunc(cfunc)})
+
+    def by_library(self, library):
+        sid = self._lookup(normalize_library(library))
+        if sid is None:
+            return []
+        return self.db.execute(QUERY_COLUMNS + " WHERE b.library = ? OR b.lib_base = ?",
+                               (sid, sid)).fetchall()
+
+    def by_package(self, name, version=None):
+        if version is None:
+            return self.db.execute(QUERY_COLUMNS + " WHERE p.name = ?", (name,)).fetchall()
+        return self.db.execute(QUERY_COLUMNS + " WHERE p.name = ? AND p.version = ?",
+                               (name, version)).fetchall()
+
+    def stats(self):
+        q = lambda sql: self.db.execute(sql).fetchone()[0]
+        return {
+            'packages': q("SELECT COUNT(*) FROM packages"),
+            'bridges': q("SELECT COUNT(*) FROM bridges"),
+            'strings': q("SELECT COUNT(*) FROM strings"),
+        }
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Corpus-wide bridge store.')
+    p.add_argument(
+        "-l",
+        "--log",
+        default="info",
+        help=("Provide logging level. Example --log debug"),
+    )
+    p.add_argument(
+        "-d",
+        "--db",
+        default=None,
+        help=("Path to the store. Defaults to data/bridges.sqlite under GASKET_ROOT."),
+    )
+    sub = p.add_subparsers(dest='command', required=True)
+    ing = sub.add_parser('ingest', help='Ingest bridges.json files.')
+    ing.add_argument("--tree", default=None,
+                     help=("Ingest every package under this data/bridges/npm directory."))
+    ing.add_argument("-p", "--package", default=None,
+                     help=("package:version of a single bridges.json given with --file."))
+    ing.add_argument("-f", "--file", default=None, help=("Path to a bridges.json."))
+    q = sub.add_parser('query', help='Query the store.')
+    q.add_argument("-c", "--cfunc", default=None,
+                   help=("Bridges reaching this C function (full or short name)."))
+    q.add_argument("-L", "--library", default=None,
+                   help=("Bridges crossing into this library (path or basename)."))
+    q.add_argument("-p", "--package", default=None,
+                   help=("Bridges of this package (name or name:version)."))
+    q.add_argument("--packages-only", default=False, action='store_true',
+                   help=("Only list the matching packages."))
+    sub.add_parser('stats', help='Print store statistics.')
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    utils.setup_logging(args)
+    store = BridgeStore(args.db)
+    try:
+        if args.command == 'ingest':
+            if args.tree is not None:
+                n = store.ingest_tree(args.tree)
+            elif args.file is not None and args.package is not None:
+                name, version = utils.pkg_name_to_tuple(args.package)
+                n = store.ingest(name, version, args.file)
+            else:
+                log.error("Give either --tree or --package and --file")
+                sys.exit(1)
+            log.info(f"Ingested {n} bridges")
+        elif args.command == 'query':
+            if args.cfunc is not None:
+                rows = store.by_cfunc(args.cfunc)
+            elif args.library is not None:
+                rows = store.by_library(args.library)
+            elif args.package is not None:
+                if ':' in args.package:
+                    rows = store.by_package(*utils.pkg_name_to_tuple(args.package))
+                else:
+                    rows = store.by_package(args.package)
+            else:
+                log.error("Give one of --cfunc, --library or --package")
+                sys.exit(1)
+            if args.packages_only:
+                for name, version in sorted({(r[0], r[1]) for r in rows}):
+                    print(f"{name}:{version}")
+            else:
+                for r in rows:
+                    print('\t'.join([f"{r[0]}:{r[1]}", r[2], r[3], r[4]]))
+        elif args.command == 'stats':
+            print(json.dumps(store.stats(), indent=2))
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
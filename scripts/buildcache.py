@@ -0,0 +1,135 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import functools
+import tempfile
+
+import utils
+
+log = logging.getLogger(__name__)
+
+GASKET_ROOT = os.getenv("GASKET_ROOT")
+
+# XXX: Intermediate build products that are never loaded at runtime.
+SKIP_DIRS = ('obj.target', '.deps', 'obj')
+
+
+@functools.lru_cache(maxsize=None)
+def first_line(cmd):
+    try:
+        ret, out, err = utils.run_cmd(cmd)
+    except Exception as e:
+        log.debug(e)
+        return None
+    if ret != 0:
+        return None
+    lines = (out or err).strip().splitlines()
+    return lines[0] if lines else None
+
+
+def toolchain():
+    cc = os.getenv('CC', 'cc')
+    cxx = os.getenv('CXX', 'c++')
+    return {
+        'node': first_line(('node', '--version')),
+        'abi': first_line(('node', '-p', 'process.versions.modules')),
+        'arch': first_line(('node', '-p', 'process.arch + "-" + process.platform')),
+        'cc': first_line(tuple(cc.split()) + ('--version',)),
+        'cxx': first_line(tuple(cxx.split()) + ('--version',)),
+    }
+
+
+def ccache_env(ccache_dir=None):
+    # XXX: node-gyp's generated Makefiles honour CC/CXX.
+    if shutil.which('ccache') is None:
+        log.warning("ccache not found, building without it")
+        return None
+    env = dict(os.environ)
+    env['CC'] = 'ccache ' + os.getenv('CC', 'cc')
+    env['CXX'] = 'ccache ' + os.getenv('CXX', 'c++')
+    if ccache_dir is None:
+        ccache_dir = os.path.join(GASKET_ROOT, 'data/ccache')
+    env['CCACHE_DIR'] = ccache_dir
+    # XXX: Install dirs differ per package; let ccache hit across them.
+    env['CCACHE_NOHASHDIR'] = '1'
+    env['CCACHE_BASEDIR'] = os.path.join(GASKET_ROOT, 'data/install')
+    return env
+
+
+def is_artifact(rel):
+    parts = rel.split(os.sep)
+    if rel.endswith('.node'):
+        return True
+    # XXX: Shared libraries and other runtime payloads next to the addon.
+    for i, p in enumerate(parts[:-1]):
+        if p == 'build' and i + 1 < len(parts) - 1 and parts[i + 1] in ('Release', 'Debug'):
+            return not any(s in SKIP_DIRS for s in parts[i + 2:-1])
+    return False
+
+
+class BuildCache():
+    def __init__(self, root=None):
+        if root is None:
+            root = os.path.join(GASKET_ROOT, 'data/buildcache')
+        self.root = root
+        utils.create_dir(self.root)
+
+    def key(self, package):
+        d = {'spec': package, 'toolchain': toolchain()}
+        return hashlib.sha256(json.dumps(d, sort_keys=True).encode()).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def has(self, key):
+        return os.path.exists(os.path.join(self._entry(key), 'manifest.json'))
+
+    def save(self, key, install_dir):
+        modules_dir = os.path.join(install_dir, 'node_modules')
+        files = []
+        for root, dirs, fnames in os.walk(modules_dir):
+            for f in fnames:
+                path = os.path.join(root, f)
+                rel = os.path.relpath(path, install_dir)
+                if os.path.isfile(path) and not os.path.islink(path) and is_artifact(rel):
+                    files.append(rel)
+        if not any(f.endswith('.node') for f in files):
+            log.info(f"No native modules in {install_dir}, not caching")
+            return False
+        entry = self._entry(key)
+        utils.create_dir(os.path.dirname(entry))
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        try:
+            for rel in files:
+                dst = os.path.join(tmp, 'files', rel)
+                utils.create_dir(os.path.dirname(dst))
+                shutil.copy2(os.path.join(install_dir, rel), dst)
+            meta = {'files': {rel: utils.sha256_file(os.path.join(tmp, 'files', rel)) for rel in files}}
+            with open(os.path.join(tmp, 'manifest.json'), 'w') as outfile:
+                outfile.write(json.dumps(meta, indent=2))
+            if os.path.exists(entry):
+                shutil.rmtree(entry)
+            os.rename(tmp, entry)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        log.info(f"Cached {len(files)} build artifacts under {entry}")
+        return True
+
+    def restore(self, key, install_dir):
+        entry = self._entry(key)
+        with open(os.path.join(entry, 'manifest.json'), 'r') as infile:
+            meta = json.loads(infile.read())
+        for rel, digest in meta['files'].items():
+            src = os.path.join(entry, 'files', rel)
+            if utils.sha256_file(src) != digest:
+                log.error(f"Build cache entry {entry} is corrupt ({rel}), dropping it")
+                shutil.rmtree(entry, ignore_errors=True)
+                return False
+            dst = os.path.join(install_dir, rel)
+            utils.create_dir(os.path.dirname(dst))
+            shutil.copy2(src, dst)
+        log.info(f"Restored {len(meta['files'])} build artifacts from {entry}")
+        return True
@@ -0,0 +1,134 @@
+import re
+import sys
+import atexit
+import shutil
+import logging
+import argparse
+import threading
+import subprocess
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 200000
+
+# XXX: Keep only "last" function name.
+#      Trim namespaces ("::")
+#      Trim arg types ("(int...)")
+SHORT_NAME_RE = re.compile(r"(?:\w+::)?(\w+)(?:\(|$)")
+
+
+def short_name(full):
+    match = SHORT_NAME_RE.search(full)
+    if match:
+        return match.group(1)
+    return None
+
+
+def is_mangled(name):
+    return name.startswith(('_Z', '_GLOBAL_'))
+
+
+class Demangler():
+    # XXX: One long-lived c++filt co-process fed with batches, plus a
+    #      bounded LRU of results that survives across packages.
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE, cxxfilt='c++filt'):
+        self.cache_size = cache_size
+        self.cxxfilt = cxxfilt
+        self.cache = OrderedDict()
+        self.proc = None
+        self.lock = threading.Lock()
+        self.available = shutil.which(cxxfilt) is not None
+        if not self.available:
+            log.warning(f"{cxxfilt} not found, C++ names will not be demangled")
+
+    def _start(self):
+        self.proc = subprocess.Popen([self.cxxfilt], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, text=True, bufsize=1)
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+                self.proc.wait(timeout=5)
+            except Exception:
+                self.proc.kill()
+            self.proc = None
+
+    def _run(self, names):
+        if self.proc is None or self.proc.poll() is not None:
+            self._start()
+        # XXX: Write from a separate thread, otherwise a large batch can
+        #      fill both pipes and deadlock us against c++filt.
+        def feed():
+            for n in names:
+                self.proc.stdin.write(n + '\n')
+            self.proc.stdin.flush()
+        writer = threading.Thread(target=feed)
+        writer.start()
+        out = [self.proc.stdout.readline().rstrip('\n') for _ in names]
+        writer.join()
+        return out
+
+    def demangle_batch(self, names):
+        with self.lock:
+            todo = []
+            for n in names:
+                if n in self.cache:
+                    self.cache.move_to_end(n)
+                elif is_mangled(n) and '\n' not in n:
+                    todo.append(n)
+            todo = list(dict.fromkeys(todo))
+            if todo and self.available:
+                try:
+                    results = self._run(todo)
+                except (OSError, ValueError) as e:
+                    log.error(f"c++filt failed: {e}")
+                    self.close()
+                    results = todo
+                for n, d in zip(todo, results):
+                    self.cache[n] = d
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            return [self.cache.get(n, n) for n in names]
+
+    def demangle(self, name):
+        return self.demangle_batch([name])[0]
+
+    def names(self, cfuncs):
+        # XXX: Returns (full, short) pairs; short is None if it cannot be
+        #      extracted.
+        return [(full, short_name(full)) for full in self.demangle_batch(cfuncs)]
+
+
+_demangler = None
+
+
+def get_demangler():
+    global _demangler
+    if _demangler is None:
+        _demangler = Demangler()
+        atexit.register(_demangler.close)
+    return _demangler
+
+
+def main():
+    p = argparse.ArgumentParser(description='Demangle C++ symbols, one per line on stdin.')
+    p.add_argument(
+        "-s",
+        "--short",
+        default=False,
+        action='store_true',
+        help=("Also print the short name, tab-separated."),
+    )
+    args = p.parse_args()
+    names = [l.rstrip('\n') for l in sys.stdin]
+    for full, short in get_demangler().names(names):
+        if args.short:
+            print(f"{full}\t{short}")
+        else:
+            print(full)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+import os
+import re
+import sys
+import time
+import shutil
+import logging
+import argparse
+
+import utils
+import manifest
+
+log = logging.getLogger(__name__)
+
+GASKET_ROOT = os.getenv("GASKET_ROOT")
+
+LRU = 'lru'
+AGE = 'age'
+
+# XXX: Installs this recent are never evicted, in case a worker we do not
+#      know about is using them.
+DEFAULT_GRACE_SEC = 10 * 60
+# XXX: Walking data/install is not free; --disk-budget runs collect at
+#      most this often.
+DEFAULT_INTERVAL_SEC = 5 * 60
+
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(s):
+    m = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', s, re.IGNORECASE)
+    if m is None:
+        raise ValueError(f"Invalid size: {s}")
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2).upper()])
+
+
+def format_size(n):
+    for unit in ('T', 'G', 'M', 'K'):
+        if n >= SIZE_UNITS[unit]:
+            return f"{n / SIZE_UNITS[unit]:.1f}{unit}"
+    return f"{n}B"
+
+
+def install_dir_name(package):
+    return utils.sanitize_package_name(package).replace(':', '___')
+
+
+def disk_usage(*roots):
+    # XXX: Count each inode once; installs are mostly hardlinks into the
+    #      install store.
+    seen = set()
+    total = 0
+    for top in roots:
+        for root, dirs, files in os.walk(top):
+            for f in files:
+                try:
+                    st = os.lstat(os.path.join(root, f))
+                except FileNotFoundError:
+                    continue
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_blocks * 512
+    return total
+
+
+def private_bytes(install_dir):
+    # XXX: What removing the install frees, assuming links with a count of
+    #      two are shared with the store object alone (pruned afterwards).
+    total = 0
+    for root, dirs, files in os.walk(install_dir):
+        for f in files:
+            try:
+                st = os.lstat(os.path.join(root, f))
+            except FileNotFoundError:
+                continue
+            if st.st_nlink <= 2:
+                total += st.st_blocks * 512
+    return total
+
+
+class Install():
+    def __init__(self, path, manifest_path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.manifest = manifest.Manifest(manifest_path)
+        self.last_used = os.stat(path).st_mtime
+        rec = self.manifest.get('install')
+        self.created = rec.get('finished_at', self.last_used) if rec else self.last_used
+
+    def state(self):
+        # XXX: Installs are kept until their bridges are verified; ones
+        #      whose processing gave up are fair game as well.
+        outcomes = [rec['outcome'] for rec in self.manifest.stages.values()]
+        if not outcomes or manifest.RUNNING in outcomes or manifest.PENDING in outcomes:
+            return 'busy'
+        csv = self.manifest.get('csv')
+        if csv is not None and csv['outcome'] == manifest.OK:
+            return 'verified'
+        if manifest.FAILED in outcomes:
+            return 'failed'
+        return 'busy'
+
+
+class DiskGC():
+    def __init__(self, root=None, output_dir=None, pins_path=None, grace_sec=DEFAULT_GRACE_SEC):
+        root = root or GASKET_ROOT
+        self.install_root = os.path.join(root, 'data/install')
+        self.store_root = os.path.join(root, 'data/store')
+        self.manifests_root = os.path.join(output_dir or root, 'data/manifests')
+        self.pins_path = pins_path or os.path.join(root, 'data/pins.txt')
+        self.grace_sec = grace_sec
+
+    def pins(self):
+        if not os.path.exists(self.pins_path):
+            return set()
+        with open(self.pins_path, 'r') as infile:
+            return {l.strip() for l in infile if l.strip() and not l.startswith('#')}
+
+    def set_pins(self, pins):
+        utils.create_dir(os.path.dirname(self.pins_path))
+        tmp_path = utils.tmp_path(self.pins_path)
+        with open(tmp_path, 'w') as outfile:
+            for p in sorted(pins):
+                outfile.write(p + '\n')
+        os.replace(tmp_path, self.pins_path)
+
+    def _manifest_path(self, dirname):
+        # XXX: Install dirs are named after the sanitized package.
+        sname, sversion = dirname.split('___', 1)
+        return manifest.manifest_path(self.manifests_root, sname + ':' + sversion)
+
+    def installs(self):
+        if not os.path.isdir(self.install_root):
+            return []
+        installs = []
+        for d in os.listdir(self.install_root):
+            if '___' not in d or d.startswith('.'):
+                continue
+            path = os.path.join(self.install_root, d)
+            try:
+                installs.append(Install(path, self._manifest_path(d)))
+            except FileNotFoundError:
+                continue
+        return installs
+
+    def usage(self):
+        return disk_usage(self.install_root, self.store_root)
+
+    def prune_store(self):
+        # XXX: Objects no install links to anymore. Stored trees that need
+        #      them are dropped the next time they fail to materialize.
+        #      Objects touched within the grace period may be in the middle
+        #      of being ingested, between their creation and the link from
+        #      the install.
+        files_root = os.path.join(self.store_root, 'files')
+        freed = 0
+        now = time.time()
+        for root, dirs, files in os.walk(files_root):
+            for f in files:
+                path = os.path.join(root, f)
+                try:
+                    st = os.lstat(path)
+                except FileNotFoundError:
+                    continue
+                if now - st.st_mtime < self.grace_sec:
+                    continue
+                if st.st_nlink == 1 and '.tmp.' not in f:
+                    os.remove(path)
+                    freed += st.st_blocks * 512
+        return freed
+
+    def clear_trash(self):
+        # XXX: Left behind by evictions that were interrupted.
+        if not os.path.isdir(self.install_root):
+            return
+        for d in os.listdir(self.install_root):
+            if d.startswith('.trash-'):
+                shutil.rmtree(os.path.join(self.install_root, d), ignore_errors=True)
+
+    def evict(self, install, dry_run=False):
+        freed = private_bytes(install.path)
+        log.info(f"Evicting {install.name} ({install.state()}, {format_size(freed)})")
+        if not dry_run:
+            # XXX: Move it out of the way first, so that nobody sees a
+            #      half-deleted install.
+            trash = os.path.join(self.install_root, '.trash-' + install.name + '-' + str(os.getpid()))
+            os.rename(install.path, trash)
+            shutil.rmtree(trash, ignore_errors=True)
+        return freed
+
+    def collect(self, budget=None, max_age=None, policy=LRU, exclude=(), dry_run=False):
+        # XXX: Returns (evicted install names, bytes in use afterwards).
+        now = time.time()
+        pinned = {install_dir_name(p) for p in self.pins()}
+        exclude = {install_dir_name(p) for p in exclude}
+        candidates = []
+        for i in self.installs():
+            if i.name in pinned or i.name in exclude:
+                continue
+            if now - i.last_used < self.grace_sec:
+                continue
+            if i.state() == 'busy':
+                continue
+            candidates.append(i)
+        sort_key = (lambda i: i.last_used) if policy == LRU else (lambda i: i.created)
+        candidates.sort(key=sort_key)
+
+        if not dry_run:
+            self.clear_trash()
+
+        evicted = []
+        if max_age is not None:
+            for i in list(candidates):
+                if now - sort_key(i) > max_age:
+                    self.evict(i, dry_run)
+                    evicted.append(i.name)
+                    candidates.remove(i)
+        if evicted and not dry_run:
+            self.prune_store()
+
+        usage = self.usage()
+        if budget is not None and usage > budget:
+            if not dry_run:
+                usage -= self.prune_store()
+            for i in candidates:
+                if usage <= budget:
+                    break
+                usage -= self.evict(i, dry_run)
+                evicted.append(i.name)
+            if not dry_run:
+                self.prune_store()
+                usage = self.usage()
+            if usage > budget:
+                log.warning(f"Still using {format_size(usage)}, over the budget of {format_size(budget)};"
+                            " the rest is pinned or in use")
+        return evicted, usage
+
+
+class DiskBudget():
+    # XXX: Rate-limited collect() for find_bridges.py --disk-budget.
+    def __init__(self, budget, output_dir=None, policy=LRU, interval_sec=DEFAULT_INTERVAL_SEC):
+        self.gc = DiskGC(output_dir=output_dir)
+        self.budget = budget
+        self.policy = policy
+        self.interval_sec = interval_sec
+        self.last = 0
+
+    def maybe_collect(self, exclude=(), force=False):
+        if not force and time.time() - self.last < self.interval_sec:
+            return
+        self.last = time.time()
+        evicted, usage = self.gc.collect(budget=self.budget, policy=self.policy, exclude=exclude)
+        log.info(f"Disk GC: evicted {len(evicted)} installs, using {format_size(usage)}"
+                 f" of {format_size(self.budget)}")
+
+
+def main():
+    p = argparse.ArgumentParser(description='Evict install trees (data/install) to stay within a disk budget.')
+    p.add_argument(
+        "-l",
+        "--log",
+        default="info",
+        help=("Provide logging level. Example --log debug"),
+    )
+    p.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help=("Output directory that find_bridges.py was run with, to find the manifests."),
+    )
+    sub = p.add_subparsers(dest='command', required=True)
+    run = sub.add_parser('run', help='Evict installs.')
+    run.add_argument("--budget", default=None, type=parse_size,
+                     help=("Evict until data/install and data/store use at most this much (e.g., 50G)."))
+    run.add_argument("--max-age", default=None, type=float,
+                     help=("Evict installs older than this many days, regardless of the budget."))
+    run.add_argument("--policy", default=LRU, choices=[LRU, AGE],
+                     help=("Evict least recently used installs first (lru) or oldest installs first (age)."))
+    run.add_argument("--grace", default=DEFAULT_GRACE_SEC, type=int,
+                     help=("Never evict installs used within this many seconds."))
+    run.add_argument("-n", "--dry-run", default=False, action='store_true',
+                     help=("Only print what would be evicted."))
+    sub.add_parser('usage', help='Print disk usage of data/install and data/store.')
+    pin = sub.add_parser('pin', help='Never evict the installs of these packages.')
+    pin.add_argument("packages", nargs='+', help=("package:version pairs."))
+    unpin = sub.add_parser('unpin', help='Allow evicting the installs of these packages again.')
+    unpin.add_argument("packages", nargs='+', help=("package:version pairs."))
+    sub.add_parser('pins', help='List pinned packages.')
+    args = p.parse_args()
+
+    utils.setup_logging(args)
+
+    gc = DiskGC(output_dir=args.output, grace_sec=getattr(args, 'grace', DEFAULT_GRACE_SEC))
+    if args.command == 'run':
+        if args.budget is None and args.max_age is None:
+            log.error("Must provide --budget and/or --max-age")
+            sys.exit(1)
+        max_age = args.max_age * 24 * 60 * 60 if args.max_age is not None else None
+        evicted, usage = gc.collect(budget=args.budget, max_age=max_age, policy=args.policy,
+                                    dry_run=args.dry_run)
+        print(f"{'Would evict' if args.dry_run else 'Evicted'} {len(evicted)} installs;"
+              f" using {format_size(usage)}")
+    elif args.command == 'usage':
+        print(format_size(gc.usage()))
+    elif args.command == 'pin':
+        gc.set_pins(gc.pins() | set(args.packages))
+    elif args.command == 'unpin':
+        gc.set_pins(gc.pins() - set(args.packages))
+    elif args.command == 'pins':
+        for p in sorted(gc.pins()):
+            print(p)
+
+
+if __name__ == "__main__":
+    main()
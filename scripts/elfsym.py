@@ -0,0 +1,508 @@
+import os
+import sys
+import mmap
+import struct
+import hashlib
+import logging
+from bisect import bisect_right
+
+log = logging.getLogger(__name__)
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+
+ET_EXEC = 2
+ET_DYN = 3
+
+PT_LOAD = 1
+PT_NOTE = 4
+
+PF_X = 0x1
+PF_W = 0x2
+PF_R = 0x4
+
+SHT_SYMTAB = 2
+SHT_NOTE = 7
+SHT_NOBITS = 8
+SHT_DYNSYM = 11
+
+SHF_ALLOC = 0x2
+
+SHN_UNDEF = 0
+SHN_LORESERVE = 0xff00
+
+STT_NOTYPE = 0
+STT_OBJECT = 1
+STT_FUNC = 2
+STT_SECTION = 3
+STT_FILE = 4
+STT_TLS = 6
+STT_GNU_IFUNC = 10
+
+STB_LOCAL = 0
+STB_GLOBAL = 1
+STB_WEAK = 2
+
+NT_GNU_BUILD_ID = 3
+
+# XXX: Lower rank wins when several symbols share an address,
+#      roughly following GDB's preference for minimal symbols.
+TYPE_RANK = {STT_FUNC: 0, STT_GNU_IFUNC: 0, STT_OBJECT: 1, STT_NOTYPE: 2}
+BIND_RANK = {STB_GLOBAL: 0, STB_WEAK: 1, STB_LOCAL: 2}
+
+
+class ElfError(Exception):
+    pass
+
+
+class Section():
+    def __init__(self, name, sh_type, flags, addr, offset, size, link, entsize):
+        self.name = name
+        self.sh_type = sh_type
+        self.flags = flags
+        self.addr = addr
+        self.offset = offset
+        self.size = size
+        self.link = link
+        self.entsize = entsize
+
+
+class Segment():
+    def __init__(self, p_type, offset, vaddr, filesz, memsz, flags=0):
+        self.p_type = p_type
+        self.offset = offset
+        self.vaddr = vaddr
+        self.filesz = filesz
+        self.memsz = memsz
+        self.flags = flags
+
+
+class ElfFile():
+    def __init__(self, path):
+        self.path = path
+        self._fd = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # XXX: Empty file.
+            self._fd.close()
+            raise ElfError(f"{path} is empty")
+        self._parse_header()
+        self._parse_segments()
+        self._parse_sections()
+        self._addrs = None
+        self._names = None
+        self._sec_addrs = None
+        self._secs = None
+
+    def close(self):
+        self._addrs = None
+        self._names = None
+        self.data.close()
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _parse_header(self):
+        d = self.data
+        if len(d) < 16 or d[:4] != b'\x7fELF':
+            raise ElfError(f"{self.path} is not an ELF file")
+        self.elfclass = d[4]
+        if self.elfclass not in (ELFCLASS32, ELFCLASS64):
+            raise ElfError(f"{self.path}: unknown ELF class {self.elfclass}")
+        self.endian = '<' if d[5] == ELFDATA2LSB else '>'
+        e = self.endian
+        if self.elfclass == ELFCLASS64:
+            hdr = struct.unpack_from(e + 'HHIQQQIHHHHHH', d, 16)
+        else:
+            hdr = struct.unpack_from(e + 'HHIIIIIHHHHHH', d, 16)
+        (self.e_type, self.e_machine, _, self.e_entry, self.e_phoff,
+         self.e_shoff, _, _, self.e_phentsize, self.e_phnum,
+         self.e_shentsize, self.e_shnum, self.e_shstrndx) = hdr
+
+    def _parse_segments(self):
+        e = self.endian
+        self.segments = []
+        for i in range(self.e_phnum):
+            off = self.e_phoff + i * self.e_phentsize
+            if self.elfclass == ELFCLASS64:
+                p_type, p_flags, p_offset, p_vaddr, _, p_filesz, p_memsz, _ = \
+                    struct.unpack_from(e + 'IIQQQQQQ', self.data, off)
+            else:
+                p_type, p_offset, p_vaddr, _, p_filesz, p_memsz, p_flags, _ = \
+                    struct.unpack_from(e + 'IIIIIIII', self.data, off)
+            self.segments.append(Segment(p_type, p_offset, p_vaddr, p_filesz, p_memsz, p_flags))
+
+    def _parse_sections(self):
+        e = self.endian
+        raw = []
+        if self.e_shoff == 0 or self.e_shoff >= len(self.data):
+            self.sections = []
+            return
+        for i in range(self.e_shnum):
+            off = self.e_shoff + i * self.e_shentsize
+            if self.elfclass == ELFCLASS64:
+                fields = struct.unpack_from(e + 'IIQQQQIIQQ', self.data, off)
+            else:
+                fields = struct.unpack_from(e + 'IIIIIIIIII', self.data, off)
+            raw.append(fields)
+        shstr = raw[self.e_shstrndx] if self.e_shstrndx < len(raw) else None
+        self.sections = []
+        for (name, sh_type, flags, addr, offset, size, link, _, _, entsize) in raw:
+            sname = self._cstr(shstr[4] + name) if shstr is not None else ''
+            self.sections.append(Section(sname, sh_type, flags, addr, offset,
+                                         size, link, entsize))
+
+    def _cstr(self, off):
+        end = self.data.find(b'\0', off)
+        if end < 0:
+            end = len(self.data)
+        return self.data[off:end].decode('utf-8', errors='replace')
+
+    def section(self, name):
+        for s in self.sections:
+            if s.name == name:
+                return s
+        return None
+
+    def has_symtab(self):
+        return any(s.sh_type == SHT_SYMTAB for s in self.sections)
+
+    def has_debug_info(self):
+        return any(s.name.startswith(('.debug_info', '.zdebug_info')) for s in self.sections)
+
+    def build_id(self):
+        for s in self.sections:
+            if s.sh_type == SHT_NOTE:
+                bid = self._scan_notes(s.offset, s.size)
+                if bid is not None:
+                    return bid
+        for seg in self.segments:
+            if seg.p_type == PT_NOTE:
+                bid = self._scan_notes(seg.offset, seg.filesz)
+                if bid is not None:
+                    return bid
+        return None
+
+    def _scan_notes(self, offset, size):
+        e = self.endian
+        pos = offset
+        end = min(offset + size, len(self.data))
+        while pos + 12 <= end:
+            namesz, descsz, ntype = struct.unpack_from(e + 'III', self.data, pos)
+            pos += 12
+            name = bytes(self.data[pos:pos + namesz])
+            pos += (namesz + 3) & ~3
+            desc = bytes(self.data[pos:pos + descsz])
+            pos += (descsz + 3) & ~3
+            if ntype == NT_GNU_BUILD_ID and name.rstrip(b'\0') == b'GNU':
+                return desc.hex()
+        return None
+
+    def load_bias(self, map_start, map_offset, perms=None, size=None):
+        # XXX: Find the PT_LOAD segment that was mapped at map_offset
+        #      and derive the difference between runtime and link-time
+        #      addresses from it. Other mappings of the file at the same
+        #      offset (e.g., our own mmap() of it) are told apart by
+        #      their permissions and size, when given.
+        if self.e_type == ET_EXEC:
+            return 0
+        for seg in self.segments:
+            if seg.p_type != PT_LOAD:
+                continue
+            if (seg.offset & ~(PAGE_SIZE - 1)) != map_offset:
+                continue
+            if perms is not None and not segment_perms_match(seg, perms):
+                continue
+            if size is not None and size > page_ceil((seg.vaddr & (PAGE_SIZE - 1)) + seg.memsz):
+                continue
+            return map_start - (seg.vaddr & ~(PAGE_SIZE - 1))
+        return None
+
+    def _iter_symbols(self, sec):
+        e = self.endian
+        if sec.link >= len(self.sections) or sec.entsize == 0:
+            return
+        strtab = self.sections[sec.link]
+        if self.elfclass == ELFCLASS64:
+            fmt = e + 'IBBHQQ'
+        else:
+            fmt = e + 'IIIBBH'
+        count = sec.size // sec.entsize
+        data = self.data
+        for i in range(count):
+            off = sec.offset + i * sec.entsize
+            if self.elfclass == ELFCLASS64:
+                st_name, st_info, _, st_shndx, st_value, st_size = \
+                    struct.unpack_from(fmt, data, off)
+            else:
+                st_name, st_value, st_size, st_info, _, st_shndx = \
+                    struct.unpack_from(fmt, data, off)
+            yield st_name, st_info, st_shndx, st_value, strtab.offset
+
+    def dynsyms(self):
+        # XXX: (name, st_info, st_shndx, st_value) of every .dynsym entry,
+        #      in symbol table order so that relocations can index it.
+        for sec in self.sections:
+            if sec.sh_type == SHT_DYNSYM:
+                return [(self._cstr(stroff + st_name) if st_name else '', st_info, st_shndx, st_value)
+                        for st_name, st_info, st_shndx, st_value, stroff in self._iter_symbols(sec)]
+        return []
+
+    def file_offset(self, vaddr):
+        s = self.section_at(vaddr)
+        if s is None or s.sh_type == SHT_NOBITS:
+            return None
+        return s.offset + (vaddr - s.addr)
+
+    def cstr_at(self, vaddr):
+        off = self.file_offset(vaddr)
+        if off is None:
+            return None
+        return self._cstr(off)
+
+    def _build_index(self):
+        best = {}
+        for sec in self.sections:
+            if sec.sh_type not in (SHT_SYMTAB, SHT_DYNSYM):
+                continue
+            for st_name, st_info, st_shndx, st_value, stroff in self._iter_symbols(sec):
+                stype = st_info & 0xf
+                sbind = st_info >> 4
+                if st_name == 0 or st_value == 0:
+                    continue
+                if st_shndx == SHN_UNDEF or st_shndx >= SHN_LORESERVE:
+                    continue
+                if stype not in TYPE_RANK:
+                    continue
+                rank = (TYPE_RANK[stype], BIND_RANK.get(sbind, 3))
+                cur = best.get(st_value)
+                if cur is not None and cur[0] <= rank:
+                    continue
+                best[st_value] = (rank, stroff + st_name)
+        addrs = sorted(best)
+        self._addrs = addrs
+        self._names = [best[a][1] for a in addrs]
+
+        secs = sorted((s for s in self.sections if s.flags & SHF_ALLOC and s.size > 0),
+                      key=lambda s: s.addr)
+        self._sec_addrs = [s.addr for s in secs]
+        self._secs = secs
+
+    def section_at(self, vaddr):
+        if self._secs is None:
+            self._build_index()
+        i = bisect_right(self._sec_addrs, vaddr) - 1
+        if i < 0:
+            return None
+        s = self._secs[i]
+        if vaddr < s.addr + s.size:
+            return s
+        return None
+
+    def symbol_at(self, vaddr):
+        # XXX: Returns (name, offset) of the closest symbol at or below
+        #      vaddr, or None.
+        if self._addrs is None:
+            self._build_index()
+        i = bisect_right(self._addrs, vaddr) - 1
+        if i < 0:
+            return None
+        return self._cstr(self._names[i]), vaddr - self._addrs[i]
+
+
+def host_machine():
+    with ElfFile(os.path.realpath(sys.executable)) as elf:
+        return elf.e_machine
+
+
+def page_ceil(n):
+    return (n + PAGE_SIZE - 1) & ~(PAGE_SIZE - 1)
+
+
+def segment_perms_match(seg, perms):
+    # XXX: perms as in /proc/pid/maps. The loader maps segments private;
+    #      write access is not compared, since RELRO takes it away after
+    #      relocation.
+    if len(perms) < 4 or perms[3] != 'p':
+        return False
+    return (perms[0] == 'r') == bool(seg.flags & PF_R) and \
+        (perms[2] == 'x') == bool(seg.flags & PF_X)
+
+
+class Mapping():
+    def __init__(self, start, end, perms, offset, dev, inode, path):
+        self.start = start
+        self.end = end
+        self.perms = perms
+        self.offset = offset
+        self.dev = dev
+        self.inode = inode
+        self.path = path
+
+
+def parse_maps(text):
+    mappings = []
+    for line in text.splitlines():
+        parts = line.split(None, 5)
+        if len(parts) < 6:
+            continue
+        path = parts[5].strip()
+        if not path.startswith('/'):
+            continue
+        if path.endswith(' (deleted)'):
+            continue
+        lo, hi = parts[0].split('-')
+        mappings.append(Mapping(int(lo, 16), int(hi, 16), parts[1], int(parts[2], 16),
+                                parts[3], int(parts[4]), path))
+    return mappings
+
+
+def read_maps(pid):
+    with open(f'/proc/{pid}/maps', 'r') as infile:
+        return parse_maps(infile.read())
+
+
+class LoadedObject():
+    def __init__(self, path, elf, bias, ranges):
+        self.path = path
+        self.elf = elf
+        self.bias = bias
+        self.ranges = ranges
+        self._key = None
+
+    @property
+    def key(self):
+        # XXX: Stable identity of the file contents: the GNU build-id when
+        #      present, a content hash otherwise.
+        if self._key is None:
+            bid = self.elf.build_id()
+            if bid is not None:
+                self._key = 'gnu:' + bid
+            else:
+                self._key = 'sha256:' + hashlib.sha256(self.elf.data).hexdigest()
+        return self._key
+
+
+class ElfResolver():
+    def __init__(self, pid=None, maps_text=None):
+        self.pid = pid
+        self.maps_text = maps_text
+        self.elfs = {}
+        self.objects = []
+        self._starts = []
+        self._stale = False
+        self.refresh()
+
+    def close(self):
+        for elf in self.elfs.values():
+            if elf is not None:
+                elf.close()
+        self.elfs = {}
+
+    def _elf(self, path):
+        if path not in self.elfs:
+            try:
+                self.elfs[path] = ElfFile(path)
+            except (OSError, ElfError) as e:
+                log.debug(f"Skipping {path}: {e}")
+                self.elfs[path] = None
+        return self.elfs[path]
+
+    def refresh(self):
+        if self.maps_text is not None:
+            mappings = parse_maps(self.maps_text)
+        else:
+            mappings = read_maps(self.pid)
+        by_path = {}
+        for m in mappings:
+            by_path.setdefault(m.path, []).append(m)
+        objects = []
+        for path, maps in by_path.items():
+            elf = self._elf(path)
+            if elf is None:
+                continue
+            bias = None
+            for m in sorted(maps, key=lambda m: (m.offset, m.start)):
+                bias = elf.load_bias(m.start, m.offset, m.perms, m.end - m.start)
+                if bias is not None:
+                    break
+            if bias is None:
+                continue
+            # XXX: Only what the loader mapped; shared mappings are not.
+            ranges = [(m.start, m.end) for m in maps if m.perms[3:4] == 'p']
+            objects.append(LoadedObject(path, elf, bias, ranges))
+        ranges = []
+        for obj in objects:
+            for lo, hi in obj.ranges:
+                ranges.append((lo, hi, obj))
+        ranges.sort(key=lambda r: r[0])
+        self._ranges = ranges
+        self._starts = [r[0] for r in ranges]
+
+    def begin_batch(self):
+        # XXX: The target may have dlopen()ed new modules since the maps
+        #      were last read. Allow one re-read per batch on a miss.
+        self._stale = self.maps_text is None
+
+    def _locate(self, address):
+        i = bisect_right(self._starts, address) - 1
+        if i >= 0:
+            lo, hi, obj = self._ranges[i]
+            if address < hi:
+                return obj
+        return None
+
+    def locate(self, address):
+        obj = self._locate(address)
+        if obj is None and self._stale:
+            self.refresh()
+            self._stale = False
+            obj = self._locate(address)
+        return obj
+
+    def lookup(self, address):
+        # XXX: Returns (cfunc, section, library) for addresses that are the
+        #      exact start of a symbol, matching what parse_gdb_line()
+        #      accepts from GDB's `info symbol`.
+        obj = self.locate(address)
+        if obj is None:
+            return None
+        vaddr = address - obj.bias
+        sym = obj.elf.symbol_at(vaddr)
+        if sym is None or sym[1] != 0:
+            return None
+        sec = obj.elf.section_at(vaddr)
+        section = sec.name if sec is not None else '??'
+        return sym[0], section, obj.path
+
+    def resolve(self, addresses):
+        result = {}
+        self.begin_batch()
+        for addr in addresses:
+            address = parse_address(addr)
+            if address is None:
+                continue
+            res = self.lookup(address)
+            if res is None:
+                log.debug("Address: %s | NOTFOUND" % addr)
+                continue
+            result[address] = res
+        return result
+
+
+def parse_address(addr):
+    try:
+        if isinstance(addr, int):
+            return addr
+        return int(str(addr).strip(), 0)
+    except ValueError:
+        log.debug(f"Invalid address: {addr}")
+        return None
@@ -0,0 +1,296 @@
+import os
+import re
+import json
+import logging
+import argparse
+
+import utils
+import manifest
+
+log = logging.getLogger(__name__)
+
+GASKET_ROOT = os.getenv("GASKET_ROOT")
+
+# XXX: Bump whenever classification changes, so that outcomes recorded by
+#      an older version are classified again.
+VERSION = 1
+
+TIMEOUT = 'timeout'
+CRASH = 'crash'
+ABI_MISMATCH = 'abi-mismatch'
+MISSING_LIBRARY = 'missing-library'
+MISSING_DEPENDENCY = 'missing-dependency'
+LOAD_ERROR = 'load-error'
+NO_MODULES = 'no-modules'
+STRIPPED = 'stripped'
+ANALYSIS = 'analysis'
+NO_BRIDGES = 'no-bridges'
+TOOLCHAIN = 'toolchain'
+BUILD_ERROR = 'build-error'
+NETWORK = 'network'
+UNKNOWN = 'unknown'
+
+REBUILD = 'rebuild'
+# XXX: Building from source cannot help; remembered across runs.
+SKIP_REBUILD = 'skip-rebuild'
+# XXX: Most likely transient; neither rebuilt nor remembered.
+RETRY = 'retry'
+
+POLICY = {
+    TIMEOUT: RETRY,
+    CRASH: SKIP_REBUILD,
+    ABI_MISMATCH: REBUILD,
+    MISSING_LIBRARY: SKIP_REBUILD,
+    MISSING_DEPENDENCY: SKIP_REBUILD,
+    LOAD_ERROR: SKIP_REBUILD,
+    NO_MODULES: REBUILD,
+    STRIPPED: REBUILD,
+    ANALYSIS: SKIP_REBUILD,
+    NO_BRIDGES: SKIP_REBUILD,
+    TOOLCHAIN: SKIP_REBUILD,
+    BUILD_ERROR: SKIP_REBUILD,
+    NETWORK: RETRY,
+    # XXX: What we always did before there was a taxonomy.
+    UNKNOWN: REBUILD,
+}
+
+# XXX: Reasons in gasket's "failed" map. Only unresolved addresses have
+#      anything to do with how the module was built.
+SYMBOL_REASONS = {'CFUNC_ADDRESS_RESOLUTION'}
+ANALYSIS_REASONS = {
+    'NULL_CB',
+    'EXTRACT_NAPI',
+    'EXTRACT_NAN',
+    'EXTRACT_FCB_INOKE',
+    'NEON_FAIL',
+    'OVERLOAD_RESOLUTION',
+}
+
+# XXX: require() errors that a module built here would not run into.
+ABI_PATTERNS = re.compile(
+    r"NODE_MODULE_VERSION"
+    r"|compiled against a different Node\.js version"
+    r"|wrong ELF class"
+    r"|invalid ELF header"
+    r"|ELF file OS ABI invalid"
+    r"|Exec format error"
+    r"|undefined symbol"
+    r"|version `(GLIBC|GLIBCXX|CXXABI)_[\d.]+' not found"
+    r"|Module did not self-register")
+MISSING_LIBRARY_PATTERNS = re.compile(r"cannot open shared object file")
+MISSING_DEPENDENCY_PATTERNS = re.compile(r"Cannot find module")
+
+NETWORK_PATTERNS = re.compile(
+    r"ETIMEDOUT|ECONNRESET|ECONNREFUSED|EAI_AGAIN|ENOTFOUND|socket hang up|network timeout")
+TOOLCHAIN_PATTERNS = re.compile(
+    r"gyp ERR! find Python"
+    r"|not found: make"
+    r"|\b(make|gcc|g\+\+|cc|c\+\+|clang|clang\+\+|cmake|cargo|rustc|python3?|pkg-config)"
+    r": (command )?not found"
+    r"|fatal error: [^:\n]+: No such file or directory"
+    r"|Package \S+ was not found in the pkg-config search path")
+
+# XXX: Loads a module the way gasket does, so that we can tell why it
+#      does not load; exits with 3 if require() throws.
+PROBE_MARKER = 'gasket-probe: '
+PROBE_JS = """
+const PROBE_MARKER = '%s'
+try {
+    require(process.argv[1])
+} catch (error) {
+    console.error(PROBE_MARKER + JSON.stringify(String(error && error.message || error)))
+    process.exit(3)
+}
+""" % PROBE_MARKER
+PROBE_TIMEOUT_SEC = 60
+
+PROBE_OK = 'ok'
+PROBE_ERROR = 'error'
+PROBE_CRASH = 'crash'
+
+
+class Diagnosis():
+    def __init__(self, klass, detail=''):
+        self.klass = klass
+        self.detail = detail
+
+    @property
+    def policy(self):
+        return POLICY[self.klass]
+
+    def __repr__(self):
+        return f"{self.klass} ({self.policy}): {self.detail}"
+
+
+def is_signal(ret):
+    # XXX: -1 is also what we return when we could not run the command.
+    return (ret < 0 and ret != -1) or ret > 128
+
+
+def probe(module):
+    # XXX: Returns (PROBE_* or None, message).
+    try:
+        ret, out, err = utils.run_cmd(['node', '-e', PROBE_JS, module],
+                                      timeout=PROBE_TIMEOUT_SEC, idle_timeout=PROBE_TIMEOUT_SEC)
+    except Exception as e:
+        # XXX: Tells us nothing about the module.
+        log.error(e)
+        return None, str(e)
+    if ret == 0:
+        return PROBE_OK, ''
+    for line in err.splitlines():
+        if line.startswith(PROBE_MARKER) and ret == 3:
+            return PROBE_ERROR, json.loads(line[len(PROBE_MARKER):]).split('\n')[0]
+    message = err.strip().splitlines()[-1] if err.strip() else ''
+    if ret == utils.RET_TIMEOUT:
+        return PROBE_CRASH, 'hangs on require()'
+    return PROBE_CRASH, f"exit status {ret} on require() {message}".strip()
+
+
+def classify_load_error(message):
+    if ABI_PATTERNS.search(message):
+        return ABI_MISMATCH
+    if MISSING_LIBRARY_PATTERNS.search(message):
+        return MISSING_LIBRARY
+    if MISSING_DEPENDENCY_PATTERNS.search(message):
+        return MISSING_DEPENDENCY
+    return LOAD_ERROR
+
+
+def empty_modules(model):
+    # XXX: Modules gasket got no bridges out of. module_stats is missing
+    #      from bridges.json files written by older gasket versions.
+    libraries = {b.library for b in model.bridges}
+    empty = []
+    for m in model.modules:
+        stats = model.module_stats.get(m)
+        if stats is not None and 'count' in stats:
+            if stats['count'] == 0:
+                empty.append(m)
+        elif m not in libraries:
+            empty.append(m)
+    return empty
+
+
+def diagnose_modules(modules, probe=probe):
+    # XXX: The first module a rebuild could help wins, then the first one
+    #      it could not; None if they all load.
+    found = []
+    for m in modules:
+        status, message = probe(m)
+        if status == PROBE_CRASH:
+            found.append(Diagnosis(CRASH, f"{m}: {message}"))
+        elif status == PROBE_ERROR:
+            found.append(Diagnosis(classify_load_error(message), f"{m}: {message}"))
+    for d in found:
+        if d.policy == REBUILD:
+            return d
+    return found[0] if found else None
+
+
+def reason_counts(failed):
+    counts = {}
+    for f in failed:
+        counts[f.reason] = counts.get(f.reason, 0) + 1
+    return counts
+
+
+def classify(ret, model=None, modules=(), stripped=(), probe=probe):
+    # XXX: Why a gasket run did not give usable bridges: its exit status
+    #      ret, the bridges.json it wrote (if any), the package's native
+    #      modules, and those of them without a .symtab.
+    if ret == utils.RET_TIMEOUT:
+        return Diagnosis(TIMEOUT, 'gasket timed out')
+    if ret != 0 or model is None:
+        d = diagnose_modules(modules, probe)
+        if d is not None:
+            return d
+        if ret != 0 and is_signal(ret):
+            return Diagnosis(CRASH, f"gasket exited with status {ret}")
+        return Diagnosis(UNKNOWN, f"gasket exited with status {ret}")
+    if not model.modules:
+        return Diagnosis(NO_MODULES, 'no native modules installed')
+    counts = reason_counts(model.failed)
+    empty = empty_modules(model)
+    if empty:
+        d = diagnose_modules(empty, probe)
+        if d is not None:
+            return d
+        stripped_empty = [m for m in empty if m in stripped]
+        if stripped_empty:
+            return Diagnosis(STRIPPED, f"no symbols in {', '.join(stripped_empty)}")
+    if any(r in SYMBOL_REASONS for r in counts):
+        return Diagnosis(STRIPPED, f"failed: {counts}")
+    if empty:
+        if any(r in ANALYSIS_REASONS for r in counts):
+            return Diagnosis(ANALYSIS, f"failed: {counts}")
+        return Diagnosis(NO_BRIDGES, f"no bridges in {', '.join(empty)}")
+    return Diagnosis(UNKNOWN, f"failed: {counts}")
+
+
+def classify_build(ret, out='', err=''):
+    # XXX: Why npm install --build-from-source failed.
+    if ret == utils.RET_TIMEOUT:
+        return Diagnosis(TIMEOUT, 'build timed out')
+    text = (out or '') + '\n' + (err or '')
+    m = NETWORK_PATTERNS.search(text)
+    if m is not None:
+        return Diagnosis(NETWORK, m.group(0))
+    m = TOOLCHAIN_PATTERNS.search(text)
+    if m is not None:
+        return Diagnosis(TOOLCHAIN, m.group(0))
+    return Diagnosis(BUILD_ERROR, f"npm exited with status {ret}")
+
+
+def main():
+    p = argparse.ArgumentParser(description='Summarize why packages failed, from their manifests.')
+    p.add_argument(
+        "-l",
+        "--log",
+        default="warning",
+        help=("Provide logging level. Example --log debug"),
+    )
+    p.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help=("Output directory that find_bridges.py was run with, to find the manifests."),
+    )
+    p.add_argument("-v", "--verbose", default=False, action='store_true',
+                   help=("List the packages of each class."))
+    p.add_argument("--probe", default=None, nargs='+', metavar='MODULE',
+                   help=("Instead, report why these .node files do (not) load."))
+    args = p.parse_args()
+    utils.setup_logging(args)
+
+    if args.probe:
+        for m in args.probe:
+            status, message = probe(m)
+            klass = classify_load_error(message) if status == PROBE_ERROR else status
+            print(f"{m}\t{klass}\t{message}")
+        return
+
+    root = os.path.join(args.output or GASKET_ROOT, 'data/manifests')
+    classes = {}
+    for dirpath, dirs, files in os.walk(root):
+        for f in files:
+            if not f.endswith('.json'):
+                continue
+            path = os.path.join(dirpath, f)
+            rec = manifest.Manifest(path).get('failure')
+            if rec is None:
+                continue
+            key = (rec['failure'], rec.get('rebuild', False))
+            classes.setdefault(key, []).append(os.path.relpath(path, root)[:-len('.json')])
+    if not classes:
+        print("No recorded failures")
+        return
+    for (klass, rebuild), pkgs in sorted(classes.items(), key=lambda kv: -len(kv[1])):
+        print(f"{len(pkgs):>8}  {klass:<20} {'rebuild' if rebuild else 'no rebuild'}")
+        if args.verbose:
+            for pkg in sorted(pkgs):
+                print(f"          {pkg}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,92 @@
 import os
-import re
 import sys
 import json
 import argparse
 import logging
-from pathlib import Path
 import shutil
-import tempfile
+import tarfile
+import time
+import hashlib
+import functools
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 
 import utils
+import elfsym
+import tracing
+import demangle
+import manifest
+import tarballs
+import triage
+import bridgestore
+import buildcache
+import installstore
+import diskgc
+import modcache
+import staticbridges
+import objects
+import symcache
+import resolve_syms
+import workqueue
+import scheduler
+import failures
+import pipeline
 
 log = logging.getLogger(__name__)
 
 GASKET_ROOT = os.getenv("GASKET_ROOT")
 
-def setup_logging(args):
-    levels = {
-        "critical": logging.CRITICAL,
-        "error": logging.ERROR,
-        "warn": logging.WARNING,
-        "warning": logging.WARNING,
-        "info": logging.INFO,
-        "debug": logging.DEBUG,
-    }
-    level = levels.get(args.log.lower())
-    if level is None:
-        raise ValueError(
-            f"log level given: {args.log}"
-            f" -- must be one of: {' | '.join(levels.keys())}"
-        )
-
-    fmt = "%(asctime)s "
-    fmt += "%(module)s:%(lineno)s [%(levelname)s] "
-    fmt += "%(message)s"
-    # Use ISO 8601 format
-    datefmt='%Y-%m-%dT%H:%M:%S'
-
-    logging.basicConfig(level=level, format=fmt, datefmt=datefmt)
+# XXX: Bump a stage's version whenever its logic changes in a way that
+#      invalidates previously generated artifacts.
+STAGE_VERSIONS = {
+    'triage': 1,
+    'install': 1,
+    'bridges': 1,
+    'csv': 2,
+}
+
+# XXX: Files whose contents determine what gasket extracts.
+TOOL_FILES = [
+    'package.json',
+    'bin/gasket.js',
+    'src/native.cc',
+    'src/ffdir.js',
+    'scripts/resolve_syms.py',
+    'scripts/elfsym.py',
+]
+
+DEFAULT_TIMEOUT_SEC = 2 * 60 * 60
+# XXX: npm hides install script output until the script exits, so a
+#      legitimate node-gyp build can stay silent for a long time.
+DEFAULT_IDLE_TIMEOUT_SEC = 30 * 60
+
+@functools.lru_cache(maxsize=None)
+def tool_version():
+    h = hashlib.sha256()
+    for f in TOOL_FILES:
+        path = os.path.join(GASKET_ROOT, f)
+        if os.path.exists(path):
+            h.update(f.encode())
+            h.update(utils.sha256_file(path).encode())
+    return h.hexdigest()[:16]
+
+@functools.lru_cache(maxsize=None)
+def node_version():
+    try:
+        ret, out, err = utils.run_cmd(['node', '--version'])
+    except Exception as e:
+        log.warning(e)
+        return None
+    return out.strip() if ret == 0 else None
+
+@functools.lru_cache(maxsize=None)
+def node_abi():
+    try:
+        ret, out, err = utils.run_cmd(['node', '-p', 'process.versions.modules'])
+    except Exception as e:
+        log.warning(e)
+        return None
+    return out.strip() if ret == 0 else None
 
 def parse_args():
     p = argparse.ArgumentParser(description='Use Gasket to generate bridges for a set of Node.js packages.')
@@ -65,11 +115,230 @@ def parse_args():
         action='store_true',
         help=("Always generate artifacts; do not reuse existing data (e.g., installs)."),
     )
+    p.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        type=int,
+        help=("Number of packages to process in parallel, each in its own worker process."),
+    )
+    p.add_argument(
+        "--log-dir",
+        default=None,
+        help=("Directory for per-package log files. Defaults to data/logs when --jobs > 1."),
+    )
+    p.add_argument(
+        "--trace",
+        default=None,
+        help=("Append per-stage tracing spans (JSON lines) to this file."),
+    )
+    p.add_argument(
+        "--chrome-trace",
+        default=None,
+        help=("At the end of the run, also write the spans as a Chrome trace-event file."),
+    )
+    p.add_argument(
+        "--store",
+        nargs='?',
+        default=None,
+        const='',
+        help=("Ingest each finished package into the bridge store at this path"
+              " (default: data/bridges.sqlite)."),
+    )
+    p.add_argument(
+        "--tarball-cache",
+        default=False,
+        action='store_true',
+        help=("Install from the local tarball store (data/tarballs) and a shared npm cache"
+              " instead of straight from the registry."),
+    )
+    p.add_argument(
+        "--no-tarball-cache",
+        default=False,
+        action='store_true',
+        help=("Install straight from the registry (the default); overrides --tarball-cache."),
+    )
+    p.add_argument(
+        "--offline",
+        default=False,
+        action='store_true',
+        help=("Never touch the network; serve installs from the tarball store and npm cache."
+              " Implies --tarball-cache."),
+    )
+    p.add_argument(
+        "--prefetch",
+        default=False,
+        action='store_true',
+        help=("Only fetch tarballs and warm the npm cache for all input packages, then exit."),
+    )
+    p.add_argument(
+        "--no-build-cache",
+        default=False,
+        action='store_true',
+        help=("Always compile build-from-source packages instead of reusing cached .node files."),
+    )
+    p.add_argument(
+        "--no-install-store",
+        default=False,
+        action='store_true',
+        help=("Give every install its own copy of node_modules instead of hardlinks into"
+              " the shared install store (data/store)."),
+    )
+    p.add_argument(
+        "--ccache",
+        default=False,
+        action='store_true',
+        help=("Compile build-from-source packages through ccache (data/ccache)."),
+    )
+    p.add_argument(
+        "--no-module-cache",
+        default=False,
+        action='store_true',
+        help=("Run gasket on every native module instead of reusing bridges of identical binaries."),
+    )
+    p.add_argument(
+        "--triage",
+        default=False,
+        action='store_true',
+        help=("Skip packages whose tarball shows no sign of native code, without installing"
+              " them; they get no bridges .txt. Implies --tarball-cache."),
+    )
+    p.add_argument(
+        "--no-triage",
+        default=False,
+        action='store_true',
+        help=("Install every package (the default); overrides --triage."),
+    )
+    p.add_argument(
+        "--retry-futile",
+        default=False,
+        action='store_true',
+        help=("Build from source even packages that a previous run found a rebuild cannot help"
+              " (e.g., after installing a missing toolchain)."),
+    )
+    p.add_argument(
+        "--static",
+        default=False,
+        action='store_true',
+        help=("Read the bridges of plain N-API modules off the ELF without loading them; only"
+              " modules the static analysis cannot fully account for go through gasket."),
+    )
+    p.add_argument(
+        "--defer-resolve",
+        default=False,
+        action='store_true',
+        help=("Run gasket on all packages first, snapshotting unresolved addresses, and"
+              " symbolize them afterwards in bulk from the snapshots."),
+    )
+    p.add_argument(
+        "--resolve-jobs",
+        default=None,
+        type=int,
+        help=("Number of workers for --defer-resolve symbolization. Defaults to --jobs."),
+    )
+    p.add_argument(
+        "--timeout",
+        default=DEFAULT_TIMEOUT_SEC,
+        type=int,
+        help=("Kill any single command (npm install, gasket, ...) running longer than this many"
+              " seconds. 0 disables the limit."),
+    )
+    p.add_argument(
+        "--idle-timeout",
+        default=DEFAULT_IDLE_TIMEOUT_SEC,
+        type=int,
+        help=("Kill any single command that prints nothing for this many seconds. 0 disables the limit."),
+    )
+    p.add_argument(
+        "--disk-budget",
+        default=None,
+        type=diskgc.parse_size,
+        help=("Evict verified installs (data/install, data/store) while running to stay within"
+              " this size (e.g., 50G). Pin packages with diskgc.py pin."),
+    )
+    p.add_argument(
+        "--gc-policy",
+        default=diskgc.LRU,
+        choices=[diskgc.LRU, diskgc.AGE],
+        help=("Which installs --disk-budget evicts first: least recently used or oldest."),
+    )
+    p.add_argument(
+        "--pipeline",
+        default=False,
+        action='store_true',
+        help=("Overlap the stages of different packages in one process: install the next packages"
+              " while earlier ones are analyzed, with separate limits per stage."),
+    )
+    p.add_argument(
+        "--install-jobs",
+        default=pipeline.DEFAULT_INSTALL_JOBS,
+        type=int,
+        help=("With --pipeline, number of concurrent npm installs of prebuilt packages."),
+    )
+    p.add_argument(
+        "--analyze-jobs",
+        default=None,
+        type=int,
+        help=("With --pipeline, number of concurrent gasket runs. Defaults to --jobs."),
+    )
+    p.add_argument(
+        "--build-jobs",
+        default=None,
+        type=int,
+        help=("With --pipeline, number of concurrent builds from source. Defaults to half of --jobs."),
+    )
+    p.add_argument(
+        "--install-ahead",
+        default=None,
+        type=int,
+        help=("With --pipeline, how many packages may be installed ahead of the analyzers; bounds"
+              " the install trees waiting on disk. Defaults to --install-jobs."),
+    )
+    p.add_argument(
+        "--queue",
+        default=None,
+        help=("Claim packages from the work queue in this shared directory instead of processing"
+              " the input CSV alone. With -i, the CSV is added to the queue first."),
+    )
+    p.add_argument(
+        "--lease-ttl",
+        default=workqueue.DEFAULT_LEASE_TTL,
+        type=int,
+        help=("Seconds after the last heartbeat before another worker may reclaim a queued package."),
+    )
+    p.add_argument(
+        "--max-attempts",
+        default=workqueue.DEFAULT_MAX_ATTEMPTS,
+        type=int,
+        help=("Give up on a queued package after this many claims (e.g., crashed workers)."),
+    )
+    p.add_argument(
+        "--schedule",
+        default=scheduler.CSV,
+        choices=scheduler.POLICIES,
+        help=("Order to process packages in: as in the CSV, longest predicted first (shortest"
+              " makespan), or shortest predicted first (earliest results). Predictions come from"
+              " previous runs' manifests and the stored tarballs."),
+    )
     return p.parse_args()
 
 class JavascriptBridger():
-    def __init__(self, package, output_dir, always):
+    def __init__(self, package, output_dir, always, tarball_store=None,
+                 build_cache=None, ccache=False, module_cache=None, use_triage=False,
+                 install_store=None, static=False, retry_futile=False):
         self.always = always
+        self.retry_futile = retry_futile
+        # XXX: With --queue, tells whether we still own the package's task;
+        #      outputs are only written while we do.
+        self.lease_check = None
+        self.static = static
+        self.install_store = install_store
+        self.use_triage = use_triage
+        self.reuse_analysis = False
+        self.module_cache = module_cache
+        self.tarball_store = tarball_store
+        self.build_cache = build_cache
+        self.ccache = ccache
         self.package = package
         self.output_dir = output_dir
         self.stripped = False
@@ -87,7 +356,7 @@ class JavascriptBridger():
 
         self.n2cgpath = None
 
-        self.namesnip = self.name[0] + '/' + self.sname + '/' + self.sversion
+        self.namesnip = utils.namesnip(package)
 
         self.tempinst_uuid = self.sname + '___' + self.sversion
         self.tmp_install_dir_root = os.path.join(GASKET_ROOT, 'data/install')
@@ -112,13 +381,170 @@ class JavascriptBridger():
 
         utils.create_dir(os.path.join(self.bridges_apps_root, self.namesnip))
 
+        manifests_root = os.path.join(self.output_dir or GASKET_ROOT, 'data/manifests')
+        self.manifest = manifest.Manifest(manifest.manifest_path(manifests_root, package))
+
+    def install_inputs(self):
+        return {
+            'spec': self.package,
+            'node': node_version(),
+            'version': STAGE_VERSIONS['install'],
+        }
+
+    def install_fresh(self):
+        if (self.always and not self.reuse_analysis) or not os.path.exists(self.pkg_inner_dir):
+            return False
+        return self.manifest.is_fresh('install', self.install_inputs())
+
+    def module_hashes(self):
+        hashes = {}
+        for path in self.find_native_modules():
+            hashes[os.path.relpath(path, self.pkg_inner_dir)] = utils.sha256_file(path)
+        return hashes
+
+    def bridges_inputs(self):
+        inputs = {
+            'tool': tool_version(),
+            'modules': self.module_hashes(),
+            'version': STAGE_VERSIONS['bridges'],
+        }
+        if self.static:
+            inputs['static'] = staticbridges.VERSION
+        return inputs
+
+    def bridges_output_ok(self):
+        rec = self.manifest.get('bridges')
+        if rec is None or not os.path.exists(self.bridges_path):
+            return False
+        return rec.get('output') == utils.sha256_file(self.bridges_path)
+
+    def bridges_fresh(self):
+        if self.always and not self.reuse_analysis:
+            return False
+        if not self.manifest.is_fresh('bridges', self.bridges_inputs()):
+            return False
+        return self.bridges_output_ok()
+
+    def csv_inputs(self):
+        return {
+            'bridges': utils.sha256_file(self.bridges_path),
+            'version': STAGE_VERSIONS['csv'],
+        }
+
+    def up_to_date(self):
+        # XXX: Cheap check that does not need the install tree; module
+        #      hashes are only compared once we actually get to the
+        #      bridges stage.
+        if self.always or not os.path.exists(self.bridges_csv_path):
+            return False
+        rec = self.manifest.get('csv')
+        if rec is None:
+            # XXX: The .txt is per package name, not per version. Keep the
+            #      old behaviour for files this version did not write.
+            log.info(f"Bridges .txt for {self.package} already exists at {self.bridges_csv_path}"
+                     " and is not tracked by this version's manifest")
+            return True
+        if rec['outcome'] != manifest.OK:
+            return False
+        b = self.manifest.get('bridges')
+        if b is None or b['outcome'] != manifest.OK:
+            return False
+        if b['inputs']['tool'] != tool_version() or b['inputs']['version'] != STAGE_VERSIONS['bridges']:
+            log.info(f"Bridges for {self.package} were generated by another tool version")
+            return False
+        if not self.bridges_output_ok():
+            return False
+        return rec['inputs'] == self.csv_inputs()
+
+    def triage_inputs(self):
+        return {
+            'spec': self.package,
+            'version': STAGE_VERSIONS['triage'],
+        }
+
+    @tracing.traced('triage')
+    def triage(self):
+        # XXX: Returns False only for packages that certainly have no
+        #      native code. Opt-in, and needs the tarball; otherwise we
+        #      always go ahead and install.
+        if not self.use_triage or self.tarball_store is None:
+            return True
+        inputs = self.triage_inputs()
+        if not self.always and self.manifest.is_fresh('triage', inputs):
+            rec = self.manifest.get('triage')
+            return rec['verdict'] != triage.PURE_JS
+        path = self.tarball_store.fetch(self.name, self.version)
+        if path is None:
+            return True
+        self.manifest.begin('triage', inputs)
+        try:
+            verdict, reasons = triage.triage_tarball(path)
+        except (OSError, EOFError, tarfile.TarError) as e:
+            log.warning(f"Could not triage {path}: {e}")
+            self.manifest.finish('triage', manifest.FAILED)
+            return True
+        log.info(f"Triage of {self.package}: {verdict} {reasons}")
+        self.manifest.finish('triage', manifest.OK, verdict=verdict, reasons=reasons)
+        return verdict != triage.PURE_JS
+
+    def install_spec(self):
+        if self.tarball_store is not None:
+            path = self.tarball_store.fetch(self.name, self.version)
+            if path is not None:
+                return path
+            log.warning(f"No tarball for {self.package}, installing from the registry")
+        return "{}@{}".format(self.name, self.version)
+
+    def npm_flags(self):
+        if self.tarball_store is not None:
+            return self.tarball_store.npm_flags()
+        return []
+
+    def install_key(self, build_from_source):
+        inputs = dict(self.install_inputs(), build_from_source=build_from_source)
+        if build_from_source:
+            inputs['toolchain'] = buildcache.toolchain()
+        return self.install_store.key(inputs)
+
+    def materialize_install(self, build_from_source):
+        # XXX: Lay out an install seen before from the install store,
+        #      without running npm. Returns the store key on success.
+        if self.install_store is None or self.always:
+            return None
+        key = self.install_key(build_from_source)
+        if not self.install_store.has(key):
+            return None
+        if os.path.exists(self.tmp_install_dir):
+            shutil.rmtree(self.tmp_install_dir)
+        if not self.install_store.materialize(key, self.tmp_install_dir):
+            return None
+        return key
+
+    def store_install(self, build_from_source):
+        if self.install_store is None:
+            return
+        try:
+            self.install_store.ingest(self.install_key(build_from_source), self.tmp_install_dir)
+        except OSError as e:
+            log.warning(f"Could not store install tree of {self.package}: {e}")
+
+    @pipeline.limited(pipeline.INSTALL)
+    @tracing.traced('install')
     def install_package(self):
         log.info(f"Installing {self.package}")
-        if os.path.exists(self.tmp_install_dir) and not self.always:
+        if self.install_fresh():
             log.info(f"Temp install dir for {self.package} already exists at {self.tmp_install_dir} - Skipping...")
             log.info(f"Use -A to force recreation.")
+            # XXX: Last use, for LRU eviction by diskgc.py.
+            os.utime(self.tmp_install_dir)
             return 0
         else:
+            self.manifest.begin('install', self.install_inputs())
+            key = self.materialize_install(False)
+            if key is not None:
+                self.manifest.finish('install', manifest.OK, build_from_source=False,
+                                     install_store=key)
+                return 0
             if os.path.exists(self.tmp_install_dir):
                 shutil.rmtree(self.tmp_install_dir)
             utils.create_dir(self.tmp_install_dir)
@@ -126,13 +552,15 @@ class JavascriptBridger():
                 'npm',
                 'install',
                 '--prefix', self.tmp_install_dir,
-                "{}@{}".format(self.name, self.version)
+            ] + self.npm_flags() + [
+                self.install_spec()
             ]
             log.info(cmd)
             try:
                 ret, out, err = utils.run_cmd(cmd)
             except Exception as e:
                 log.error(e)
+                self.manifest.finish('install', manifest.FAILED, ret=-1)
                 return -1
             if ret != 0:
                 log.error(f"cmd {cmd} returned non-zero exit code {ret}")
@@ -140,12 +568,77 @@ class JavascriptBridger():
                 log.info(err)
                 if os.path.exists(self.tmp_install_dir):
                     shutil.rmtree(self.tmp_install_dir)
+                self.manifest.finish('install', manifest.FAILED, ret=ret,
+                                     timeout=(ret == utils.RET_TIMEOUT))
                 return ret
+            self.store_install(False)
+            self.manifest.finish('install', manifest.OK, build_from_source=False)
             return 0
 
-    def find_bridges(self):
+    def run_gasket(self, modules=None, defer=False):
+        # XXX: gasket writes in place; have it write a new file and swap
+        #      it in, as BridgesFile.save() does.
+        tmp_path = utils.tmp_path(self.bridges_path)
+        cmd = [
+            'gasket',
+            '-r', self.pkg_inner_dir,
+            '-o', tmp_path
+        ]
+        if defer:
+            cmd.append('--defer-resolve')
+        if modules is not None:
+            for m in modules:
+                cmd += ['--module', m]
+        log.info(cmd)
+        try:
+            ret, out, err = utils.run_cmd(cmd)
+        except Exception as e:
+            log.error(e)
+            return -1
+        if ret != 0:
+            log.error(f"cmd {cmd} returned non-zero exit code {ret}")
+            log.warning(out)
+            log.warning(err)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return ret
+        log.info(out)
+        log.info(err)
+        if not os.path.exists(tmp_path):
+            log.error(f"gasket did not write {tmp_path}")
+            return -1
+        os.replace(tmp_path, self.bridges_path)
+        self.trace_bridges_stats()
+        return 0
+
+    def merge_cached_modules(self, cached, ran_gasket):
+        if ran_gasket:
+            with open(self.bridges_path, 'r') as infile:
+                model = objects.BridgesFile.from_json(infile.read())
+        else:
+            model = objects.BridgesFile()
+        for path, entry in cached.items():
+            bridges, failed = modcache.materialize(entry, self.pkg_inner_dir, path)
+            model.bridges.extend(bridges)
+            model.failed.extend(failed)
+            model.modules.append(os.path.abspath(path))
+            stats = entry.get('stats')
+            if stats is not None:
+                model.module_stats[os.path.abspath(path)] = stats
+                model.objects_examined += stats.get('objects_examined', 0)
+                model.callable_objects += stats.get('callable_objects', 0)
+                model.foreign_callable_objects += stats.get('foreign_callable_objects', 0)
+            for b in bridges:
+                if b.library not in model.jump_libs:
+                    model.jump_libs.append(b.library)
+        model.count = len(model.bridges)
+        model.save(self.bridges_path)
+
+    @pipeline.limited(pipeline.ANALYZE)
+    @tracing.traced('bridges')
+    def find_bridges(self, defer=False):
         log.info(f"Generating bridges for {self.package}")
-        if os.path.exists(self.bridges_path) and not self.always:
+        if self.bridges_fresh():
             log.info(f"Bridges for {self.package} already exist at {self.bridges_path} - Skipping...")
             log.info(f"Use -A to force recreation.")
             return 0
@@ -155,47 +648,199 @@ class JavascriptBridger():
             bridges_dir = self.bridges_dir
             if not os.path.exists(bridges_dir):
                 utils.create_dir(bridges_dir)
-            cmd = [
-                'gasket',
-                '-r', self.pkg_inner_dir,
-                '-o', self.bridges_path
-            ]
-            log.info(cmd)
-            try:
-                ret, out, err = utils.run_cmd(cmd)
-            except Exception as e:
-                log.error(e)
-                log.warn(out)
-                log.warn(err)
-                return -1
+            inputs = self.bridges_inputs()
+            cached = {}
+            if self.module_cache is not None:
+                for rel, digest in inputs['modules'].items():
+                    entry = self.module_cache.get(digest)
+                    if entry is not None:
+                        cached[os.path.join(self.pkg_inner_dir, rel)] = entry
+            modules = self.find_native_modules()
+            todo = [m for m in modules if m not in cached]
+            self.manifest.begin('bridges', inputs)
+            if cached:
+                log.info(f"Reusing bridges of {len(cached)}/{len(modules)} modules of {self.package}")
+            static = self.static_bridges(todo) if self.static else {}
+            todo = [m for m in todo if m not in static]
+            reused = dict(cached, **static)
+            ret = 0
+            if not reused:
+                ret = self.run_gasket(defer=defer)
+            elif todo:
+                ret = self.run_gasket(todo, defer=defer)
             if ret != 0:
-                log.error(f"cmd {cmd} returned non-zero exit code {ret}")
-                log.warn(out)
-                log.warn(err)
+                self.manifest.finish('bridges', manifest.FAILED, ret=ret,
+                                     timeout=(ret == utils.RET_TIMEOUT))
                 return ret
+            if defer and todo:
+                # XXX: Resolved in bulk later; see complete_bridges().
+                self.manifest.finish('bridges', manifest.PENDING,
+                                     cached=[os.path.relpath(m, self.pkg_inner_dir) for m in cached],
+                                     static={os.path.relpath(m, self.pkg_inner_dir): e
+                                             for m, e in static.items()})
+                return 0
+            if reused:
+                self.merge_cached_modules(reused, bool(todo))
+            self.manifest.finish('bridges', manifest.OK,
+                                 output=utils.sha256_file(self.bridges_path),
+                                 reused_modules=len(cached),
+                                 static_modules=[os.path.relpath(m, self.pkg_inner_dir)
+                                                 for m in static])
+
+        return 0
+
+    @tracing.traced('static')
+    def static_bridges(self, modules):
+        # XXX: Modules whose bridges can be read off the ELF alone; the
+        #      rest still go through gasket.
+        static = {}
+        for m in modules:
+            res = staticbridges.analyze(m, self.pkg_inner_dir)
+            if res.complete:
+                static[m] = res.entry
+            else:
+                log.info(f"No static bridges for {m}: {', '.join(res.reasons)}")
+        if static:
+            log.info(f"Extracted bridges of {len(static)}/{len(modules)} modules of {self.package} statically")
+        return static
+
+    def deferred_path(self):
+        rec = self.manifest.get('bridges')
+        if rec is None or rec['outcome'] != manifest.PENDING:
+            return None
+        return self.bridges_path
+
+    def complete_bridges(self):
+        # XXX: Second half of find_bridges(defer=True), once
+        #      resolve_syms.py --snapshot has filled bridges.json in.
+        rec = self.manifest.get('bridges')
+        if rec is None or rec['outcome'] != manifest.PENDING:
+            return 0
+        with open(self.bridges_path, 'r') as infile:
+            raw = json.loads(infile.read())
+        if 'deferred' in raw:
+            log.error(f"Deferred addresses of {self.package} were not resolved")
+            self.manifest.finish('bridges', manifest.FAILED, ret=-1)
+            return -1
+        cached = {}
+        for rel in rec.get('cached', []):
+            digest = rec['inputs']['modules'].get(rel)
+            entry = self.module_cache.get(digest) if self.module_cache is not None else None
+            if entry is None:
+                log.error(f"Cached bridges of {rel} disappeared")
+                self.manifest.finish('bridges', manifest.FAILED, ret=-1)
+                return -1
+            cached[os.path.join(self.pkg_inner_dir, rel)] = entry
+        static = {os.path.join(self.pkg_inner_dir, rel): e
+                  for rel, e in rec.get('static', {}).items()}
+        if cached or static:
+            self.merge_cached_modules(dict(cached, **static), True)
+        self.manifest.finish('bridges', manifest.OK,
+                             output=utils.sha256_file(self.bridges_path),
+                             reused_modules=len(cached), deferred=True,
+                             static_modules=list(rec.get('static', {})))
+        return 0
+
+    @pipeline.limited(pipeline.EXPORT)
+    def store_module_bridges(self):
+        # XXX: Only called once check_bridges() has accepted the result, so
+        #      stripped or failed analyses never enter the cache. Modules
+        #      without any bridge (e.g., ones that failed to load) are not
+        #      stored either.
+        if self.module_cache is None or not os.path.exists(self.bridges_path):
+            return
+        model = objects.load_bridges(self.bridges_path)
+        rec = self.manifest.get('bridges') or {}
+        # XXX: Only gasket's own results go into the cache.
+        static = set(rec.get('static_modules', []))
+        for rel, digest in self.module_hashes().items():
+            if rel in static or self.module_cache.get(digest) is not None:
+                continue
+            entry = modcache.extract(model, self.pkg_inner_dir,
+                                     os.path.join(self.pkg_inner_dir, rel))
+            if not entry['bridges']:
+                continue
+            entry['source'] = {'package': self.package, 'module': rel}
+            try:
+                self.module_cache.put(digest, entry)
+            except OSError as e:
+                log.warning(f"Could not store module bridges of {rel}: {e}")
+
+    def restore_build_from_cache(self, key):
+        # XXX: Lay the package out without running any install scripts,
+        #      then drop the previously compiled artifacts into place.
+        cmd = [
+            'npm',
+            'install',
+            '--ignore-scripts',
+            '--prefix', self.tmp_install_dir,
+        ] + self.npm_flags() + [
+            self.install_spec()
+        ]
+        log.info(cmd)
+        try:
+            ret, out, err = utils.run_cmd(cmd)
+        except Exception as e:
+            log.error(e)
+            return -1
+        if ret != 0:
+            log.error(f"cmd {cmd} returned non-zero exit code {ret}")
             log.info(out)
             log.info(err)
-
+            return ret
+        # XXX: The artifacts are copied over files of the install.
+        installstore.break_links(self.tmp_install_dir)
+        if not self.build_cache.restore(key, self.tmp_install_dir):
+            return -1
         return 0
 
+    @pipeline.limited(pipeline.BUILD)
+    @tracing.traced('build_from_source')
     def install_package_build_from_source(self):
         log.info(f"Installing (BUILD-FROM-SOURCE) {self.package}")
+        self.manifest.begin('install', self.install_inputs())
+        key = self.materialize_install(True)
+        if key is not None:
+            self.manifest.finish('install', manifest.OK, build_from_source=True,
+                                 install_store=key)
+            return 0
         # XXX: Remove old installation (prebuilt). Build from source!
         if os.path.exists(self.tmp_install_dir):
             shutil.rmtree(self.tmp_install_dir)
         utils.create_dir(self.tmp_install_dir)
+        key = None
+        if self.build_cache is not None:
+            key = self.build_cache.key(self.package)
+            if self.build_cache.has(key):
+                log.info(f"Build cache hit for {self.package}")
+                if self.restore_build_from_cache(key) == 0:
+                    self.store_install(True)
+                    self.manifest.finish('install', manifest.OK, build_from_source=True,
+                                         build_cache=key)
+                    return 0
+                log.warning(f"Could not restore cached build of {self.package}, building...")
+                shutil.rmtree(self.tmp_install_dir)
+                utils.create_dir(self.tmp_install_dir)
+        # XXX: Nothing the build runs may write through to the install
+        #      store, whatever is left in the install dir.
+        installstore.break_links(self.tmp_install_dir)
+        env = None
+        if self.ccache:
+            env = buildcache.ccache_env()
         cmd = [
             'npm',
             'install',
             '--build-from-source',
             '--prefix', self.tmp_install_dir,
-            "{}@{}".format(self.name, self.version)
+        ] + self.npm_flags() + [
+            self.install_spec()
         ]
         log.info(cmd)
         try:
-            ret, out, err = utils.run_cmd(cmd)
+            ret, out, err = utils.run_cmd(cmd, env=env)
         except Exception as e:
             log.error(e)
+            self.manifest.finish('install', manifest.FAILED, ret=-1, build_from_source=True)
             return -1
         if ret != 0:
             log.error(f"cmd {cmd} returned non-zero exit code {ret}")
@@ -203,33 +848,94 @@ class JavascriptBridger():
             log.info(err)
             if os.path.exists(self.tmp_install_dir):
                 shutil.rmtree(self.tmp_install_dir)
+            diagnosis = failures.classify_build(ret, out, err)
+            self.manifest.finish('install', manifest.FAILED, ret=ret, build_from_source=True,
+                                 timeout=(ret == utils.RET_TIMEOUT),
+                                 failure=diagnosis.klass, detail=diagnosis.detail)
             return ret
+        if key is not None:
+            try:
+                self.build_cache.save(key, self.tmp_install_dir)
+            except OSError as e:
+                log.warning(f"Could not cache build of {self.package}: {e}")
+        self.store_install(True)
+        self.manifest.finish('install', manifest.OK, build_from_source=True)
         return 0
 
+    def find_native_modules(self):
+        modules = []
+        for root, dirs, files in os.walk(self.pkg_inner_dir):
+            for f in files:
+                if f.endswith('.node'):
+                    modules.append(os.path.join(root, f))
+        return sorted(modules)
+
+    @tracing.traced('preflight')
+    def find_stripped_modules(self):
+        # XXX: Look for modules without a .symtab before the first gasket
+        #      run. Only modules that can be loaded here matter; prebuilds
+        #      for other platforms/architectures are ignored.
+        host_machine = elfsym.host_machine()
+        stripped = []
+        for path in self.find_native_modules():
+            try:
+                with elfsym.ElfFile(path) as elf:
+                    if elf.e_machine != host_machine:
+                        continue
+                    if not elf.has_symtab():
+                        stripped.append(path)
+            except (OSError, elfsym.ElfError) as e:
+                log.debug(f"Skipping {path}: {e}")
+        return stripped
+
+    def trace_bridges_stats(self):
+        # XXX: Fold gasket's own counters into the bridges span.
+        if not tracing.enabled() or not os.path.exists(self.bridges_path):
+            return
+        try:
+            model = objects.load_bridges(self.bridges_path)
+        except (ValueError, KeyError):
+            return
+        tracing.emit({
+            'package': self.package,
+            'stage': 'gasket_stats',
+            'parent': 'bridges',
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'start': time.time(),
+            'duration_sec': model.duration_sec,
+            'objects_examined': model.objects_examined,
+            'callable_objects': model.callable_objects,
+            'foreign_callable_objects': model.foreign_callable_objects,
+            'modules': len(model.modules),
+            'bridges': model.count,
+            'failed': len(model.failed),
+        })
+
+    @tracing.traced('check')
     def check_bridges(self):
         log.info(f"Checking bridges for {self.package}, ensuring not failed/stripped")
         self.stripped = False
         bridges_json_path = self.bridges_path
         if os.path.exists(bridges_json_path):
-            with open(bridges_json_path, 'r') as infile:
-                bridges_orig_raw = json.loads(infile.read())
-            bridges_orig = bridges_orig_raw['bridges']
-            modules_orig = bridges_orig_raw['modules']
+            model = objects.load_bridges(bridges_json_path)
+            bridges_orig = model.bridges
+            modules_orig = model.modules
 
             if (len(modules_orig) == 0) or (len(bridges_orig) == 0):
                 self.stripped = True
                 return -1
-            failed_orig = bridges_orig_raw['failed']
+            failed_orig = model.failed
 
             jsnames_ok = set()
 
             for b in bridges_orig:
                 # XXX: Add final comp
-                jsnames_ok.add(b['jsname'].split('.')[-1])
+                jsnames_ok.add(b.jsname.split('.')[-1])
 
-            for k,v in failed_orig.items():
-                kk = k.split('.')[-1]
-                if v == 'CFUNC_ADDRESS_RESOLUTION' and kk not in jsnames_ok:
+            for f in failed_orig:
+                kk = f.jsname.split('.')[-1]
+                if f.reason == 'CFUNC_ADDRESS_RESOLUTION' and kk not in jsnames_ok:
                     log.warning(f"jsname = {kk} not in bridges while having rebuilt")
                     self.stripped = True
                     return -1
@@ -238,32 +944,92 @@ class JavascriptBridger():
             # XXX: Gasket terminated unexpectedly. No bridges were generated.
             return -1
 
+    def failure_inputs(self):
+        return {
+            'spec': self.package,
+            'node': node_version(),
+            'tool': tool_version(),
+            'version': failures.VERSION,
+        }
+
+    def known_futile(self):
+        # XXX: A previous run found that building this package from source
+        #      cannot help. Returns that run's record, if still applicable.
+        if self.always or self.retry_futile:
+            return None
+        rec = self.manifest.get('failure')
+        if rec is None or rec['inputs'] != self.failure_inputs() or rec.get('rebuild', True):
+            return None
+        return rec
+
+    @tracing.traced('diagnose')
+    def diagnose(self, ret):
+        model = None
+        if ret == 0 and os.path.exists(self.bridges_path):
+            try:
+                model = objects.load_bridges(self.bridges_path)
+            except (ValueError, KeyError) as e:
+                log.warning(f"Could not read {self.bridges_path}: {e}")
+        diagnosis = failures.classify(ret, model, self.find_native_modules(),
+                                      self.find_stripped_modules())
+        log.warning(f"Bridges of {self.package} failed: {diagnosis}")
+        return diagnosis
+
+    def build_diagnosis(self):
+        rec = self.manifest.get('install') or {}
+        return failures.Diagnosis(rec.get('failure', failures.BUILD_ERROR), rec.get('detail', ''))
+
+    def should_rebuild(self, diagnosis):
+        if diagnosis.policy != failures.REBUILD:
+            log.warning(f"Not building {self.package} from source: {diagnosis.klass} failures"
+                        " do not go away with a rebuild")
+            return False
+        rec = self.known_futile()
+        if rec is not None:
+            log.warning(f"Not building {self.package} from source: a previous run failed with"
+                        f" {rec['failure']} ({rec.get('detail', '')}). Use --retry-futile to try anyway.")
+            return False
+        return True
+
+    def record_failure(self, diagnosis, rebuilt):
+        # XXX: What the next run needs to know to skip a futile rebuild.
+        #      Once a rebuild has been tried, another one cannot help.
+        if diagnosis.policy == failures.RETRY:
+            return
+        self.manifest.begin('failure', self.failure_inputs())
+        self.manifest.finish('failure', manifest.FAILED, failure=diagnosis.klass,
+                             detail=diagnosis.detail,
+                             rebuild=(diagnosis.policy == failures.REBUILD and not rebuilt))
+
+    def give_up(self, ret, diagnosis, rebuilt):
+        self.record_failure(diagnosis, rebuilt)
+        return ret
+
+    @pipeline.limited(pipeline.EXPORT)
+    @tracing.traced('csv')
     def generate_bridges_csv(self):
         log.info(f"Generating CSV bridges for {self.package}")
-        if os.path.exists(self.bridges_csv_path) and not self.always:
+        csv_inputs = self.csv_inputs()
+        rec = self.manifest.get('csv')
+        if (os.path.exists(self.bridges_csv_path) and not self.always
+                and (rec is None or self.manifest.is_fresh('csv', csv_inputs))):
             log.info(f"Bridges .txt for {self.package} already exist at {self.bridges_csv_path} - Skipping...")
             log.info(f"Use -A to force recreation.")
             return 0
         else:
+            self.manifest.begin('csv', csv_inputs)
             bridges_json_path = self.bridges_path
             bridges_new = set()
-            with open(bridges_json_path, 'r') as infile:
-                bridges_orig_raw = json.loads(infile.read())
-            bridges_orig = bridges_orig_raw['bridges']
-            for b in bridges_orig:
-                jsname = b['jsname']
-                cfunc = b['cfunc']
+            bridges_orig = objects.load_bridges(bridges_json_path).bridges
+            names = demangle.get_demangler().names([b.cfunc for b in bridges_orig])
+            for b, (full, new_cfunc) in zip(bridges_orig, names):
+                jsname = b.jsname
 
                 # XXX: Keep only basename.
                 new_jsname = jsname.split('.')[-1].split('/')[-1]
-                # XXX: Keep only "last" function name.
-                #      Trim namespaces ("::")
-                #      Trim arg types ("(int...)")
-                match = re.search(r"(?:\w+::)?(\w+)(?:\(|$)", cfunc)
-                if match:
-                    new_cfunc = match.group(1)
-                else:
+                if new_cfunc is None:
                     log.error(f"Couldn't exract new jsname/cfunc for bridge: {b}")
+                    self.manifest.finish('csv', manifest.FAILED, ret=-1)
                     return -1
 
                 bridges_new.add((new_jsname, new_cfunc))
@@ -274,76 +1040,511 @@ class JavascriptBridger():
                     c = bn[1]
                     outfile.write(f'({j},{c})\n')
                 outfile.flush()
+            self.manifest.finish('csv', manifest.OK)
             return 0
 
-    def process(self):
+    def rebuild_stripped(self):
+        # XXX: Returns (ret, rebuilt); rebuilt is None if no build from
+        #      source was attempted.
+        stripped_modules = self.find_stripped_modules()
+        if not stripped_modules:
+            return 0, None
+        if not self.should_rebuild(failures.Diagnosis(failures.STRIPPED)):
+            return 0, None
+        log.warning(f"Package {self.package} ships stripped modules {stripped_modules}."
+                    " Reinstalling from source...")
+        ret = self.install_package_build_from_source()
+        if ret == 0:
+            return 0, True
+        self.record_failure(self.build_diagnosis(), True)
+        log.warning(f"Build from source failed for {self.package}. Using prebuilt modules...")
+        return self.install_package(), False
+
+    @tracing.traced('analyze')
+    def analyze_deferred(self):
+        # XXX: First phase of --defer-resolve: install and run gasket, but
+        #      leave the final address resolution to resolve_syms.py.
+        log.info(f"Analyzing package: '{self.package}'")
+        if self.up_to_date():
+            log.info(f"Bridges .txt for {self.package} is up to date at {self.bridges_csv_path} - Skipping...")
+            return 0
+        if not self.triage():
+            log.warning(f"Package {self.package} has no native code - Skipping (--triage)...")
+            return 0
+        ret = self.install_package()
+        if ret != 0:
+            return ret
+        if not self.bridges_fresh():
+            ret, rebuilt = self.rebuild_stripped()
+            if ret != 0:
+                return ret
+        return self.find_bridges(defer=True)
+
+    def finish_deferred(self):
+        # XXX: Last phase of --defer-resolve. Install and bridges were
+        #      (re)done by analyze_deferred(); -A only applies to what is
+        #      left. Anything that went wrong falls back to the live path.
+        self.reuse_analysis = True
+        self.complete_bridges()
+        rec = self.manifest.get('install')
+        return self.process(tried_rebuild=rec is not None and rec.get('build_from_source', False))
+
+    @tracing.traced('package')
+    def process(self, tried_rebuild=False):
         log.info(f"Processing package: '{self.package}'")
-        if os.path.exists(self.bridges_csv_path) and not self.always:
-            log.info(f"Bridges .txt for {self.package} already exist at {self.bridges_csv_path} - Skipping...")
+        if self.up_to_date():
+            log.info(f"Bridges .txt for {self.package} is up to date at {self.bridges_csv_path} - Skipping...")
             log.info(f"Use -A to force recreation.")
             return 0
 
+        if not self.triage():
+            log.warning(f"Package {self.package} has no native code - Skipping (--triage)...")
+            return 0
+
         ret = self.install_package()
         if ret != 0:
             return ret
 
         rebuilt = False
+        # XXX: tried_rebuild is set once a build from source has been
+        #      attempted, whether it succeeded or not, so that we never
+        #      attempt it twice.
+
+        if not tried_rebuild and not self.bridges_fresh():
+            ret, rebuilt = self.rebuild_stripped()
+            if ret != 0:
+                return ret
+            tried_rebuild = tried_rebuild or rebuilt is not None
+            rebuilt = bool(rebuilt)
 
         ret = self.find_bridges()
         if ret != 0:
+            # XXX: Only rebuild if the failure class says it may help; e.g.,
+            #      a hung analysis would most likely hang again.
+            diagnosis = self.diagnose(ret)
+            if tried_rebuild or not self.should_rebuild(diagnosis):
+                return self.give_up(ret, diagnosis, tried_rebuild)
             log.warning(f"Bridge generation failed for {self.package}. Reinstalling from source...")
             # XXX: Remove old bridges.
             if os.path.exists(self.bridges_dir):
                 shutil.rmtree(self.bridges_dir)
+            tried_rebuild = True
             ret = self.install_package_build_from_source()
             if ret != 0:
-                return ret
+                return self.give_up(ret, self.build_diagnosis(), True)
             rebuilt = True
             ret = self.find_bridges()
             if ret != 0:
-                return ret
+                return self.give_up(ret, self.diagnose(ret), True)
 
+        diagnosis = None
         ret = self.check_bridges()
-        if ret < 0 and not rebuilt:
-            if self.stripped:
+        if ret < 0 and not tried_rebuild and self.stripped:
+            diagnosis = self.diagnose(0)
+            if self.should_rebuild(diagnosis):
+                diagnosis = None
                 log.warning(f"Package {self.package} is stripped. Reinstalling from source...")
                 # XXX: Remove old bridges.
                 if os.path.exists(self.bridges_dir):
                     shutil.rmtree(self.bridges_dir)
+                tried_rebuild = True
                 ret = self.install_package_build_from_source()
                 if ret != 0:
-                    return ret
+                    return self.give_up(ret, self.build_diagnosis(), True)
+                rebuilt = True
                 ret = self.find_bridges()
                 if ret != 0:
-                    return ret
+                    return self.give_up(ret, self.diagnose(ret), True)
 
         ret = self.check_bridges()
         if ret != 0:
-            return ret
+            return self.give_up(ret, diagnosis or self.diagnose(0), tried_rebuild)
+
+        if self.lease_check is not None and not self.lease_check():
+            log.error(f"Lost the queue lease of {self.package}, not writing its outputs")
+            return -1
+
+        self.store_module_bridges()
 
         ret = self.generate_bridges_csv()
         if ret != 0:
             return ret
 
+        self.manifest.invalidate('failure')
         return ret
 
-def do_single(p, output, always):
-    log.info(f"Processing package '{p}'")
-    bridger = JavascriptBridger(p, output, always)
-    bridger.process()
+# XXX: --defer-resolve splits process() into analyze and finish phases,
+#      with bulk symbol resolution in between.
+PHASES = {
+    'all': 'process',
+    'analyze': 'analyze_deferred',
+    'finish': 'finish_deferred',
+}
+
+def package_log_path(log_dir, package):
+    sanitized = utils.sanitize_package_name(package)
+    return os.path.join(log_dir, sanitized.replace(':', '___') + '.log')
+
+def use_triage(args):
+    return args.triage and not args.no_triage
+
+def make_tarball_store(args):
+    if args.no_tarball_cache or not (args.tarball_cache or args.offline or use_triage(args)):
+        return None
+    return tarballs.TarballStore(offline=args.offline)
+
+def make_build_cache(args):
+    if args.no_build_cache:
+        return None
+    return buildcache.BuildCache()
+
+def make_install_store(args):
+    if args.no_install_store:
+        return None
+    return installstore.InstallStore()
+
+def make_module_cache(args):
+    if args.no_module_cache:
+        return None
+    return modcache.ModuleCache(tool_version(), node_abi())
+
+def do_single(p, args, log_dir=None, phase='all', lease_check=None):
+    handler = None
+    output_log = None
+    if log_dir is not None:
+        utils.create_dir(log_dir)
+        root = logging.getLogger()
+        handler = logging.FileHandler(package_log_path(log_dir, p),
+                                      mode='a' if phase == 'finish' else 'w')
+        handler.addFilter(pipeline.thread_filter())
+        if root.handlers:
+            handler.setFormatter(root.handlers[0].formatter)
+        root.addHandler(handler)
+        # XXX: Full output of the package's commands; the log itself only
+        #      gets the tails.
+        output_log = utils.OutputLog(os.path.splitext(package_log_path(log_dir, p))[0] + '.out')
+    utils.set_cmd_limits(timeout=args.timeout or None,
+                         idle_timeout=args.idle_timeout or None,
+                         output_log=output_log)
+    tracing.set_package(p)
+    try:
+        log.info(f"Processing package '{p}'")
+        bridger = JavascriptBridger(p, args.output, args.always,
+                                    tarball_store=make_tarball_store(args),
+                                    build_cache=make_build_cache(args),
+                                    ccache=args.ccache,
+                                    module_cache=make_module_cache(args),
+                                    use_triage=use_triage(args),
+                                    install_store=make_install_store(args),
+                                    static=args.static,
+                                    retry_futile=args.retry_futile)
+        bridger.lease_check = lease_check
+        try:
+            ret = getattr(bridger, PHASES[phase])()
+            if ret == 0 and phase != 'analyze' and args.store is not None:
+                with pipeline.slot(pipeline.EXPORT):
+                    ingest_bridges(bridger, args.store)
+        except Exception as e:
+            log.exception(e)
+            ret = -1
+    finally:
+        utils.set_cmd_limits()
+        if output_log is not None:
+            output_log.close()
+        if handler is not None:
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+    return ret
+
+def ingest_bridges(bridger, store_path):
+    if not os.path.exists(bridger.bridges_path):
+        return
+    store = bridgestore.BridgeStore(store_path or None)
+    try:
+        n = store.ingest(bridger.name, bridger.version, bridger.bridges_path)
+        log.info(f"Ingested {n} bridges of {bridger.package} into {store.path}")
+    finally:
+        store.close()
+
+def do_group(group, args, log_dir=None, phase='all', lease_check=None):
+    results = []
+    for p in group:
+        if lease_check is not None and not lease_check():
+            log.error(f"Lost the queue lease of {p}, skipping the rest of its group")
+            results.append((p, -1))
+            continue
+        results.append((p, do_single(p, args, log_dir, phase, lease_check)))
+    return results
+
+def do_prefetch(p, args):
+    name, version = utils.pkg_name_to_tuple(p)
+    store = tarballs.TarballStore()
+    return p, store.prefetch(name, version)
+
+def group_packages(package_names):
+    # XXX: All versions of a package share one bridges .txt file
+    #      (data/gasket_bridges/<name>.txt), so they must be processed
+    #      in input order by the same worker to match a sequential run.
+    groups = {}
+    seen = set()
+    for pkg in package_names:
+        if pkg in seen:
+            continue
+        seen.add(pkg)
+        sname = utils.sanitize_package_name(pkg).split(':')[0]
+        groups.setdefault(sname, []).append(pkg)
+    return list(groups.values())
+
+def schedule_groups(package_names, args):
+    groups = group_packages(package_names)
+    if args.schedule == scheduler.CSV:
+        return groups
+    model = scheduler.CostModel(args.output, tarballs.TarballStore())
+    return scheduler.schedule(groups, args.schedule, model)
+
+def init_worker(level, trace_path):
+    # XXX: Forked workers inherit the parent's handlers; only make sure
+    #      the level survives the 'spawn' start method as well.
+    logging.getLogger().setLevel(level)
+    tracing.configure(trace_path)
+
+def run_parallel(package_names, args, log_dir, phase='all'):
+    groups = schedule_groups(package_names, args)
+    results = {}
+    log.info(f"Processing {len(package_names)} packages in {len(groups)} groups with {args.jobs} workers")
+    with ProcessPoolExecutor(max_workers=args.jobs,
+                             initializer=init_worker,
+                             initargs=(logging.getLogger().level, args.trace)) as executor:
+        futures = [executor.submit(do_group, g, args, log_dir, phase)
+                   for g in groups]
+        try:
+            for i, fut in enumerate(futures):
+                for p, ret in fut.result():
+                    results[p] = ret
+                    log.info(f"Finished '{p}' (ret = {ret})")
+                if args.disk_budget_gc is not None:
+                    args.disk_budget_gc.maybe_collect(
+                        exclude=[p for g in groups[i + 1:] for p in g])
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    return results
+
+def run_pipeline(package_names, args, log_dir, phase='all'):
+    # XXX: One thread per package group in flight, all in this process.
+    #      The stages of a package still run in order; what overlaps are
+    #      the stages of different packages, each limited on its own (see
+    #      pipeline.py). Only analyze_jobs + install_ahead groups are in
+    #      flight, so installs cannot run far ahead of the analyzers.
+    #      Anything that writes shared files must use temp names that are
+    #      unique per call (utils.tmp_path()), not per process.
+    groups = schedule_groups(package_names, args)
+    window = args.analyze_jobs + args.install_ahead
+    pipeline.configure({
+        pipeline.INSTALL: args.install_jobs,
+        pipeline.ANALYZE: args.analyze_jobs,
+        pipeline.BUILD: args.build_jobs,
+        pipeline.EXPORT: pipeline.DEFAULT_EXPORT_JOBS,
+    })
+    results = {}
+    log.info(f"Processing {len(package_names)} packages in {len(groups)} groups as a pipeline:"
+             f" {args.install_jobs} installs, {args.analyze_jobs} analyzers, {args.build_jobs} builds,"
+             f" {window} packages in flight")
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        futures = {executor.submit(do_group, g, args, log_dir, phase): g for g in groups}
+        unfinished = set(futures)
+        try:
+            for fut in as_completed(futures):
+                unfinished.discard(fut)
+                for p, ret in fut.result():
+                    results[p] = ret
+                    log.info(f"Finished '{p}' (ret = {ret})")
+                if args.disk_budget_gc is not None:
+                    args.disk_budget_gc.maybe_collect(
+                        exclude=[p for f in unfinished for p in futures[f]])
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            pipeline.configure({})
+    return results
+
+def run_queue(queue, args, log_dir):
+    # XXX: Heartbeats come from this process while the workers run, so a
+    #      single long package never makes its lease look expired.
+    interval = max(1, args.lease_ttl // 5)
+    results = {}
+    running = {}
+    log.info(f"Claiming packages from {queue.root} as {queue.owner} with {args.jobs} workers")
+    with ProcessPoolExecutor(max_workers=args.jobs,
+                             initializer=init_worker,
+                             initargs=(logging.getLogger().level, args.trace)) as executor:
+        try:
+            while True:
+                while len(running) < args.jobs:
+                    task = queue.claim()
+                    if task is None:
+                        break
+                    log.info(f"Claimed {task.packages} (attempt {task.attempts})")
+                    lease_check = functools.partial(workqueue.holds_lease, queue.root, task.key, task.lease)
+                    running[executor.submit(do_group, task.packages, args, log_dir, 'all',
+                                            lease_check)] = task
+                if not running:
+                    if queue.unfinished() == 0:
+                        break
+                    # XXX: Others hold the rest; wait in case they crash.
+                    time.sleep(interval)
+                    continue
+                done, _ = wait(running, timeout=interval, return_when=FIRST_COMPLETED)
+                lost = set(queue.heartbeat())
+                for fut, task in list(running.items()):
+                    if task.key in lost and fut not in done:
+                        # XXX: The worker checks the lease itself before
+                        #      writing outputs; drop it if not started yet.
+                        log.error(f"Lost the lease of {task.packages}, abandoning them")
+                        if fut.cancel():
+                            running.pop(fut)
+                for fut in done:
+                    task = running.pop(fut)
+                    if task.key in lost or task.key not in queue.held:
+                        log.warning(f"Ignoring results of {task.packages}, their lease was lost")
+                        continue
+                    try:
+                        group_results = dict(fut.result())
+                    except Exception as e:
+                        log.exception(e)
+                        group_results = {p: -1 for p in task.packages}
+                    for p, ret in group_results.items():
+                        log.info(f"Finished '{p}' (ret = {ret})")
+                    results.update(group_results)
+                    queue.complete(task, group_results)
+                if args.disk_budget_gc is not None:
+                    args.disk_budget_gc.maybe_collect(
+                        exclude=[p for t in running.values() for p in t.packages])
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    return results
+
+def run_phase(package_names, args, log_dir, phase='all'):
+    if args.pipeline:
+        return run_pipeline(package_names, args, log_dir, phase)
+    if args.jobs == 1:
+        results = {}
+        if args.schedule != scheduler.CSV:
+            package_names = [p for g in schedule_groups(package_names, args) for p in g]
+        for pkg in package_names:
+            results[pkg] = do_single(pkg, args, log_dir, phase)
+            if args.disk_budget_gc is not None:
+                args.disk_budget_gc.maybe_collect()
+        return results
+    return run_parallel(package_names, args, log_dir, phase)
+
+def resolve_deferred(package_names, args):
+    paths = []
+    for p in package_names:
+        path = JavascriptBridger(p, args.output, args.always).deferred_path()
+        if path is not None:
+            paths.append(path)
+    if not paths:
+        return
+    jobs = args.resolve_jobs or args.jobs
+    log.info(f"Resolving deferred addresses of {len(paths)} packages with {jobs} workers")
+    with tracing.span('resolve_deferred', packages=len(paths), jobs=jobs):
+        results = resolve_syms.resolve_snapshots(paths, jobs, symcache.default_cache_path())
+    failed = [p for p, ret in results.items() if ret != 0]
+    if failed:
+        log.warning(f"Deferred resolution failed for {len(failed)} packages; they will be redone live")
 
 def main():
     args = parse_args()
-    setup_logging(args)
+    utils.setup_logging(args)
 
-    if args.input is None:
+    if args.input is None and args.queue is None:
         log.error("Must provide input CSV file")
         sys.exit(1)
 
-    package_names = utils.load_csv(args.input)
+    if args.jobs < 1:
+        log.error("--jobs must be at least 1")
+        sys.exit(1)
 
-    for pkg in package_names:
-        do_single(pkg, args.output, args.always)
+    if args.queue is not None and (args.prefetch or args.defer_resolve):
+        log.error("--queue cannot be combined with --prefetch or --defer-resolve")
+        sys.exit(1)
+
+    if args.pipeline and args.queue is not None:
+        log.error("--pipeline cannot be combined with --queue")
+        sys.exit(1)
+
+    if args.analyze_jobs is None:
+        args.analyze_jobs = args.jobs
+    if args.build_jobs is None:
+        args.build_jobs = max(1, args.jobs // 2)
+    if args.install_ahead is None:
+        args.install_ahead = args.install_jobs
+    if min(args.install_jobs, args.analyze_jobs, args.build_jobs) < 1 or args.install_ahead < 0:
+        log.error("Stage limits must be at least 1")
+        sys.exit(1)
+
+    package_names = utils.load_csv(args.input) if args.input is not None else []
+
+    args.disk_budget_gc = None
+    if args.disk_budget is not None:
+        args.disk_budget_gc = diskgc.DiskBudget(args.disk_budget, output_dir=args.output,
+                                                policy=args.gc_policy)
+
+    if args.chrome_trace is not None and args.trace is None:
+        args.trace = os.path.splitext(args.chrome_trace)[0] + '.jsonl'
+    tracing.configure(args.trace)
+
+    log_dir = args.log_dir
+    if log_dir is None and (args.jobs > 1 or args.pipeline):
+        log_dir = os.path.join(GASKET_ROOT, 'data/logs')
+
+    if args.prefetch:
+        if args.offline:
+            log.error("--prefetch and --offline are mutually exclusive")
+            sys.exit(1)
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = dict(executor.map(do_prefetch, package_names,
+                                        [args] * len(package_names)))
+        failed = [p for p, ret in results.items() if ret != 0]
+        log.info(f"Prefetched {len(results)} packages, {len(failed)} failed")
+        return
+
+    if args.queue is not None:
+        queue = workqueue.WorkQueue(args.queue, lease_ttl=args.lease_ttl,
+                                    max_attempts=args.max_attempts)
+        if package_names:
+            n = queue.enqueue(schedule_groups(package_names, args))
+            log.info(f"Added {n} tasks to {args.queue}")
+        if log_dir is None:
+            log_dir = os.path.join(GASKET_ROOT, 'data/logs')
+        results = run_queue(queue, args, log_dir)
+        log.info(f"Queue status: {queue.summary()}")
+    elif args.defer_resolve:
+        results = run_phase(package_names, args, log_dir, 'analyze')
+        analyzed = [p for p in package_names if results.get(p) == 0]
+        resolve_deferred(analyzed, args)
+        failed = [p for p in package_names if p in results and results[p] != 0]
+        if failed:
+            log.warning(f"Analysis failed for {len(failed)} packages; they will be redone live")
+        # XXX: Packages whose analysis failed go through the live path as
+        #      well (diagnosis, rebuild from source, live resolution).
+        results.update(run_phase([p for p in package_names if p in results], args, log_dir, 'finish'))
+    else:
+        results = run_phase(package_names, args, log_dir)
+
+    failed = [p for p, ret in results.items() if ret != 0]
+    timed_out = [p for p, ret in results.items() if ret == utils.RET_TIMEOUT]
+    log.info(f"Processed {len(results)} packages, {len(failed)} failed"
+             f" ({len(timed_out)} timed out)")
+    for p in timed_out:
+        log.warning(f"Timed out: {p}")
+
+    if args.chrome_trace is not None:
+        tracing.write_chrome(tracing.load(args.trace), args.chrome_trace)
+        log.info(f"Wrote Chrome trace to {args.chrome_trace}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+import os
+import json
+import stat
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+
+import utils
+
+log = logging.getLogger(__name__)
+
+GASKET_ROOT = os.getenv("GASKET_ROOT")
+
+# XXX: Executable files get their own objects, since the mode lives in
+#      the inode that all links share.
+EXEC_SUFFIX = '-x'
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        # XXX: Store on another filesystem, or too many links to one inode.
+        if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+            raise
+        shutil.copy2(src, dst)
+
+
+def break_links(install_dir):
+    # XXX: Give every file of install_dir that is linked elsewhere (into
+    #      the store, so into every other install) a private copy. Objects
+    #      are read-only, but that does not stop root, and anything that
+    #      builds in install_dir may rewrite files in place.
+    count = 0
+    for root, dirs, files in os.walk(install_dir):
+        for f in files:
+            path = os.path.join(root, f)
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode) or st.st_nlink == 1:
+                continue
+            tmp = utils.tmp_path(path)
+            shutil.copyfile(path, tmp)
+            os.chmod(tmp, stat.S_IMODE(st.st_mode) | stat.S_IWUSR)
+            os.replace(tmp, path)
+            count += 1
+    if count:
+        log.info(f"Broke {count} links into the install store under {install_dir}")
+    return count
+
+
+class InstallStore():
+    # XXX: pnpm-style store for install trees:
+    #
+    #        files/<sha[:2]>/<sha>[-x]   file contents, read-only
+    #        trees/<key[:2]>/<key>.json  layout of one install
+    #
+    #      Every install under data/install is made of hardlinks into
+    #      files/, so a dependency shared by thousands of packages is on
+    #      disk once. Trees are keyed by the install's inputs, and an
+    #      install seen before is laid out again without running npm.
+    def __init__(self, root=None):
+        if root is None:
+            root = os.path.join(GASKET_ROOT, 'data/store')
+        self.root = root
+        self.files_root = os.path.join(root, 'files')
+        self.trees_root = os.path.join(root, 'trees')
+        utils.create_dir(self.files_root)
+        utils.create_dir(self.trees_root)
+
+    def key(self, inputs):
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def _object(self, name):
+        return os.path.join(self.files_root, name[:2], name)
+
+    def _tree(self, key):
+        return os.path.join(self.trees_root, key[:2], key + '.json')
+
+    def has(self, key):
+        return os.path.exists(self._tree(key))
+
+    def _add_file(self, path, mode):
+        name = utils.sha256_file(path)
+        if mode & stat.S_IXUSR:
+            name += EXEC_SUFFIX
+        obj = self._object(name)
+        # XXX: diskgc.py prunes objects nothing links to, unless they were
+        #      touched within its grace period. Touch the object before
+        #      linking to it, and start over if it was pruned in between.
+        for attempt in range(2):
+            if not self._touch(obj):
+                utils.create_dir(os.path.dirname(obj))
+                tmp = utils.tmp_path(obj)
+                shutil.copyfile(path, tmp)
+                os.chmod(tmp, 0o555 if name.endswith(EXEC_SUFFIX) else 0o444)
+                try:
+                    os.link(tmp, obj)
+                except FileExistsError:
+                    # XXX: Another ingest stored the same contents first.
+                    pass
+                finally:
+                    os.remove(tmp)
+            # XXX: Swap the file for a link to the object in place.
+            tmp = utils.tmp_path(path)
+            try:
+                if os.path.samefile(obj, path):
+                    break
+                link_or_copy(obj, tmp)
+            except FileNotFoundError:
+                if attempt:
+                    raise
+                continue
+            os.replace(tmp, path)
+            break
+        return name
+
+    def _touch(self, obj):
+        try:
+            os.utime(obj)
+        except FileNotFoundError:
+            return False
+        except PermissionError:
+            # XXX: Someone else's object; if it is pruned before we link
+            #      to it, we start over.
+            return os.path.exists(obj)
+        return True
+
+    def ingest(self, key, install_dir):
+        files = {}
+        symlinks = {}
+        dirs = []
+        for root, dnames, fnames in os.walk(install_dir):
+            for d in list(dnames):
+                path = os.path.join(root, d)
+                rel = os.path.relpath(path, install_dir)
+                if os.path.islink(path):
+                    # XXX: os.walk() does not descend into these.
+                    symlinks[rel] = os.readlink(path)
+                    dnames.remove(d)
+                else:
+                    dirs.append(rel)
+            for f in fnames:
+                path = os.path.join(root, f)
+                rel = os.path.relpath(path, install_dir)
+                st = os.lstat(path)
+                if stat.S_ISLNK(st.st_mode):
+                    symlinks[rel] = os.readlink(path)
+                elif stat.S_ISREG(st.st_mode):
+                    files[rel] = self._add_file(path, st.st_mode)
+        tree = {'dirs': dirs, 'files': files, 'symlinks': symlinks}
+        path = self._tree(key)
+        utils.create_dir(os.path.dirname(path))
+        tmp_path = utils.tmp_path(path)
+        with open(tmp_path, 'w') as outfile:
+            outfile.write(json.dumps(tree))
+        os.replace(tmp_path, path)
+        log.info(f"Stored install tree {key} ({len(files)} files) from {install_dir}")
+        return True
+
+    def materialize(self, key, install_dir):
+        # XXX: install_dir must not exist. Returns False, leaving nothing
+        #      behind, if any object has been pruned from the store.
+        try:
+            with open(self._tree(key), 'r') as infile:
+                tree = json.loads(infile.read())
+        except (FileNotFoundError, ValueError):
+            return False
+        parent = os.path.dirname(install_dir)
+        utils.create_dir(parent)
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.materialize-')
+        try:
+            for rel in tree['dirs']:
+                os.makedirs(os.path.join(tmp, rel), exist_ok=True)
+            for rel, name in tree['files'].items():
+                dst = os.path.join(tmp, rel)
+                utils.create_dir(os.path.dirname(dst))
+                link_or_copy(self._object(name), dst)
+            for rel, target in tree['symlinks'].items():
+                dst = os.path.join(tmp, rel)
+                utils.create_dir(os.path.dirname(dst))
+                os.symlink(target, dst)
+            os.rename(tmp, install_dir)
+        except FileNotFoundError as e:
+            log.warning(f"Install tree {key} is incomplete, dropping it: {e}")
+            shutil.rmtree(tmp, ignore_errors=True)
+            self.drop(key)
+            return False
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        log.info(f"Materialized {len(tree['files'])} files of install tree {key} at {install_dir}")
+        return True
+
+    def drop(self, key):
+        try:
+            os.remove(self._tree(key))
+        except FileNotFoundError:
+            pass
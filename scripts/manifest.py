@@ -0,0 +1,85 @@
+import os
+import json
+import time
+import logging
+
+import utils
+
+log = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+OK = 'ok'
+FAILED = 'failed'
+RUNNING = 'running'
+# XXX: Work left to another process (e.g., deferred symbol resolution).
+PENDING = 'pending'
+
+
+def manifest_path(manifests_root, package):
+    return os.path.join(manifests_root, utils.namesnip(package) + '.json')
+
+
+class Manifest():
+    # XXX: Per-package record of every stage's inputs and outcome. A stage
+    #      is fresh only if it finished OK with the exact same inputs; a
+    #      stage left RUNNING by a crash is always stale.
+    def __init__(self, path):
+        self.path = path
+        self.data = {'version': MANIFEST_VERSION, 'stages': {}}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as infile:
+                    data = json.loads(infile.read())
+                if data.get('version') == MANIFEST_VERSION:
+                    self.data = data
+                else:
+                    log.info(f"Manifest {path} has an old format, ignoring it")
+            except ValueError as e:
+                log.warning(f"Manifest {path} is corrupt, ignoring it: {e}")
+
+    @property
+    def stages(self):
+        return self.data['stages']
+
+    def get(self, stage):
+        return self.stages.get(stage)
+
+    def save(self):
+        utils.create_dir(os.path.dirname(self.path))
+        tmp_path = utils.tmp_path(self.path)
+        with open(tmp_path, 'w') as outfile:
+            outfile.write(json.dumps(self.data, indent=2))
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, self.path)
+
+    def is_fresh(self, stage, inputs):
+        rec = self.get(stage)
+        if rec is None:
+            return False
+        return rec['outcome'] == OK and rec['inputs'] == inputs
+
+    def begin(self, stage, inputs):
+        self.stages[stage] = {
+            'inputs': inputs,
+            'outcome': RUNNING,
+            'started_at': time.time(),
+        }
+        self.save()
+
+    def finish(self, stage, outcome, **extra):
+        rec = self.stages[stage]
+        rec['outcome'] = outcome
+        rec['finished_at'] = time.time()
+        rec['duration_sec'] = round(rec['finished_at'] - rec['started_at'], 3)
+        rec.update(extra)
+        self.save()
+
+    def invalidate(self, *stages):
+        changed = False
+        for stage in stages:
+            if self.stages.pop(stage, None) is not None:
+                changed = True
+        if changed:
+            self.save()
@@ -0,0 +1,141 @@
+import os
+import json
+import logging
+
+import utils
+import objects
+
+log = logging.getLogger(__name__)
+
+GASKET_ROOT = os.getenv("GASKET_ROOT")
+
+# XXX: Bump whenever the format of entries changes, so that entries
+#      written by an older version are not used.
+VERSION = 2
+
+# XXX: Stand-ins for the package root and for the node_modules directory
+#      of its install (where sibling dependencies live) in stored library
+#      paths.
+PKG_ROOT_VAR = '$PKG_ROOT'
+NODE_MODULES_VAR = '$NODE_MODULES'
+
+
+def module_prefix(pkg_root, module_path):
+    # XXX: Mirrors get_mod_fqn() in bin/gasket.js.
+    rel = os.path.relpath(module_path, pkg_root)
+    return os.path.basename(pkg_root) + '/' + os.path.splitext(rel)[0]
+
+
+def strip_prefix(jsname, prefix):
+    if jsname == prefix or jsname.startswith(prefix + '.'):
+        return jsname[len(prefix):]
+    return None
+
+
+def pkg_roots(pkg_root):
+    roots = [os.path.abspath(pkg_root)]
+    real = os.path.realpath(pkg_root)
+    if real not in roots:
+        roots.append(real)
+    return roots
+
+
+def modules_root(pkg_root):
+    # XXX: The outermost node_modules above pkg_root, or None.
+    i = pkg_root.find('/node_modules/')
+    if i < 0:
+        return None
+    return pkg_root[:i + len('/node_modules')]
+
+
+def normalize_library(library, pkg_root):
+    roots = pkg_roots(pkg_root)
+    for root in roots:
+        if library.startswith(root + '/'):
+            return PKG_ROOT_VAR + library[len(root):]
+    for root in roots:
+        modules = modules_root(root)
+        if modules is not None and library.startswith(modules + '/'):
+            return NODE_MODULES_VAR + library[len(modules):]
+    return library
+
+
+def expand_library(library, pkg_root):
+    root = os.path.abspath(pkg_root)
+    if library.startswith(PKG_ROOT_VAR + '/'):
+        return root + library[len(PKG_ROOT_VAR):]
+    modules = modules_root(root)
+    if modules is not None and library.startswith(NODE_MODULES_VAR + '/'):
+        return modules + library[len(NODE_MODULES_VAR):]
+    return library
+
+
+def extract(model, pkg_root, module_path):
+    # XXX: Cut the bridges of one module out of a gasket result, with
+    #      package-specific parts of jsnames and libraries made relative.
+    prefix = module_prefix(pkg_root, module_path)
+    bridges = []
+    for b in model.bridges:
+        suffix = strip_prefix(b.jsname, prefix)
+        if suffix is None:
+            continue
+        bridges.append({
+            'jsname': suffix,
+            'cfunc': b.cfunc,
+            'library': normalize_library(b.library, pkg_root),
+        })
+    failed = {}
+    for f in model.failed:
+        suffix = strip_prefix(f.jsname, prefix)
+        if suffix is not None:
+            failed[suffix] = f.reason
+    return {
+        'bridges': bridges,
+        'failed': failed,
+        'stats': model.module_stats.get(os.path.abspath(module_path)),
+    }
+
+
+def materialize(entry, pkg_root, module_path):
+    prefix = module_prefix(pkg_root, module_path)
+    bridges = []
+    for b in entry['bridges']:
+        library = expand_library(b['library'], pkg_root)
+        bridges.append(objects.Bridge(prefix + b['jsname'], b['cfunc'], library))
+    failed = [objects.Failure(prefix + k, v) for k, v in entry['failed'].items()]
+    return bridges, failed
+
+
+class ModuleCache():
+    # XXX: Per-module gasket results addressed by the .node file's sha256.
+    #      Entries are scoped by tool version, since a different gasket may
+    #      extract different bridges from the same binary, and by node ABI
+    #      (process.versions.modules), since whether and how the binary
+    #      loads depends on the node that gasket runs under.
+    def __init__(self, tool_version, node_abi, root=None):
+        if root is None:
+            root = os.path.join(GASKET_ROOT, 'data/modcache')
+        self.root = os.path.join(root, f"v{VERSION}-{tool_version}-abi{node_abi}")
+        utils.create_dir(self.root)
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + '.json')
+
+    def get(self, digest):
+        path = self._path(digest)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as infile:
+                return json.loads(infile.read())
+        except ValueError as e:
+            log.warning(f"Module cache entry {path} is corrupt, ignoring it: {e}")
+            return None
+
+    def put(self, digest, entry):
+        path = self._path(digest)
+        utils.create_dir(os.path.dirname(path))
+        tmp_path = utils.tmp_path(path)
+        with open(tmp_path, 'w') as outfile:
+            outfile.write(json.dumps(entry))
+        os.replace(tmp_path, path)
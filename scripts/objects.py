@@ -1,6 +1,14 @@
 import os
+import sys
+import json
+import uuid
+import functools
 
 class Base():
+    # XXX: Records are slotted; subclasses list their fields in __slots__,
+    #      in constructor order.
+    __slots__ = ()
+
     # @classmethod
     # def from_dict(cls, dict_repr):
     #     return cls(**dict_repr)
@@ -18,30 +26,54 @@ class Base():
         # Create and return an instance of the correct class
         return target_class(**dict_repr)
 
+    def astuple(self):
+        return tuple(getattr(self, s) for s in self.__slots__)
+
     def to_dict(self):
-        return self.__dict__
+        return {s: getattr(self, s) for s in self.__slots__}
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            return vars(self) == vars(other)
+            return self.astuple() == other.astuple()
         return False
 
+    def __hash__(self):
+        return hash(self.astuple())
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}{self.astuple()!r}"
+
+def intern(s):
+    # XXX: The same library paths and C names recur across thousands of
+    #      records; share one string object for each.
+    return sys.intern(s) if isinstance(s, str) else s
+
+def parse_address(address):
+    if isinstance(address, int):
+        return address
+    # XXX: Accepts both decimal (as sent by gasket) and 0x-prefixed hex.
+    return int(address, 0)
+
 class PyCHop(Base):
+    __slots__ = ('pyname', 'address', 'cfunc', 'section', 'library')
+
     def __init__(self, pyname, address, cfunc, section, library):
         self.pyname = pyname
-        self.address = int(address)
-        self.cfunc = cfunc
-        self.section = section
-        self.library = library
+        self.address = parse_address(address)
+        self.cfunc = intern(cfunc)
+        self.section = intern(section)
+        self.library = intern(library)
 
     def to_dict(self):
         return {"pyname": self.pyname, "cfunc": self.cfunc, "library": self.library}
 
 class PyCBridge(Base):
+    __slots__ = ('pyname', 'cfunc', 'library')
+
     def __init__(self, pyname, cfunc, library):
         self.pyname = pyname
-        self.cfunc = cfunc
-        self.library = library
+        self.cfunc = intern(cfunc)
+        self.library = intern(library)
 
     def to_dict(self):
         return {
@@ -49,3 +81,106 @@ class PyCBridge(Base):
                 "library": self.library
                 }
 
+class Bridge(Base):
+    # XXX: One entry of the "bridges" list in a gasket bridges.json.
+    __slots__ = ('jsname', 'cfunc', 'library')
+
+    def __init__(self, jsname, cfunc, library):
+        self.jsname = jsname
+        self.cfunc = intern(cfunc)
+        self.library = intern(library)
+
+class Failure(Base):
+    # XXX: One entry of the "failed" map in a gasket bridges.json.
+    __slots__ = ('jsname', 'reason')
+
+    def __init__(self, jsname, reason):
+        self.jsname = jsname
+        self.reason = intern(reason)
+
+BRIDGE_KEYS = frozenset(Bridge.__slots__)
+
+def _bridge_hook(d):
+    # XXX: Convert each bridge as soon as the decoder has built it, so the
+    #      dicts for the whole list never exist at the same time.
+    if len(d) == 3 and d.keys() == BRIDGE_KEYS:
+        return Bridge(d['jsname'], d['cfunc'], d['library'])
+    return d
+
+class BridgesFile(Base):
+    __slots__ = ('objects_examined', 'callable_objects', 'foreign_callable_objects',
+                 'duration_sec', 'count', 'modules', 'jump_libs', 'bridges',
+                 'failed', 'module_stats')
+
+    def __init__(self, objects_examined=0, callable_objects=0, foreign_callable_objects=0,
+                 duration_sec=0, count=0, modules=None, jump_libs=None, bridges=None,
+                 failed=None, module_stats=None):
+        self.objects_examined = objects_examined
+        self.callable_objects = callable_objects
+        self.foreign_callable_objects = foreign_callable_objects
+        self.duration_sec = duration_sec
+        self.count = count
+        self.modules = [intern(m) for m in (modules or [])]
+        self.jump_libs = [intern(l) for l in (jump_libs or [])]
+        self.bridges = bridges or []
+        self.failed = failed or []
+        self.module_stats = module_stats or {}
+
+    @classmethod
+    def from_json(cls, text):
+        raw = json.loads(text, object_hook=_bridge_hook)
+        bridges = raw.get('bridges', [])
+        for i, b in enumerate(bridges):
+            if not isinstance(b, Bridge):
+                # XXX: Entries with extra keys; keep what we know about.
+                bridges[i] = Bridge(b['jsname'], b['cfunc'], b['library'])
+        return cls(
+            objects_examined=raw.get('objects_examined', 0),
+            callable_objects=raw.get('callable_objects', 0),
+            foreign_callable_objects=raw.get('foreign_callable_objects', 0),
+            duration_sec=raw.get('duration_sec', 0),
+            count=raw.get('count', len(bridges)),
+            modules=raw['modules'],
+            jump_libs=raw.get('jump_libs', []),
+            bridges=bridges,
+            failed=[Failure(k, v) for k, v in raw['failed'].items()],
+            module_stats=raw.get('module_stats', {}),
+        )
+
+    def to_dict(self):
+        return {
+            'objects_examined': self.objects_examined,
+            'callable_objects': self.callable_objects,
+            'foreign_callable_objects': self.foreign_callable_objects,
+            'duration_sec': self.duration_sec,
+            'count': self.count,
+            'modules': self.modules,
+            'jump_libs': self.jump_libs,
+            'bridges': [b.to_dict() for b in self.bridges],
+            'module_stats': self.module_stats,
+            'failed': {f.jsname: f.reason for f in self.failed},
+        }
+
+    def save(self, path):
+        # XXX: A new inode every time, so that load_bridges() never serves
+        #      a stale or half-written model.
+        tmp_path = f"{path}.tmp.{os.getpid()}.{uuid.uuid4().hex[:8]}"
+        with open(tmp_path, 'w') as outfile:
+            outfile.write(json.dumps(self.to_dict(), indent=2))
+        os.replace(tmp_path, path)
+
+@functools.lru_cache(maxsize=4)
+def _load_bridges(path, ino, mtime_ns, size):
+    with open(path, 'r') as infile:
+        return BridgesFile.from_json(infile.read())
+
+def load_bridges(path):
+    # XXX: Parsed once per file version and shared by all stages of a
+    #      package. Callers must not mutate the result; it is invalidated
+    #      as soon as the file is rewritten.
+    st = os.stat(path)
+    return _load_bridges(os.path.abspath(path), st.st_ino, st.st_mtime_ns, st.st_size)
+
+class_registry = {
+    cls.__name__: cls for cls in (PyCHop, PyCBridge, Bridge, Failure)
+}
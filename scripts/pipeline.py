@@ -0,0 +1,63 @@
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+import tracing
+
+log = logging.getLogger(__name__)
+
+INSTALL = 'install'
+ANALYZE = 'analyze'
+BUILD = 'build'
+EXPORT = 'export'
+STAGES = (INSTALL, ANALYZE, BUILD, EXPORT)
+
+DEFAULT_INSTALL_JOBS = 4
+# XXX: CSV export is cheap and demangling goes through one c++filt anyway.
+DEFAULT_EXPORT_JOBS = 2
+
+# XXX: Stage -> semaphore. Empty (no limits) unless find_bridges.py runs
+#      with --pipeline; limits are per process.
+_limits = {}
+
+
+def configure(limits):
+    global _limits
+    _limits = {stage: threading.BoundedSemaphore(n) for stage, n in limits.items() if n}
+
+
+@contextmanager
+def slot(stage):
+    sem = _limits.get(stage)
+    if sem is None:
+        yield
+        return
+    if not sem.acquire(blocking=False):
+        # XXX: Shows up as its own span, so that stage durations are
+        #      the work alone and queueing is visible in the trace.
+        with tracing.span('wait', resource=stage):
+            sem.acquire()
+    try:
+        yield
+    finally:
+        sem.release()
+
+
+def limited(stage):
+    # XXX: Decorator for JavascriptBridger methods that use the resource
+    #      a stage is named after. Must never nest.
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with slot(stage):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+
+def thread_filter():
+    # XXX: For handlers that should only see the current thread's records
+    #      (per-package log files with several packages in one process).
+    ident = threading.get_ident()
+    return lambda record: record.thread == ident
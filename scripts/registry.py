@@ -0,0 +1,145 @@
+import os
+import json
+import base64
+import hashlib
+import logging
+import tarfile
+import argparse
+import threading
+from urllib.parse import quote, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import triage
+
+log = logging.getLogger(__name__)
+
+
+def tarball_package_json(path):
+    with tarfile.open(path, 'r:*') as tar:
+        m = triage.package_json_member(tar.getmembers())
+        if m is None:
+            return None
+        return json.loads(tar.extractfile(m).read().decode('utf-8'))
+
+
+def digests(path):
+    sha1 = hashlib.sha1()
+    sha512 = hashlib.sha512()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            sha1.update(chunk)
+            sha512.update(chunk)
+    return sha1.hexdigest(), 'sha512-' + base64.b64encode(sha512.digest()).decode('ascii')
+
+
+class Registry():
+    # XXX: Just enough of the npm registry protocol for `npm pack` and
+    #      `npm install` to work against a directory of .tgz files:
+    #      GET /<name> returns the packument, GET /<name>/-/<file> the
+    #      tarball.
+    def __init__(self, root):
+        self.root = root
+        self.tarballs = {}
+        self.packuments = {}
+        self.base_url = None
+        for f in sorted(os.listdir(root)):
+            if not f.endswith('.tgz'):
+                continue
+            path = os.path.join(root, f)
+            pkg = tarball_package_json(path)
+            if pkg is None or 'name' not in pkg or 'version' not in pkg:
+                log.warning(f"Skipping {path}: no usable package.json")
+                continue
+            self.add(pkg, path)
+
+    def add(self, pkg, path):
+        name = pkg['name']
+        fname = os.path.basename(path)
+        shasum, integrity = digests(path)
+        doc = self.packuments.setdefault(name, {'name': name, 'dist-tags': {}, 'versions': {}})
+        meta = dict(pkg)
+        meta['_id'] = f"{name}@{pkg['version']}"
+        scripts = pkg.get('scripts') or {}
+        if pkg.get('gypfile') or any(s in scripts for s in ('preinstall', 'install', 'postinstall')):
+            meta['hasInstallScript'] = True
+        meta['dist'] = {'shasum': shasum, 'integrity': integrity, 'file': fname}
+        doc['versions'][pkg['version']] = meta
+        # XXX: Fixture corpora are added in version order.
+        doc['dist-tags']['latest'] = pkg['version']
+        self.tarballs[(name, fname)] = path
+
+    def packument(self, name):
+        doc = self.packuments.get(name)
+        if doc is None:
+            return None
+        doc = json.loads(json.dumps(doc))
+        for meta in doc['versions'].values():
+            fname = meta['dist'].pop('file')
+            meta['dist']['tarball'] = f"{self.base_url}/{quote(name, safe='@')}/-/{fname}"
+        return doc
+
+
+class Handler(BaseHTTPRequestHandler):
+    registry = None
+
+    def log_message(self, fmt, *args):
+        log.debug(fmt % args)
+
+    def _send(self, code, body, ctype):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        path = unquote(self.path.split('?', 1)[0]).lstrip('/')
+        if '/-/' in path:
+            name, fname = path.split('/-/', 1)
+            tarball = self.registry.tarballs.get((name, fname))
+            if tarball is None:
+                self._send(404, b'{"error":"not found"}', 'application/json')
+                return
+            with open(tarball, 'rb') as infile:
+                self._send(200, infile.read(), 'application/octet-stream')
+            return
+        doc = self.registry.packument(path)
+        if doc is None:
+            self._send(404, b'{"error":"not found"}', 'application/json')
+            return
+        self._send(200, json.dumps(doc).encode('utf-8'), 'application/json')
+
+    do_HEAD = do_GET
+
+
+def serve(root, host='127.0.0.1', port=0):
+    # XXX: Returns (server, url); the server runs in a daemon thread until
+    #      server.shutdown().
+    registry = Registry(root)
+    handler = type('RegistryHandler', (Handler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    registry.base_url = f"http://{host}:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    log.info(f"Serving {len(registry.tarballs)} tarballs from {root} at {registry.base_url}")
+    return server, registry.base_url
+
+
+def main():
+    p = argparse.ArgumentParser(description='Serve a directory of npm tarballs as a local registry.')
+    p.add_argument("root", help=("Directory with .tgz files."))
+    p.add_argument("--host", default='127.0.0.1', help=("Address to listen on."))
+    p.add_argument("-p", "--port", default=4873, type=int, help=("Port to listen on."))
+    args = p.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server, url = serve(args.root, args.host, args.port)
+    print(f"npm_config_registry={url}/")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,20 @@ import sys
 import logging
 import argparse
 import json
+import uuid
 
 import subprocess
 import tempfile
 
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
+import utils
 import objects
+import elfsym
+import symcache
+import demangle
+import tracing
 
 log = logging.getLogger(__name__)
 
@@ -42,30 +49,6 @@ GDB_ADDR2SYMBOL_INVOKE = "addr2symbol(%s)\n"
 GDB_QUIT_INVOKE = "gdb.execute('quit')\n"
 
 
-def setup_logging(args):
-    levels = {
-        "critical": logging.CRITICAL,
-        "error": logging.ERROR,
-        "warn": logging.WARNING,
-        "warning": logging.WARNING,
-        "info": logging.INFO,
-        "debug": logging.DEBUG,
-    }
-    level = levels.get(args.log.lower())
-    if level is None:
-        raise ValueError(
-            f"log level given: {args.log}"
-            f" -- must be one of: {' | '.join(levels.keys())}"
-        )
-
-    fmt = "%(asctime)s "
-    fmt += "%(module)s:%(lineno)s [%(levelname)s] "
-    fmt += "%(message)s"
-    # Use ISO 8601 format
-    datefmt='%Y-%m-%dT%H:%M:%S'
-
-    logging.basicConfig(level=level, format=fmt, datefmt=datefmt)
-
 def parse_args():
     p = argparse.ArgumentParser(description='Resolve addresses to symbols using GDB')
     p.add_argument(
@@ -92,6 +75,65 @@ def parse_args():
         default=None,
         help=("Absolute path to the candidates JSON file."),
     )
+    p.add_argument(
+        "-b",
+        "--backend",
+        default="elf",
+        choices=["elf", "gdb"],
+        help=("Symbolization backend: read the target's ELF files directly (elf)"
+              " or attach with GDB (gdb)."),
+    )
+    p.add_argument(
+        "-s",
+        "--serve",
+        default=False,
+        action='store_true',
+        help=("Run a resolution session: read one JSON array of addresses per line"
+              " and answer each with one JSON object per line. A request of the form"
+              " {\"demangle\": [names]} is answered with {\"names\": [demangled]}."),
+    )
+    p.add_argument(
+        "--fifo-in",
+        default=None,
+        help=("Session mode: read requests from this FIFO instead of stdin."),
+    )
+    p.add_argument(
+        "--fifo-out",
+        default=None,
+        help=("Session mode: write responses to this FIFO instead of stdout."),
+    )
+    p.add_argument(
+        "--cache",
+        default=symcache.default_cache_path(),
+        help=("Path to the persistent symbol cache. Defaults to data/symcache.sqlite"
+              " under GASKET_ROOT (or GASKET_SYMCACHE)."),
+    )
+    p.add_argument(
+        "--no-cache",
+        default=False,
+        action='store_true',
+        help=("Do not use the persistent symbol cache."),
+    )
+    p.add_argument(
+        "--cache-size",
+        default=symcache.DEFAULT_MAX_ENTRIES,
+        type=int,
+        help=("Maximum number of entries kept in the symbol cache."),
+    )
+    p.add_argument(
+        "--snapshot",
+        nargs='+',
+        default=None,
+        help=("Offline mode: finish bridges.json files written by gasket --defer-resolve,"
+              " using their process snapshots instead of a live target."),
+    )
+    p.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        type=int,
+        help=("Offline mode: number of snapshots to resolve in parallel."),
+    )
 
     return p.parse_args()
 
@@ -196,11 +238,243 @@ def parse_gdb_line(line):
 
     return ret
 
+def resolve_elf(symbol_addresses, target_pid, resolver=None):
+    if resolver is None:
+        resolver = elfsym.ElfResolver(pid=target_pid)
+        try:
+            found = resolver.resolve(symbol_addresses)
+        finally:
+            resolver.close()
+    else:
+        found = resolver.resolve(symbol_addresses)
+    hops = []
+    for address, (c_name, section, library) in found.items():
+        hops.append(objects.PyCHop(None, address, c_name, section, library))
+    return hops
+
+def resolve_gdb(symbol_addresses, target_pid):
+    hops = []
+    gdb_output = run_gdb(symbol_addresses, target_pid)
+    for line in gdb_output.splitlines():
+        hop = parse_gdb_line(line)
+        if hop is not None:
+            hops.append(hop)
+    return hops
+
+BACKENDS = {
+    'elf': resolve_elf,
+    'gdb': resolve_gdb,
+}
+
+def hops_to_resolved(hops):
+    resolved = {}
+    for h in hops:
+        resolved[hex(h.address)] = {'cfunc': h.cfunc, 'library': h.library}
+    return resolved
+
+class Session():
+    def __init__(self, target_pid, backend='elf', cache=None, maps_text=None):
+        self.target_pid = target_pid
+        self.backend = backend
+        self.cache = cache
+        self.resolver = None
+        self.batches = 0
+        if maps_text is not None:
+            # XXX: Offline: the target is gone, only its mappings are left.
+            self.resolver = elfsym.ElfResolver(maps_text=maps_text)
+        elif backend == 'elf' or cache is not None:
+            # XXX: Index once, keep it across batches. New modules loaded
+            #      by the target are picked up on the first miss. The GDB
+            #      backend only uses it to locate addresses for the cache.
+            self.resolver = elfsym.ElfResolver(pid=target_pid)
+
+    def resolve_hops(self, symbol_addresses):
+        with tracing.span('resolve', backend=self.backend, addresses=len(symbol_addresses)) as rec:
+            hops = self._resolve_hops(symbol_addresses, rec)
+            rec['resolved'] = len(hops)
+            return hops
+
+    def _resolve_hops(self, symbol_addresses, rec):
+        self.batches += 1
+        hops = []
+        pending = symbol_addresses
+        if self.cache is not None:
+            hops, pending = self.cache.lookup(symbol_addresses, self.resolver)
+            rec['cache_misses'] = len(pending)
+            if not pending:
+                log.info(f"All {len(symbol_addresses)} addresses served from the symbol cache")
+                return hops
+            log.info(f"Symbol cache: {len(symbol_addresses) - len(pending)} hits,"
+                     f" {len(pending)} misses")
+        if self.backend == 'elf':
+            new_hops = resolve_elf(pending, self.target_pid, self.resolver)
+        else:
+            new_hops = BACKENDS[self.backend](pending, self.target_pid)
+        if self.cache is not None:
+            # XXX: Only the ELF backend tells "no symbol" apart from "did
+            #      not run"; GDB returns nothing when it cannot attach.
+            self.cache.store(pending, new_hops, self.resolver, negative=(self.backend == 'elf'))
+        return hops + new_hops
+
+    def resolve(self, symbol_addresses):
+        return hops_to_resolved(self.resolve_hops(symbol_addresses))
+
+    def close(self):
+        if self.resolver is not None:
+            self.resolver.close()
+            self.resolver = None
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+def open_cache(path, max_entries):
+    if path is None:
+        return None
+    try:
+        return symcache.SymbolCache(path, max_entries)
+    except Exception as e:
+        log.warning(f"Symbol cache at {path} unavailable: {e}")
+        return None
+
+def changed_files(files):
+    # XXX: Mapped files replaced or modified since the snapshot was taken
+    #      can no longer be trusted to symbolize its addresses.
+    changed = set()
+    for path, ident in files.items():
+        try:
+            st = os.stat(path)
+        except OSError:
+            changed.add(path)
+            continue
+        if (str(st.st_dev) != ident['dev'] or str(st.st_ino) != ident['ino']
+                or str(st.st_size) != ident['size'] or str(st.st_mtime_ns) != ident['mtime_ns']):
+            changed.add(path)
+    return changed
+
+def resolve_snapshot(path, cache_path=None, cache_size=symcache.DEFAULT_MAX_ENTRIES):
+    # XXX: Finish a bridges.json written by gasket --defer-resolve in place.
+    with open(path, 'r') as infile:
+        raw = json.loads(infile.read())
+    deferred = raw.pop('deferred', None)
+    if deferred is None:
+        log.info(f"{path} has no deferred addresses")
+        return 0
+    snapshot = deferred['snapshot']
+    changed = changed_files(snapshot['files'])
+    for f in sorted(changed):
+        log.warning(f"{f} changed since the snapshot of {path}, not resolving into it")
+
+    addresses = set(e['address'] for e in deferred['cfuncs'].values())
+    for e in deferred['overloads'].values():
+        addresses.update(e['addresses'])
+    session = Session(snapshot['pid'], 'elf', open_cache(cache_path, cache_size),
+                      maps_text=snapshot['maps'])
+    try:
+        found = {}
+        for h in session.resolve_hops(sorted(addresses)):
+            if h.library not in changed:
+                found[h.address] = h
+    finally:
+        session.close()
+
+    def lookup(addr):
+        address = elfsym.parse_address(addr)
+        return found.get(address) if address is not None else None
+
+    bridges = raw['bridges']
+    stats = raw.setdefault('module_stats', {})
+    def add(fqn, cfunc, library, module):
+        bridges.append({'jsname': fqn, 'cfunc': cfunc, 'library': library})
+        if library not in raw['jump_libs']:
+            raw['jump_libs'].append(library)
+        if module in stats:
+            stats[module]['count'] += 1
+
+    for fqn, e in deferred['overloads'].items():
+        for addr in e['addresses']:
+            h = lookup(addr)
+            if h is None:
+                raw['failed'][fqn] = 'OVERLOAD_RESOLUTION'
+                continue
+            add(fqn, h.cfunc, h.library, e['module'])
+
+    hops = {fqn: lookup(e['address']) for fqn, e in deferred['cfuncs'].items()}
+    names = demangle.get_demangler().demangle_batch(
+        [h.cfunc for h in hops.values() if h is not None])
+    names = iter(names)
+    for fqn, h in hops.items():
+        if h is None:
+            raw['failed'][fqn] = 'CFUNC_ADDRESS_RESOLUTION'
+            continue
+        add(fqn, next(names), h.library, deferred['cfuncs'][fqn]['module'])
+
+    raw['count'] = len(bridges)
+    tmp_path = f"{path}.tmp.{os.getpid()}.{uuid.uuid4().hex[:8]}"
+    with open(tmp_path, 'w') as outfile:
+        outfile.write(json.dumps(raw, indent=2))
+    os.replace(tmp_path, path)
+    log.info(f"Resolved {len(found)}/{len(addresses)} deferred addresses of {path}")
+    return 0
+
+def _resolve_snapshot_job(path, cache_path, cache_size):
+    try:
+        return path, resolve_snapshot(path, cache_path, cache_size)
+    except (OSError, ValueError, KeyError) as e:
+        log.error(f"Could not resolve {path}: {e}")
+        return path, -1
+
+def resolve_snapshots(paths, jobs=1, cache_path=None, cache_size=symcache.DEFAULT_MAX_ENTRIES):
+    if jobs <= 1 or len(paths) <= 1:
+        return dict(_resolve_snapshot_job(p, cache_path, cache_size) for p in paths)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return dict(executor.map(_resolve_snapshot_job, paths,
+                                 [cache_path] * len(paths), [cache_size] * len(paths)))
+
+def serve(target_pid, backend, fifo_in=None, fifo_out=None, cache=None):
+    # XXX: Open the response side first; the client holds its read end
+    #      open before it starts waiting for us on the request side.
+    fout = open(fifo_out, 'w') if fifo_out is not None else sys.stdout
+    fin = open(fifo_in, 'r') if fifo_in is not None else sys.stdin
+    session = Session(target_pid, backend, cache)
+    log.info(f"Serving resolution requests for pid {target_pid} ({backend})")
+    try:
+        for line in fin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+                if isinstance(request, dict) and 'demangle' in request:
+                    # XXX: {"demangle": [names]} -> {"names": [demangled]}
+                    with tracing.span('demangle', names=len(request['demangle'])):
+                        reply = {'names': demangle.get_demangler().demangle_batch(request['demangle'])}
+                else:
+                    reply = session.resolve(request)
+            except Exception as e:
+                log.error(f"Failed to handle request: {e}")
+                reply = {}
+            fout.write(json.dumps(reply) + '\n')
+            fout.flush()
+    except BrokenPipeError:
+        log.warning("Client went away")
+    finally:
+        log.info(f"Session done after {session.batches} batches")
+        session.close()
+        if fin is not sys.stdin:
+            fin.close()
+        if fout is not sys.stdout:
+            try:
+                fout.close()
+            except BrokenPipeError:
+                pass
+
 class Analyzer():
-    def __init__(self, input_file, target_pid, output_file):
+    def __init__(self, input_file, target_pid, output_file, backend='elf', cache=None):
         self.input_file = input_file
         self.output_file = output_file
         self.target_pid = target_pid
+        self.backend = backend
+        self.cache = cache
         self.symbol_addresses = []
         self.resolved = {}
         self.hops = []
@@ -208,12 +482,12 @@ class Analyzer():
         with open(self.input_file, 'r') as infile:
             self.symbol_addresses = json.loads(infile.read())
         log.info(f'ADDRESSES = {self.symbol_addresses}')
-        log.info('Running GDB')
-        gdb_output = run_gdb(self.symbol_addresses, self.target_pid)
-        for line in gdb_output.splitlines():
-            hop = parse_gdb_line(line)
-            if hop is not None:
-                self.hops.append(hop)
+        log.info(f'Resolving with backend {self.backend}')
+        session = Session(self.target_pid, self.backend, self.cache)
+        try:
+            self.hops = session.resolve_hops(self.symbol_addresses)
+        finally:
+            session.close()
         if (len(self.symbol_addresses) != len(self.hops)):
             log.info(("len(symbol_addresses) = %s != %s = len(hops)"
                    % (len(self.symbol_addresses), len(self.hops))))
@@ -222,12 +496,7 @@ class Analyzer():
 
         bridges = []
 
-        for h in self.hops:
-            address = hex(h.address)
-            lib = h.library
-            cfunc = h.cfunc
-            d = {'cfunc': cfunc, 'library': lib}
-            self.resolved[address] = d
+        self.resolved = hops_to_resolved(self.hops)
 
 
         # for p in self.pyname_addr_pairs:
@@ -279,11 +548,25 @@ class Analyzer():
             log.info(json.dumps(self.resolved, indent=2))
         else:
             with open(self.output_file, 'w') as outfile:
-                outfile.write(json.dumps(self.resolved, indent=2))
+                outfile.write(json.dumps(self.resolved))
 
 def main():
     args = parse_args()
-    setup_logging(args)
+    utils.setup_logging(args)
+    tracing.configure_from_env()
+    cache = None
+    if args.snapshot is not None:
+        results = resolve_snapshots(args.snapshot, args.jobs,
+                                    None if args.no_cache else args.cache, args.cache_size)
+        sys.exit(0 if all(ret == 0 for ret in results.values()) else 1)
+    if not args.no_cache:
+        cache = open_cache(args.cache, args.cache_size)
+    if args.serve:
+        if args.pid is None:
+            log.error("Must give target pid")
+            sys.exit(1)
+        serve(args.pid, args.backend, args.fifo_in, args.fifo_out, cache)
+        return
     if args.input is None:
         log.error("Must give input file path")
         sys.exit(1)
@@ -291,7 +574,10 @@ def main():
     if not os.path.exists(json_path):
         log.error(f"Input file {json_path} does not exist")
         sys.exit(1)
-    analyzer = Analyzer(args.input, args.pid, args.output)
+    if args.pid is None:
+        log.error("Must give target pid")
+        sys.exit(1)
+    analyzer = Analyzer(args.input, args.pid, args.output, args.backend, cache)
     analyzer.process()
 
 if __name__ == "__main__":
@@ -0,0 +1,208 @@
+import os
+import json
+import logging
+import argparse
+import statistics
+
+import utils
+import triage
+import manifest
+import tarballs
+
+log = logging.getLogger(__name__)
+
+GASKET_ROOT = os.getenv("GASKET_ROOT")
+
+CSV = 'csv'
+LONGEST = 'longest'
+SHORTEST = 'shortest'
+POLICIES = (CSV, LONGEST, SHORTEST)
+
+PURE_JS = 'pure-js'
+PREBUILT = 'prebuilt'
+BUILD = 'build'
+UNKNOWN = 'unknown'
+
+# XXX: Seconds per package class until the corpus' own history says
+#      otherwise.
+DEFAULT_COST_SEC = {
+    PURE_JS: 2,
+    PREBUILT: 60,
+    BUILD: 600,
+    UNKNOWN: 120,
+}
+
+# XXX: What a package whose outputs are up to date costs: find_bridges.py
+#      only reads its manifest.
+FRESH_COST_SEC = 0.01
+
+# XXX: Tarball size at which the default costs apply; bigger packages
+#      are assumed to be slower, within bounds.
+REF_TARBALL_BYTES = 256 * 1024
+SIZE_FACTOR_BOUNDS = (0.5, 4.0)
+
+
+def is_fresh(m):
+    # XXX: Same outcomes find_bridges.py wants before it skips a package;
+    #      it also compares tool versions, which we cannot do from here.
+    return all(m.get(stage) is not None and m.get(stage)['outcome'] == manifest.OK
+               for stage in ('bridges', 'csv'))
+
+
+def history_cost(m):
+    # XXX: Time the last run spent in stages that finished, whatever
+    #      their outcome. None without a finished install.
+    install = m.get('install')
+    if install is None or install['outcome'] not in (manifest.OK, manifest.FAILED):
+        return None
+    return sum(rec.get('duration_sec', 0) for rec in m.stages.values()
+               if rec['outcome'] in (manifest.OK, manifest.FAILED))
+
+
+def classify(verdict, reasons):
+    if verdict == triage.PURE_JS:
+        return PURE_JS
+    if any(r.startswith('file:') and r.endswith('.node') for r in reasons) or \
+            any(r.startswith('prebuilds:') for r in reasons):
+        return PREBUILT
+    if 'gypfile' in reasons or any(r.endswith('binding.gyp') or r.startswith('script:') for r in reasons):
+        return BUILD
+    return UNKNOWN
+
+
+class Estimate():
+    def __init__(self, package, cost, source, klass=UNKNOWN):
+        self.package = package
+        self.cost = cost
+        self.source = source
+        self.klass = klass
+
+
+class CostModel():
+    # XXX: Predicts how long find_bridges.py will spend on a package, from
+    #      (best first) whether its outputs are up to date, its own last
+    #      run, other versions of it, the median of its class in this
+    #      corpus, and a default for its class scaled by tarball size.
+    #      Only reads manifests and tarball metadata.
+    def __init__(self, output_dir=None, tarball_store=None):
+        self.output_dir = output_dir
+        self.tarball_store = tarball_store
+
+    def package_class(self, package, m):
+        rec = m.get('triage')
+        if rec is not None and rec['outcome'] == manifest.OK:
+            klass = classify(rec['verdict'], rec.get('reasons', []))
+        else:
+            klass = None
+        install = m.get('install')
+        if install is not None and install.get('build_from_source'):
+            # XXX: Needed a rebuild last time; will most likely again.
+            return BUILD
+        return klass or UNKNOWN
+
+    def tarball_meta(self, package):
+        if self.tarball_store is None:
+            return None
+        name, version = utils.pkg_name_to_tuple(package)
+        return self.tarball_store.peek(name, version)
+
+    def size_factor(self, package):
+        meta = self.tarball_meta(package)
+        if meta is None or not meta.get('size'):
+            return 1.0
+        lo, hi = SIZE_FACTOR_BOUNDS
+        return max(lo, min(hi, (meta['size'] / REF_TARBALL_BYTES) ** 0.5))
+
+    def estimate(self, package_names):
+        root = os.path.join(self.output_dir or GASKET_ROOT, 'data/manifests')
+        manifests = {p: manifest.Manifest(manifest.manifest_path(root, p)) for p in package_names}
+        history = {}
+        by_name = {}
+        by_class = {}
+        classes = {}
+        for p, m in manifests.items():
+            classes[p] = self.package_class(p, m)
+            cost = history_cost(m)
+            if cost is None:
+                continue
+            history[p] = cost
+            by_name.setdefault(p.split(':')[0], []).append(cost)
+            by_class.setdefault(classes[p], []).append(cost)
+        estimates = {}
+        for p in package_names:
+            klass = classes[p]
+            name = p.split(':')[0]
+            if is_fresh(manifests[p]):
+                estimates[p] = Estimate(p, FRESH_COST_SEC, 'fresh', klass)
+            elif p in history:
+                estimates[p] = Estimate(p, history[p], 'history', klass)
+            elif name in by_name:
+                estimates[p] = Estimate(p, statistics.median(by_name[name]), 'versions', klass)
+            elif klass in by_class:
+                estimates[p] = Estimate(p, statistics.median(by_class[klass]) * self.size_factor(p),
+                                        'class', klass)
+            else:
+                estimates[p] = Estimate(p, DEFAULT_COST_SEC[klass] * self.size_factor(p),
+                                        'default', klass)
+        return estimates
+
+
+def order_groups(groups, policy, estimates):
+    # XXX: Groups (all versions of a name) stay whole and keep their
+    #      internal order; ties keep input order.
+    if policy == CSV:
+        return list(groups)
+    cost = lambda g: sum(estimates[p].cost for p in g)
+    return sorted(groups, key=cost, reverse=(policy == LONGEST))
+
+
+def schedule(groups, policy, model):
+    if policy == CSV:
+        return list(groups)
+    estimates = model.estimate([p for g in groups for p in g])
+    ordered = order_groups(groups, policy, estimates)
+    sources = {}
+    for e in estimates.values():
+        sources[e.source] = sources.get(e.source, 0) + 1
+    total = sum(e.cost for e in estimates.values())
+    log.info(f"Scheduled {len(groups)} groups {policy}-first; predicted {total / 3600:.1f} CPU-hours"
+             f" (estimates from {sources})")
+    for g in ordered[:5]:
+        log.info(f"  {sum(estimates[p].cost for p in g):>10.1f}s  {', '.join(g)}")
+    return ordered
+
+
+def main():
+    p = argparse.ArgumentParser(description='Predict per-package cost and print the processing order.')
+    p.add_argument(
+        "-l",
+        "--log",
+        default="info",
+        help=("Provide logging level. Example --log debug"),
+    )
+    p.add_argument("-i", "--input", required=True, help=("CSV file with package:version pairs."))
+    p.add_argument("-o", "--output", default=None,
+                   help=("Output directory that find_bridges.py was run with, to find the manifests."))
+    p.add_argument("-s", "--schedule", default=LONGEST, choices=POLICIES,
+                   help=("Order to print."))
+    p.add_argument("--json", default=False, action='store_true',
+                   help=("Print the estimates as JSON lines."))
+    args = p.parse_args()
+    utils.setup_logging(args)
+
+    import find_bridges
+    package_names = utils.load_csv(args.input)
+    model = CostModel(args.output, tarballs.TarballStore())
+    estimates = model.estimate(package_names)
+    for g in order_groups(find_bridges.group_packages(package_names), args.schedule, estimates):
+        for pkg in g:
+            e = estimates[pkg]
+            if args.json:
+                print(json.dumps({'package': pkg, 'cost_sec': round(e.cost, 1),
+                                  'source': e.source, 'class': e.klass}))
+            else:
+                print(f"{e.cost:>10.1f}\t{e.source:<8}\t{e.klass:<8}\t{pkg}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+import os
+import re
+import json
+import struct
+import logging
+import argparse
+
+import utils
+import elfsym
+import modcache
+import objects
+import demangle
+
+log = logging.getLogger(__name__)
+
+GASKET_ROOT = os.getenv("GASKET_ROOT")
+
+# XXX: Bump whenever the analysis changes; part of the bridges stage inputs
+#      when find_bridges.py runs with --static.
+VERSION = 1
+
+EM_X86_64 = 62
+EM_AARCH64 = 183
+
+# XXX: (RELATIVE, ABS64) relocation types per machine.
+RELOCS = {
+    EM_X86_64: (8, 1),
+    EM_AARCH64: (1027, 257),
+}
+
+SHT_RELA = 4
+SHT_RELR = 19
+SHF_EXECINSTR = 0x4
+
+PTR_SIZE = 8
+# XXX: napi_property_descriptor on LP64: utf8name, name, method, getter,
+#      setter, value, attributes (+ padding), data.
+DESC_SIZE = 8 * PTR_SIZE
+MAX_ATTRIBUTES = 0x7ff
+
+# XXX: Entry points of N-API addons.
+REGISTER_EXPORTS = ('napi_register_module_v1',)
+REGISTER_IMPORTS = ('napi_module_register',)
+
+# XXX: Ways to hand a native callback to JS other than a property table
+#      passed to napi_define_properties(). Any of these makes the static
+#      view incomplete.
+DYNAMIC_CALLBACK_APIS = {
+    'napi_create_function',
+    'napi_define_class',
+    'napi_new_instance',
+    'napi_wrap',
+    'napi_create_external',
+    'node_api_create_external_string_latin1',
+}
+
+# XXX: Direct use of V8 or Node internals (NAN, plain V8 addons).
+NON_NAPI_PREFIXES = ('_ZN2v8', '_ZN4node', '_ZNK2v8')
+
+NAME_RE = re.compile(r'^[\x21-\x7e]{1,256}$')
+
+
+class StaticResult():
+    def __init__(self, path, complete, reasons, entry=None):
+        self.path = path
+        self.complete = complete
+        self.reasons = reasons
+        self.entry = entry
+
+
+def pointer_slots(elf):
+    # XXX: Map of data addresses to the address their dynamic relocation
+    #      stores there. Imported targets are left out.
+    relative, abs64 = RELOCS[elf.e_machine]
+    syms = None
+    slots = {}
+    data = elf.data
+    for sec in elf.sections:
+        if not sec.flags & elfsym.SHF_ALLOC:
+            continue
+        if sec.sh_type == SHT_RELA:
+            for off in range(sec.offset, sec.offset + sec.size - 23, 24):
+                r_offset, r_info, r_addend = struct.unpack_from('<QQq', data, off)
+                rtype = r_info & 0xffffffff
+                if rtype == relative:
+                    slots[r_offset] = r_addend
+                elif rtype == abs64:
+                    if syms is None:
+                        syms = elf.dynsyms()
+                    idx = r_info >> 32
+                    if idx < len(syms) and syms[idx][2] != elfsym.SHN_UNDEF:
+                        slots[r_offset] = syms[idx][3] + r_addend
+        elif sec.sh_type == SHT_RELR:
+            # XXX: Packed relative relocations; the addend is in place.
+            where = 0
+            for off in range(sec.offset, sec.offset + sec.size - 7, 8):
+                (entry,) = struct.unpack_from('<Q', data, off)
+                if entry & 1 == 0:
+                    addrs = [entry]
+                    where = entry + PTR_SIZE
+                else:
+                    addrs = [where + (i - 1) * PTR_SIZE for i in range(1, 64) if entry >> i & 1]
+                    where += 63 * PTR_SIZE
+                for a in addrs:
+                    foff = elf.file_offset(a)
+                    if foff is not None:
+                        slots[a] = struct.unpack_from('<Q', data, foff)[0]
+    return slots
+
+
+class Slot():
+    # XXX: What a pointer-sized word holds once relocated: a target address
+    #      (reloc), a plain value, or None if it is not in the file.
+    def __init__(self, elf, slots, vaddr):
+        self.reloc = slots.get(vaddr)
+        self.value = None
+        if self.reloc is None:
+            off = elf.file_offset(vaddr)
+            if off is not None and off + PTR_SIZE <= len(elf.data):
+                self.value = struct.unpack_from('<Q', elf.data, off)[0]
+
+    def is_zero(self):
+        return self.reloc is None and self.value == 0
+
+
+def is_code(elf, vaddr):
+    s = elf.section_at(vaddr)
+    return s is not None and bool(s.flags & SHF_EXECINSTR)
+
+
+def read_descriptor(elf, slots, vaddr):
+    # XXX: Returns (utf8name, method, getter, setter) if a plausible
+    #      napi_property_descriptor with a native callback starts here.
+    utf8name, name, method, getter, setter, value, attrs, data = \
+        [Slot(elf, slots, vaddr + i * PTR_SIZE) for i in range(8)]
+    if utf8name.reloc is None or is_code(elf, utf8name.reloc):
+        return None
+    if not (name.is_zero() and value.is_zero()):
+        return None
+    if attrs.reloc is not None or attrs.value is None or attrs.value > MAX_ATTRIBUTES:
+        return None
+    if data.reloc is None and data.value != 0:
+        return None
+    callbacks = []
+    for s in (method, getter, setter):
+        if s.is_zero():
+            callbacks.append(None)
+        elif s.reloc is not None and is_code(elf, s.reloc):
+            callbacks.append(s.reloc)
+        else:
+            return None
+    if not any(callbacks):
+        return None
+    jsname = elf.cstr_at(utf8name.reloc)
+    if jsname is None or not NAME_RE.match(jsname):
+        return None
+    return (jsname, *callbacks)
+
+
+def find_tables(elf, slots):
+    # XXX: Runs of descriptors laid out back to back, as in a
+    #      `static napi_property_descriptor desc[] = {...}`.
+    tables = []
+    seen = set()
+    for vaddr in sorted(slots):
+        if vaddr in seen:
+            continue
+        desc = read_descriptor(elf, slots, vaddr)
+        if desc is None:
+            continue
+        table = []
+        while desc is not None:
+            table.append(desc)
+            seen.add(vaddr)
+            vaddr += DESC_SIZE
+            desc = read_descriptor(elf, slots, vaddr)
+        tables.append(table)
+    return tables
+
+
+def analyze(path, pkg_root):
+    try:
+        elf = elfsym.ElfFile(path)
+    except (OSError, elfsym.ElfError, struct.error) as e:
+        return StaticResult(path, False, [f'unreadable:{e}'])
+    try:
+        return _analyze(elf, path, pkg_root)
+    except struct.error as e:
+        return StaticResult(path, False, [f'malformed:{e}'])
+    finally:
+        elf.close()
+
+
+def _analyze(elf, path, pkg_root):
+    if elf.elfclass != elfsym.ELFCLASS64 or elf.endian != '<' or elf.e_machine not in RELOCS:
+        return StaticResult(path, False, ['unsupported-arch'])
+    imports = set()
+    exports = set()
+    for name, info, shndx, value in elf.dynsyms():
+        if not name:
+            continue
+        if shndx == elfsym.SHN_UNDEF:
+            imports.add(name)
+        else:
+            exports.add(name)
+    reasons = []
+    if not (exports & set(REGISTER_EXPORTS) or imports & set(REGISTER_IMPORTS)):
+        reasons.append('not-napi')
+    if any(n.startswith(NON_NAPI_PREFIXES) for n in imports):
+        reasons.append('v8-api')
+    for api in sorted(imports & DYNAMIC_CALLBACK_APIS):
+        reasons.append(f'uses:{api}')
+    if 'napi_define_properties' not in imports:
+        reasons.append('no-define-properties')
+    if reasons:
+        return StaticResult(path, False, reasons)
+
+    tables = find_tables(elf, pointer_slots(elf))
+    # XXX: With several tables we cannot tell which object each one ends
+    #      up on; none means the descriptors are built on the stack.
+    if len(tables) != 1:
+        return StaticResult(path, False, [f'tables:{len(tables)}'])
+
+    found = []
+    for jsname, method, getter, setter in tables[0]:
+        for suffix, addr in (('', method), ('.GET', getter), ('.SET', setter)):
+            if addr is None:
+                continue
+            sym = elf.symbol_at(addr)
+            if sym is None or sym[1] != 0:
+                return StaticResult(path, False, ['unnamed-callback'])
+            found.append(('.' + jsname + suffix, sym[0]))
+
+    library = modcache.normalize_library(os.path.realpath(path), pkg_root)
+    cfuncs = demangle.get_demangler().demangle_batch([c for _, c in found])
+    entry = {
+        'bridges': [{'jsname': j, 'cfunc': c, 'library': library}
+                    for (j, _), c in zip(found, cfuncs)],
+        'failed': {},
+        'stats': {
+            'objects_examined': 0,
+            'callable_objects': 0,
+            'foreign_callable_objects': 0,
+            'count': len(found),
+            'static': True,
+        },
+    }
+    return StaticResult(path, True, [], entry)
+
+
+def package_root(module_path):
+    # XXX: <install>/node_modules/<name>/..., where name may be scoped.
+    parts = module_path.split('/')
+    try:
+        i = parts.index('node_modules')
+    except ValueError:
+        return None
+    n = 2 if i + 1 < len(parts) and parts[i + 1].startswith('@') else 1
+    return '/'.join(parts[:i + 1 + n])
+
+
+def triples(bridges):
+    return {(b['jsname'], b['cfunc'], b['library']) for b in bridges}
+
+
+def agreement(bridges_paths):
+    # XXX: Compare static results against what gasket found for every
+    #      module that is still on disk.
+    report = {
+        'modules': 0,
+        'complete': 0,
+        'agree': 0,
+        'incomplete_reasons': {},
+        'disagreements': [],
+    }
+    for bpath in bridges_paths:
+        try:
+            model = objects.load_bridges(bpath)
+        except (OSError, ValueError, KeyError) as e:
+            log.warning(f"Skipping {bpath}: {e}")
+            continue
+        for module in model.modules:
+            if model.module_stats.get(module, {}).get('static'):
+                continue
+            pkg_root = package_root(module)
+            if pkg_root is None or not os.path.exists(module):
+                continue
+            report['modules'] += 1
+            res = analyze(module, pkg_root)
+            if not res.complete:
+                for r in res.reasons:
+                    r = r.split(':')[0] if r.startswith(('unreadable', 'malformed')) else r
+                    report['incomplete_reasons'][r] = report['incomplete_reasons'].get(r, 0) + 1
+                continue
+            report['complete'] += 1
+            dynamic = modcache.extract(model, pkg_root, module)
+            if triples(res.entry['bridges']) == triples(dynamic['bridges']):
+                report['agree'] += 1
+            else:
+                s = triples(res.entry['bridges'])
+                d = triples(dynamic['bridges'])
+                report['disagreements'].append({
+                    'module': module,
+                    'static_only': sorted(s - d),
+                    'dynamic_only': sorted(d - s),
+                })
+    n = report['modules']
+    report['coverage'] = round(report['complete'] / n, 4) if n else 0
+    report['agreement_rate'] = round(report['agree'] / report['complete'], 4) if report['complete'] else 0
+    return report
+
+
+def find_bridges_files(root):
+    paths = []
+    for dirpath, dirs, files in os.walk(root):
+        if 'bridges.json' in files:
+            paths.append(os.path.join(dirpath, 'bridges.json'))
+    return sorted(paths)
+
+
+def main():
+    p = argparse.ArgumentParser(description='Extract N-API bridges from .node files without loading them.')
+    p.add_argument(
+        "-l",
+        "--log",
+        default="info",
+        help=("Provide logging level. Example --log debug"),
+    )
+    sub = p.add_subparsers(dest='command', required=True)
+    an = sub.add_parser('analyze', help='Print the static bridges of modules.')
+    an.add_argument("modules", nargs='+', help=("Paths to .node files."))
+    an.add_argument("-r", "--root", default=None,
+                    help=("Package root (defaults to the node_modules/<name> above each module)."))
+    rep = sub.add_parser('report', help='Measure agreement with gasket over existing bridges.json files.')
+    rep.add_argument("--bridges-root", default=None,
+                     help=("Directory to search for bridges.json files (default: data/bridges)."))
+    rep.add_argument("--json", default=None, help=("Also write the full report to this file."))
+    args = p.parse_args()
+
+    utils.setup_logging(args)
+
+    if args.command == 'analyze':
+        for m in args.modules:
+            root = args.root or package_root(os.path.abspath(m)) or os.path.dirname(os.path.abspath(m))
+            res = analyze(m, root)
+            if not res.complete:
+                print(f"{m}: incomplete ({', '.join(res.reasons)})")
+                continue
+            bridges, _ = modcache.materialize(res.entry, root, m)
+            print(f"{m}: complete, {len(bridges)} bridges")
+            for b in bridges:
+                print(f"  {b.jsname}\t{b.cfunc}\t{b.library}")
+    elif args.command == 'report':
+        root = args.bridges_root or os.path.join(GASKET_ROOT, 'data/bridges')
+        report = agreement(find_bridges_files(root))
+        if args.json is not None:
+            with open(args.json, 'w') as outfile:
+                outfile.write(json.dumps(report, indent=2))
+        print(f"Modules:        {report['modules']}")
+        print(f"Complete:       {report['complete']} ({report['coverage']:.1%})")
+        print(f"Agree:          {report['agree']} ({report['agreement_rate']:.1%} of complete)")
+        for r, n in sorted(report['incomplete_reasons'].items(), key=lambda x: -x[1]):
+            print(f"  {r}: {n}")
+        for d in report['disagreements'][:20]:
+            print(f"Disagreement in {d['module']}:")
+            for t in d['static_only']:
+                print(f"  static only:  {t}")
+            for t in d['dynamic_only']:
+                print(f"  dynamic only: {t}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import os
+import time
+import sqlite3
+import logging
+
+import objects
+import elfsym
+
+log = logging.getLogger(__name__)
+
+GASKET_ROOT = os.getenv("GASKET_ROOT")
+
+DEFAULT_MAX_ENTRIES = 2000000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS symbols (
+    lib_key   TEXT NOT NULL,
+    offset    INTEGER NOT NULL,
+    cfunc     TEXT,
+    section   TEXT,
+    last_used INTEGER NOT NULL,
+    PRIMARY KEY (lib_key, offset)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS symbols_last_used ON symbols (last_used);
+"""
+
+
+def default_cache_path():
+    path = os.getenv("GASKET_SYMCACHE")
+    if path:
+        return path
+    if GASKET_ROOT is None:
+        return None
+    return os.path.join(GASKET_ROOT, 'data', 'symcache.sqlite')
+
+
+class SymbolCache():
+    # XXX: Maps (library identity, link-time offset) to the resolved
+    #      symbol. A NULL cfunc records that the address did not resolve,
+    #      so fully cached batches need no symbolization at all.
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        d = os.path.dirname(path)
+        if d and not os.path.exists(d):
+            os.makedirs(d, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+        # XXX: Upper bound on the number of rows (replaced rows count
+        #      twice), so that we only COUNT(*) when it may be over.
+        self.count = None
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def _key(self, locator, address):
+        obj = locator.locate(address)
+        if obj is None:
+            return None, None
+        return obj, (obj.key, address - obj.bias)
+
+    def lookup(self, symbol_addresses, locator):
+        # XXX: Returns (hops, pending): hops served from the cache and the
+        #      addresses that still need to go through a backend.
+        hops = []
+        pending = []
+        used = []
+        locator.begin_batch()
+        for addr in symbol_addresses:
+            address = elfsym.parse_address(addr)
+            if address is None:
+                pending.append(addr)
+                continue
+            obj, key = self._key(locator, address)
+            if key is None:
+                pending.append(addr)
+                continue
+            row = self.db.execute(
+                "SELECT cfunc, section FROM symbols WHERE lib_key = ? AND offset = ?",
+                key).fetchone()
+            if row is None:
+                pending.append(addr)
+                continue
+            used.append(key)
+            if row[0] is not None:
+                hops.append(objects.PyCHop(None, address, row[0], row[1], obj.path))
+        self.hits += len(used)
+        self.misses += len(pending)
+        if used:
+            now = int(time.time())
+            with self.db:
+                self.db.executemany(
+                    "UPDATE symbols SET last_used = ? WHERE lib_key = ? AND offset = ?",
+                    [(now, k[0], k[1]) for k in used])
+        return hops, pending
+
+    def store(self, symbol_addresses, hops, locator, negative=True):
+        # XXX: negative=False for backends whose empty result may just mean
+        #      they failed (e.g., GDB could not attach); addresses they did
+        #      not resolve are then left to the next lookup.
+        found = {h.address: h for h in hops}
+        rows = []
+        now = int(time.time())
+        locator.begin_batch()
+        for addr in symbol_addresses:
+            address = elfsym.parse_address(addr)
+            if address is None:
+                continue
+            obj, key = self._key(locator, address)
+            if key is None:
+                continue
+            h = found.get(address)
+            if h is not None:
+                rows.append((key[0], key[1], h.cfunc, h.section, now))
+            elif negative:
+                rows.append((key[0], key[1], None, None, now))
+        if not rows:
+            return
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO symbols VALUES (?, ?, ?, ?, ?)", rows)
+        if self.count is not None:
+            self.count += len(rows)
+        self.evict()
+
+    def evict(self):
+        if self.count is not None and self.count <= self.max_entries:
+            return
+        count = self.db.execute("SELECT COUNT(*) FROM symbols").fetchone()[0]
+        self.count = count
+        excess = count - self.max_entries
+        if excess <= 0:
+            return
+        # XXX: Evict a bit more than needed, so that we do not end up
+        #      evicting on every single batch once the cache is full.
+        excess += self.max_entries // 10
+        log.info(f"Evicting {excess} least recently used symbol cache entries")
+        with self.db:
+            self.db.execute(
+                "DELETE FROM symbols WHERE (lib_key, offset) IN "
+                "(SELECT lib_key, offset FROM symbols ORDER BY last_used LIMIT ?)",
+                (excess,))
+        self.count = max(0, count - excess)
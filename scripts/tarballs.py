@@ -0,0 +1,183 @@
+import os
+import json
+import base64
+import shutil
+import hashlib
+import logging
+import tempfile
+
+import utils
+
+log = logging.getLogger(__name__)
+
+GASKET_ROOT = os.getenv("GASKET_ROOT")
+
+
+def compute_integrity(path, algo='sha512'):
+    h = hashlib.new(algo)
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            h.update(chunk)
+    return f"{algo}-" + base64.b64encode(h.digest()).decode('ascii')
+
+
+def check_integrity(path, integrity):
+    # XXX: SRI strings may list several hashes; any match will do.
+    for entry in integrity.split():
+        algo = entry.split('-', 1)[0]
+        if algo not in hashlib.algorithms_available:
+            continue
+        if compute_integrity(path, algo) == entry:
+            return True
+    return False
+
+
+def stat_key(path):
+    # XXX: Changes whenever the file is replaced or written to.
+    st = os.stat(path)
+    return [st.st_ino, st.st_mtime_ns, st.st_size]
+
+
+class TarballStore():
+    def __init__(self, root=None, npm_cache=None, offline=False):
+        if root is None:
+            root = os.path.join(GASKET_ROOT, 'data/tarballs')
+        if npm_cache is None:
+            npm_cache = os.path.join(GASKET_ROOT, 'data/npm-cache')
+        self.root = root
+        self.npm_cache = npm_cache
+        self.offline = offline
+        utils.create_dir(self.root)
+
+    def npm_flags(self):
+        # XXX: Share one npm cache between all installs and never
+        #      revalidate what is already in it.
+        flags = ['--cache', self.npm_cache]
+        if self.offline:
+            flags.append('--offline')
+        else:
+            flags.append('--prefer-offline')
+        return flags
+
+    def _meta_path(self, name, version):
+        sname = utils.sanitize_package_name(name)
+        return os.path.join(self.root, sname, version + '.json')
+
+    def peek(self, name, version):
+        # XXX: Metadata of a stored tarball, plus its path, without the
+        #      integrity check; for cheap lookups over a whole corpus.
+        meta_path = self._meta_path(name, version)
+        try:
+            with open(meta_path, 'r') as infile:
+                meta = json.loads(infile.read())
+        except (FileNotFoundError, ValueError):
+            return None
+        meta['path'] = os.path.join(os.path.dirname(meta_path), meta['filename'])
+        return meta
+
+    def _write_meta(self, meta_path, meta):
+        tmp_path = utils.tmp_path(meta_path)
+        with open(tmp_path, 'w') as outfile:
+            outfile.write(json.dumps(meta))
+        os.replace(tmp_path, meta_path)
+
+    def get(self, name, version):
+        meta_path = self._meta_path(name, version)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r') as infile:
+            meta = json.loads(infile.read())
+        path = os.path.join(os.path.dirname(meta_path), meta['filename'])
+        if not os.path.exists(path):
+            return None
+        # XXX: Hash the tarball only if it changed since it was last
+        #      verified (or was stored by a version that did not record
+        #      when).
+        if meta.get('verified') == stat_key(path):
+            return path
+        if not check_integrity(path, meta['integrity']):
+            log.warning(f"Integrity check failed for {path}, discarding")
+            os.remove(path)
+            os.remove(meta_path)
+            return None
+        meta['verified'] = stat_key(path)
+        self._write_meta(meta_path, meta)
+        return path
+
+    def fetch(self, name, version):
+        path = self.get(name, version)
+        if path is not None:
+            return path
+        if self.offline:
+            log.error(f"{name}@{version} is not in the tarball store and --offline was given")
+            return None
+        pkg_dir = os.path.dirname(self._meta_path(name, version))
+        utils.create_dir(pkg_dir)
+        with tempfile.TemporaryDirectory(dir=pkg_dir) as tmp_dir:
+            cmd = [
+                'npm',
+                'pack',
+                '--json',
+                '--pack-destination', tmp_dir,
+            ] + self.npm_flags() + [
+                "{}@{}".format(name, version)
+            ]
+            log.info(cmd)
+            try:
+                ret, out, err = utils.run_cmd(cmd)
+            except Exception as e:
+                log.error(e)
+                return None
+            if ret != 0:
+                log.error(f"cmd {cmd} returned non-zero exit code {ret}")
+                log.info(err)
+                return None
+            try:
+                info = json.loads(out)[0]
+            except (ValueError, IndexError) as e:
+                log.error(f"Could not parse npm pack output for {name}@{version}: {e}")
+                return None
+            tmp_path = os.path.join(tmp_dir, info['filename'])
+            integrity = info.get('integrity')
+            if integrity is None or not check_integrity(tmp_path, integrity):
+                log.error(f"Integrity check failed for {name}@{version}")
+                return None
+            path = os.path.join(pkg_dir, info['filename'])
+            os.replace(tmp_path, path)
+            meta = {
+                'name': name,
+                'version': version,
+                'filename': info['filename'],
+                'integrity': integrity,
+                'size': os.path.getsize(path),
+                'verified': stat_key(path),
+            }
+            self._write_meta(self._meta_path(name, version), meta)
+        return path
+
+    def prefetch(self, name, version):
+        # XXX: Fetch the tarball and warm the npm cache with its whole
+        #      dependency tree, so that later installs work offline.
+        path = self.fetch(name, version)
+        if path is None:
+            return -1
+        tmp_dir = tempfile.mkdtemp(prefix='gasket-prefetch-')
+        try:
+            cmd = [
+                'npm',
+                'install',
+                '--ignore-scripts',
+                '--prefix', tmp_dir,
+            ] + self.npm_flags() + [path]
+            log.info(cmd)
+            try:
+                ret, out, err = utils.run_cmd(cmd)
+            except Exception as e:
+                log.error(e)
+                return -1
+            if ret != 0:
+                log.error(f"cmd {cmd} returned non-zero exit code {ret}")
+                log.info(err)
+            return ret
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
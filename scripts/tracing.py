@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import logging
+import argparse
+import functools
+import threading
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# XXX: Child processes (e.g., resolve_syms.py spawned by gasket) pick the
+#      trace file and current package up from the environment.
+TRACE_ENV = 'GASKET_TRACE'
+PACKAGE_ENV = 'GASKET_TRACE_PACKAGE'
+
+_local = threading.local()
+_trace_fd = None
+_trace_path = None
+
+
+def configure(path):
+    global _trace_fd, _trace_path
+    if _trace_fd is not None:
+        os.close(_trace_fd)
+        _trace_fd = None
+    _trace_path = path
+    if path is not None:
+        d = os.path.dirname(os.path.abspath(path))
+        os.makedirs(d, exist_ok=True)
+        # XXX: O_APPEND plus one write() per record keeps lines from
+        #      several worker processes from interleaving.
+        _trace_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+
+def configure_from_env():
+    path = os.getenv(TRACE_ENV)
+    if path:
+        configure(path)
+        set_package(os.getenv(PACKAGE_ENV))
+
+
+def enabled():
+    return _trace_fd is not None
+
+
+def set_package(package):
+    _local.package = package
+
+
+def current_package():
+    return getattr(_local, 'package', None)
+
+
+def child_env(env=None):
+    # XXX: Returns None (inherit) when tracing is off.
+    if not enabled():
+        return env
+    env = dict(os.environ if env is None else env)
+    env[TRACE_ENV] = _trace_path
+    package = current_package()
+    if package is not None:
+        env[PACKAGE_ENV] = package
+    return env
+
+
+def emit(record):
+    if _trace_fd is None:
+        return
+    os.write(_trace_fd, (json.dumps(record) + '\n').encode('utf-8'))
+
+
+@contextmanager
+def span(stage, **attrs):
+    if not enabled():
+        yield {}
+        return
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    rec = {
+        'package': current_package(),
+        'stage': stage,
+        'parent': stack[-1] if stack else None,
+        'pid': os.getpid(),
+        'tid': threading.get_ident(),
+        'start': time.time(),
+    }
+    rec.update(attrs)
+    stack.append(stage)
+    t0 = time.perf_counter()
+    try:
+        yield rec
+    except BaseException as e:
+        rec['error'] = repr(e)
+        raise
+    finally:
+        rec['duration_sec'] = round(time.perf_counter() - t0, 6)
+        stack.pop()
+        emit(rec)
+
+
+def traced(stage):
+    # XXX: Decorator for stage methods that return an exit code.
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with span(stage) as rec:
+                ret = fn(*args, **kwargs)
+                if isinstance(ret, int):
+                    rec['exit_code'] = ret
+                return ret
+        return inner
+    return wrap
+
+
+def load(path):
+    records = []
+    with open(path, 'r') as infile:
+        for line in infile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # XXX: Possibly a torn last line from a crashed worker.
+                log.warning(f"Skipping malformed trace line: {line[:80]}")
+    return records
+
+
+def to_chrome(records):
+    events = []
+    for r in records:
+        args = {k: v for k, v in r.items()
+                if k not in ('stage', 'pid', 'tid', 'start', 'duration_sec')}
+        events.append({
+            'name': r['stage'],
+            'cat': r.get('package') or 'gasket',
+            'ph': 'X',
+            'ts': int(r['start'] * 1e6),
+            'dur': int(r['duration_sec'] * 1e6),
+            'pid': r['pid'],
+            'tid': r['tid'],
+            'args': args,
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome(records, path):
+    with open(path, 'w') as outfile:
+        outfile.write(json.dumps(to_chrome(records)))
+
+
+def summarize(records, top):
+    packages = {}
+    stages = {}
+    for r in records:
+        if r['stage'] == 'package':
+            packages[r.get('package')] = r['duration_sec']
+        s = stages.setdefault(r['stage'], [0, 0.0])
+        s[0] += 1
+        s[1] += r['duration_sec']
+    print("Slowest packages:")
+    for p, d in sorted(packages.items(), key=lambda kv: -kv[1])[:top]:
+        print(f"  {d:>10.2f}s  {p}")
+    print("Time per stage:")
+    for st, (n, d) in sorted(stages.items(), key=lambda kv: -kv[1][1]):
+        print(f"  {d:>10.2f}s  {n:>7} spans  {d / n:>8.3f}s avg  {st}")
+
+
+def main():
+    p = argparse.ArgumentParser(description='Inspect a gasket trace (JSON lines).')
+    p.add_argument("trace", help=("Trace file written with find_bridges.py --trace."))
+    p.add_argument(
+        "-c",
+        "--chrome",
+        default=None,
+        help=("Convert to a Chrome trace-event file at this path."),
+    )
+    p.add_argument(
+        "-n",
+        "--top",
+        default=20,
+        type=int,
+        help=("Number of slowest packages to list."),
+    )
+    args = p.parse_args()
+    records = load(args.trace)
+    if args.chrome is not None:
+        write_chrome(records, args.chrome)
+    summarize(records, args.top)
+
+
+if __name__ == "__main__":
+    main()
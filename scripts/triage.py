@@ -0,0 +1,123 @@
+import json
+import tarfile
+import logging
+import argparse
+
+log = logging.getLogger(__name__)
+
+NATIVE = 'native'
+PURE_JS = 'pure-js'
+
+# XXX: Packages that only make sense as a dependency of an addon (build
+#      helpers, loaders for prebuilt binaries, C++ header packages).
+NATIVE_DEPS = {
+    'bindings',
+    'nan',
+    'node-addon-api',
+    'node-gyp',
+    'node-gyp-build',
+    'node-gyp-build-optional-packages',
+    'node-pre-gyp',
+    '@mapbox/node-pre-gyp',
+    'prebuild-install',
+    'prebuildify',
+    'pkg-prebuilds',
+    'cmake-js',
+    'napi-macros',
+    'neon-cli',
+    '@neon-rs/load',
+    '@napi-rs/cli',
+}
+
+NATIVE_SCRIPT_HINTS = (
+    'node-gyp',
+    'prebuild-install',
+    'node-pre-gyp',
+    'cmake-js',
+    'neon',
+    'napi',
+)
+
+NATIVE_FILES = (
+    'binding.gyp',
+    'CMakeLists.txt',
+    'Cargo.toml',
+)
+
+
+def package_json_member(members):
+    # XXX: npm tarballs normally use package/, but not always.
+    candidates = [m for m in members
+                  if m.isfile() and m.name.count('/') == 1 and m.name.endswith('/package.json')]
+    return candidates[0] if candidates else None
+
+
+def classify(names, pkg):
+    # XXX: Conservative; anything that might end up with a .node file in
+    #      the package directory counts as native.
+    reasons = []
+    for n in names:
+        base = n.rsplit('/', 1)[-1]
+        if base.endswith('.node'):
+            reasons.append(f'file:{n}')
+        elif base in NATIVE_FILES:
+            reasons.append(f'file:{n}')
+        elif '/prebuilds/' in n:
+            reasons.append(f'prebuilds:{n}')
+    if pkg.get('gypfile'):
+        reasons.append('gypfile')
+    if pkg.get('binary'):
+        reasons.append('binary')
+    if pkg.get('napi'):
+        reasons.append('napi')
+    scripts = pkg.get('scripts') or {}
+    for hook in ('preinstall', 'install', 'postinstall'):
+        cmd = scripts.get(hook)
+        if not isinstance(cmd, str):
+            continue
+        for hint in NATIVE_SCRIPT_HINTS:
+            if hint in cmd:
+                reasons.append(f'script:{hook}')
+                break
+    for field in ('dependencies', 'optionalDependencies', 'peerDependencies'):
+        deps = pkg.get(field) or {}
+        if not isinstance(deps, dict):
+            continue
+        for d in deps:
+            if d in NATIVE_DEPS:
+                reasons.append(f'dep:{d}')
+    # XXX: Platform-specific prebuilt packages are usually pulled in as
+    #      optional dependencies and may get nested under the package.
+    if pkg.get('optionalDependencies'):
+        reasons.append('optionalDependencies')
+    return (NATIVE if reasons else PURE_JS), reasons
+
+
+def triage_tarball(path):
+    with tarfile.open(path, 'r:*') as tar:
+        members = tar.getmembers()
+        pkg = {}
+        m = package_json_member(members)
+        if m is not None:
+            try:
+                pkg = json.loads(tar.extractfile(m).read().decode('utf-8'))
+            except (ValueError, UnicodeDecodeError) as e:
+                log.warning(f"Unreadable package.json in {path}: {e}")
+                return NATIVE, ['unreadable-package.json']
+        else:
+            return NATIVE, ['no-package.json']
+        names = [m.name for m in members if m.isfile()]
+    return classify(names, pkg)
+
+
+def main():
+    p = argparse.ArgumentParser(description='Classify npm tarballs as native or pure JS.')
+    p.add_argument("tarballs", nargs='+', help=("Paths to .tgz files."))
+    args = p.parse_args()
+    for path in args.tarballs:
+        verdict, reasons = triage_tarball(path)
+        print(f"{verdict}\t{path}\t{','.join(reasons)}")
+
+
+if __name__ == "__main__":
+    main()
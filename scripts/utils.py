@@ -1,11 +1,32 @@
 import os
 import csv
+import time
+import uuid
+import signal
+import hashlib
 import logging
+import selectors
+import threading
 from pathlib import Path
 import subprocess as sp
 
+import tracing
+
 log = logging.getLogger(__name__)
 
+# XXX: Same exit code as coreutils' timeout(1).
+RET_TIMEOUT = 124
+
+TAIL_BYTES = 256 * 1024
+KILL_GRACE_SEC = 5
+# XXX: Bounds how long we keep reading after the command exited, in case
+#      something it left behind keeps writing to its pipes.
+DRAIN_READS = 64
+DEFAULT_OUTPUT_LOG_BYTES = 16 * 1024 * 1024
+DEFAULT_OUTPUT_LOG_BACKUPS = 2
+
+_cmd_local = threading.local()
+
 def load_csv(filename):
     package_names = []
     with open(filename, 'r') as file:
@@ -54,20 +75,181 @@ def get_mod_import_name(mod_path, pkg_root_path):
 
     return import_name
 
-def run_cmd(opts, timeout=None, shell=False):
-    cmd = sp.Popen(opts, stdin=sp.DEVNULL, stdout=sp.PIPE, stderr=sp.PIPE, text=True, shell=shell)
-    out, err = cmd.communicate(timeout=None)
-    ret = cmd.returncode
+def cmd_name(opts):
+    if isinstance(opts, str):
+        return opts.split()[0] if opts.split() else opts
+    name = os.path.basename(opts[0])
+    if len(opts) > 1 and not opts[1].startswith('-'):
+        name += ' ' + opts[1]
+    return name
+
+class OutputLog():
+    # XXX: Size-bounded log of raw child output; rotates to .1, .2, ...
+    def __init__(self, path, max_bytes=DEFAULT_OUTPUT_LOG_BYTES, backups=DEFAULT_OUTPUT_LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        create_dir(os.path.dirname(os.path.abspath(path)))
+        self.f = open(path, 'ab')
+
+    def rotate(self):
+        self.f.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.f = open(self.path, 'ab')
+
+    def write(self, data):
+        if self.f.tell() + len(data) > self.max_bytes and self.f.tell() > 0:
+            self.rotate()
+        self.f.write(data)
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+def set_cmd_limits(timeout=None, idle_timeout=None, output_log=None):
+    # XXX: Per-thread defaults for run_cmd(), set once per package.
+    _cmd_local.timeout = timeout
+    _cmd_local.idle_timeout = idle_timeout
+    _cmd_local.output_log = output_log
+
+def kill_group(proc):
+    # XXX: The child leads its own session; take down everything it
+    #      spawned (node-gyp, make, compilers, resolve_syms, ...).
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+        try:
+            proc.wait(timeout=KILL_GRACE_SEC)
+            return
+        except sp.TimeoutExpired:
+            continue
+    proc.wait()
+
+def append_tail(buf, data):
+    buf += data
+    if len(buf) > 2 * TAIL_BYTES:
+        del buf[:-TAIL_BYTES]
+        return True
+    return False
+
+def run_cmd(opts, timeout=None, shell=False, env=None, idle_timeout=None):
+    # XXX: Streams output instead of buffering it. Only the last TAIL_BYTES
+    #      of each stream are returned; everything goes to the per-package
+    #      output log, if any. Returns RET_TIMEOUT if the wall-clock or the
+    #      idle (no output) timeout expires.
+    if timeout is None:
+        timeout = getattr(_cmd_local, 'timeout', None)
+    if idle_timeout is None:
+        idle_timeout = getattr(_cmd_local, 'idle_timeout', None)
+    output_log = getattr(_cmd_local, 'output_log', None)
+    with tracing.span('cmd', cmd=cmd_name(opts)) as rec:
+        cmd = sp.Popen(opts, stdin=sp.DEVNULL, stdout=sp.PIPE, stderr=sp.PIPE,
+                       shell=shell, env=tracing.child_env(env), start_new_session=True)
+        if output_log is not None:
+            output_log.write(f"\n$ {opts if isinstance(opts, str) else ' '.join(opts)}\n".encode())
+        out_fd, err_fd = cmd.stdout.fileno(), cmd.stderr.fileno()
+        tails = {out_fd: bytearray(), err_fd: bytearray()}
+        truncated = set()
+        sel = selectors.DefaultSelector()
+        sel.register(cmd.stdout, selectors.EVENT_READ)
+        sel.register(cmd.stderr, selectors.EVENT_READ)
+        start = last_output = time.monotonic()
+        expired = None
+
+        def read(key):
+            fd = key.fileobj.fileno()
+            data = os.read(fd, 65536)
+            if not data:
+                sel.unregister(key.fileobj)
+                return False
+            if append_tail(tails[fd], data):
+                truncated.add(fd)
+            if output_log is not None:
+                output_log.write(data)
+            return True
+
+        try:
+            while sel.get_map():
+                now = time.monotonic()
+                if timeout is not None and now - start > timeout:
+                    expired = 'wall'
+                    break
+                if idle_timeout is not None and now - last_output > idle_timeout:
+                    expired = 'idle'
+                    break
+                if cmd.poll() is not None:
+                    # XXX: Background processes it left behind may hold
+                    #      the pipes open; take what is there and stop.
+                    for _ in range(DRAIN_READS):
+                        ready = sel.select(timeout=0) if sel.get_map() else []
+                        if not ready:
+                            break
+                        for key, _ in ready:
+                            read(key)
+                    break
+                for key, _ in sel.select(timeout=1.0):
+                    if read(key):
+                        last_output = time.monotonic()
+            if expired is None:
+                # XXX: It may also close its pipes and then hang.
+                remaining = None if timeout is None else max(0, timeout - (time.monotonic() - start))
+                try:
+                    cmd.wait(timeout=remaining)
+                except sp.TimeoutExpired:
+                    expired = 'wall'
+        except BaseException:
+            kill_group(cmd)
+            raise
+        finally:
+            sel.close()
+            cmd.stdout.close()
+            cmd.stderr.close()
+        if expired is not None:
+            kill_group(cmd)
+            log.error(f"{cmd_name(opts)} exceeded its {expired} timeout"
+                      f" ({timeout if expired == 'wall' else idle_timeout}s), killed")
+            rec['timeout'] = expired
+            ret = RET_TIMEOUT
+        else:
+            ret = cmd.returncode
+        rec['exit_code'] = ret
+        out, err = [
+            ('[... truncated ...]\n' if fd in truncated else '')
+            + bytes(tails[fd][-TAIL_BYTES:]).decode('utf-8', errors='replace')
+            for fd in (out_fd, err_fd)
+        ]
     log.debug(opts)
     log.debug("ret = %s" % ret)
     log.debug(out)
     log.debug(err)
     return ret, out, err
 
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def tmp_path(path):
+    # XXX: Next to path, so that os.replace() is atomic, and unique per
+    #      call, since threads of one process may write the same path.
+    return f"{path}.tmp.{os.getpid()}.{uuid.uuid4().hex[:8]}"
+
 def create_dir(path):
     p = Path(path)
     if not p.exists():
-        p.mkdir(parents=True)
+        # XXX: Parallel workers may race to create shared directories.
+        p.mkdir(parents=True, exist_ok=True)
 
 def find_git_root():
     path = Path.cwd()
@@ -78,8 +260,39 @@ def find_git_root():
             return parent.as_posix()
     return None
 
+def setup_logging(args):
+    # XXX: For the main() of every script; args.log is the level name.
+    levels = {
+        "critical": logging.CRITICAL,
+        "error": logging.ERROR,
+        "warn": logging.WARNING,
+        "warning": logging.WARNING,
+        "info": logging.INFO,
+        "debug": logging.DEBUG,
+    }
+    level = levels.get(args.log.lower())
+    if level is None:
+        raise ValueError(
+            f"log level given: {args.log}"
+            f" -- must be one of: {' | '.join(levels.keys())}"
+        )
+
+    fmt = "%(asctime)s "
+    fmt += "%(module)s:%(lineno)s [%(levelname)s] "
+    fmt += "%(message)s"
+    # Use ISO 8601 format
+    datefmt='%Y-%m-%dT%H:%M:%S'
+
+    logging.basicConfig(level=level, format=fmt, datefmt=datefmt)
+
 def sanitize_package_name(package):
     # Avoid filesystem errors due to packages containing
     # illegal characters  (@augmentality/node-alsa)
     return package.replace("/", "~")
 
+def namesnip(package):
+    # XXX: <first letter>/<name>/<version>, sanitized; where a package's
+    #      bridges and manifest live under their roots.
+    sname, sversion = sanitize_package_name(package).split(':')[:2]
+    return sname[0] + '/' + sname + '/' + sversion
+
@@ -0,0 +1,371 @@
+import os
+import json
+import uuid
+import time
+import socket
+import logging
+from contextlib import contextmanager
+import argparse
+
+import utils
+
+log = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+DEFAULT_LEASE_TTL = 600
+DEFAULT_MAX_ATTEMPTS = 3
+# XXX: enqueue() holds a task's lock for milliseconds; one this old was
+#      left behind by a crash.
+STALE_LOCK_SEC = 60
+
+
+def task_key(group):
+    return utils.sanitize_package_name(group[0]).split(':')[0]
+
+
+def write_json(path, data):
+    tmp_path = utils.tmp_path(path)
+    with open(tmp_path, 'w') as outfile:
+        outfile.write(json.dumps(data))
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    try:
+        with open(path, 'r') as infile:
+            return json.loads(infile.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def holds_lease(root, key, rec):
+    # XXX: For workers, to check that nobody reclaimed their task before
+    #      they write its outputs.
+    return read_json(os.path.join(root, 'leases', key + '.lease')) == rec
+
+
+def covers(st, packages):
+    # XXX: Versions may be added to a task after it finished; it is only
+    #      finished if they were all part of the run.
+    return set(packages) <= set(st.get('packages') or [])
+
+
+class Task():
+    def __init__(self, key, packages, attempts, lease=None):
+        self.key = key
+        self.packages = packages
+        self.attempts = attempts
+        self.lease = lease
+
+
+class WorkQueue():
+    # XXX: Coordinator-free queue in a directory shared by all hosts:
+    #
+    #        tasks/<key>.json    packages of one task (all versions of a name)
+    #        leases/<key>.lease  held by whoever works on the task
+    #        status/<key>.json   status, attempts and results
+    #        clock/<owner>       touched to read the file server's time
+    #
+    #      Leases are taken with O_EXCL and kept alive by touching them.
+    #      An expired lease is reclaimed by renaming it away, which only
+    #      one contender can do. Only the lease holder writes status.
+    def __init__(self, root, lease_ttl=DEFAULT_LEASE_TTL, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.root = root
+        self.lease_ttl = lease_ttl
+        self.max_attempts = max_attempts
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.held = {}
+        for d in ('tasks', 'leases', 'status', 'clock'):
+            utils.create_dir(os.path.join(root, d))
+        # XXX: Finished tasks, by the mtime of their task file, which
+        #      changes when enqueue() adds versions to them.
+        self._terminal = {}
+        self._priorities = {}
+
+    def _path(self, kind, key):
+        ext = {'tasks': '.json', 'leases': '.lease', 'status': '.json'}[kind]
+        return os.path.join(self.root, kind, key + ext)
+
+    def now(self):
+        # XXX: Lease ages are judged by file server time, so that clock
+        #      skew between hosts does not matter.
+        path = os.path.join(self.root, 'clock', self.owner.replace(':', '_'))
+        with open(path, 'a'):
+            pass
+        os.utime(path, None)
+        return os.stat(path).st_mtime
+
+    @contextmanager
+    def _task_lock(self, key):
+        path = self._path('tasks', key) + '.lock'
+        while True:
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                break
+            except FileExistsError:
+                try:
+                    if self.now() - os.stat(path).st_mtime > STALE_LOCK_SEC:
+                        log.warning(f"Breaking stale lock {path}")
+                        os.remove(path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.1)
+        os.close(fd)
+        try:
+            yield
+        finally:
+            os.remove(path)
+
+    def enqueue(self, groups):
+        # XXX: Groups are claimed in the order given here (see
+        #      scheduler.py); later enqueue() calls go after earlier ones.
+        #      New versions of a queued name are merged into its task,
+        #      which reopens it if it had finished. Returns the number of
+        #      tasks added or extended.
+        changed = 0
+        skipped = 0
+        stamp = self.now()
+        for i, group in enumerate(groups):
+            key = task_key(group)
+            path = self._path('tasks', key)
+            with self._task_lock(key):
+                task = read_json(path)
+                if task is None:
+                    write_json(path, {'packages': group, 'priority': [stamp, i]})
+                    changed += 1
+                    continue
+                new = [p for p in group if p not in task['packages']]
+                if not new:
+                    skipped += 1
+                    continue
+                log.info(f"Adding {new} to queued task {key}")
+                task['packages'] = task['packages'] + new
+                write_json(path, task)
+                changed += 1
+        if skipped:
+            log.info(f"Skipped {skipped} groups that were already queued")
+        return changed
+
+    def keys(self):
+        return sorted(f[:-len('.json')] for f in os.listdir(os.path.join(self.root, 'tasks'))
+                      if f.endswith('.json'))
+
+    def status(self, key):
+        st = read_json(self._path('status', key))
+        if st is None:
+            return {'status': PENDING, 'attempts': 0}
+        return st
+
+    def _lease_record(self):
+        return {'owner': self.owner, 'nonce': uuid.uuid4().hex}
+
+    def _try_lease(self, key, now):
+        path = self._path('leases', key)
+        rec = self._lease_record()
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                return None
+            if now - mtime <= self.lease_ttl:
+                return None
+            seen = read_json(path)
+            stale = f"{path}.stale.{uuid.uuid4().hex[:8]}"
+            try:
+                os.rename(path, stale)
+            except FileNotFoundError:
+                return None
+            if read_json(stale) != seen:
+                # XXX: Someone reclaimed and re-leased it between our
+                #      stat() and rename(); give the live lease back.
+                try:
+                    os.link(stale, path)
+                except FileExistsError:
+                    pass
+                os.remove(stale)
+                return None
+            os.remove(stale)
+            log.warning(f"Reclaimed expired lease of {key} from {seen and seen.get('owner')}")
+            return self._try_lease(key, now)
+        with os.fdopen(fd, 'w') as outfile:
+            outfile.write(json.dumps(rec))
+        return rec
+
+    def _release(self, key):
+        self.held.pop(key, None)
+        path = self._path('leases', key)
+        rec = read_json(path)
+        if rec is not None and rec.get('owner') == self.owner:
+            os.remove(path)
+
+    def priority(self, key):
+        if key not in self._priorities:
+            task = read_json(self._path('tasks', key)) or {}
+            priority = task.get('priority', 0)
+            self._priorities[key] = priority if isinstance(priority, list) else [0, priority]
+        return self._priorities[key]
+
+    def _task_mtime(self, key):
+        try:
+            return os.stat(self._path('tasks', key)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _mark_terminal(self, key):
+        self._terminal[key] = self._task_mtime(key)
+
+    def _is_terminal(self, key):
+        return key in self._terminal and self._terminal[key] == self._task_mtime(key)
+
+    def finished(self, key, st=None):
+        st = st or self.status(key)
+        if st['status'] not in (DONE, FAILED):
+            return False
+        task = read_json(self._path('tasks', key))
+        return task is None or covers(st, task['packages'])
+
+    def claim(self):
+        now = self.now()
+        for key in sorted(self.keys(), key=lambda k: (self.priority(k), k)):
+            if self._is_terminal(key) or key in self.held:
+                continue
+            st = self.status(key)
+            if self.finished(key, st):
+                self._mark_terminal(key)
+                continue
+            if st['status'] == RUNNING and now - st.get('updated', 0) <= self.lease_ttl:
+                # XXX: Cheap pre-check; the lease below is what counts.
+                continue
+            rec = self._try_lease(key, now)
+            if rec is None:
+                continue
+            self.held[key] = rec
+            # XXX: Re-read under the lease; it may have finished meanwhile.
+            st = self.status(key)
+            if self.finished(key, st):
+                self._mark_terminal(key)
+                self._release(key)
+                continue
+            task = read_json(self._path('tasks', key))
+            if st['status'] in (DONE, FAILED):
+                log.info(f"Reopening task {key} for {len(task['packages'])} packages")
+                st = {'status': PENDING, 'attempts': 0}
+            attempts = st.get('attempts', 0) + 1
+            if attempts > self.max_attempts:
+                log.error(f"Task {key} failed {st.get('attempts')} times, giving up")
+                self._set_status(key, task['packages'], FAILED, st.get('attempts'),
+                                 error='too many attempts')
+                self._mark_terminal(key)
+                self._release(key)
+                continue
+            self._set_status(key, task['packages'], RUNNING, attempts)
+            return Task(key, task['packages'], attempts, rec)
+        return None
+
+    def _set_status(self, key, packages, status, attempts, **extra):
+        st = {
+            'packages': packages,
+            'status': status,
+            'attempts': attempts,
+            'owner': self.owner,
+            'updated': self.now(),
+        }
+        st.update(extra)
+        write_json(self._path('status', key), st)
+
+    def heartbeat(self):
+        # XXX: Returns the keys whose lease was lost (e.g., we stalled for
+        #      longer than the TTL and someone reclaimed it).
+        lost = []
+        for key, rec in list(self.held.items()):
+            path = self._path('leases', key)
+            if read_json(path) != rec:
+                log.error(f"Lost the lease of {key}")
+                self.held.pop(key)
+                lost.append(key)
+                continue
+            try:
+                os.utime(path, None)
+            except FileNotFoundError:
+                self.held.pop(key)
+                lost.append(key)
+        return lost
+
+    def complete(self, task, results):
+        if task.key not in self.held:
+            log.warning(f"Not recording results of {task.key}, its lease was lost")
+            return
+        ok = all(ret == 0 for ret in results.values())
+        self._set_status(task.key, task.packages, DONE if ok else FAILED, task.attempts,
+                         results=results)
+        self._mark_terminal(task.key)
+        self._release(task.key)
+
+    def unfinished(self):
+        n = 0
+        for key in self.keys():
+            if self._is_terminal(key):
+                continue
+            if self.finished(key):
+                self._mark_terminal(key)
+                continue
+            n += 1
+        return n
+
+    def summary(self):
+        counts = {}
+        for key in self.keys():
+            st = self.status(key)
+            status = st['status'] if self.finished(key, st) or st['status'] == RUNNING else PENDING
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def requeue(self, status=FAILED):
+        n = 0
+        for key in self.keys():
+            st = self.status(key)
+            if st['status'] == status:
+                os.remove(self._path('status', key))
+                n += 1
+        return n
+
+
+def main():
+    p = argparse.ArgumentParser(description='Inspect or fill a shared find_bridges.py work queue.')
+    p.add_argument(
+        "-l",
+        "--log",
+        default="info",
+        help=("Provide logging level. Example --log debug"),
+    )
+    p.add_argument("queue", help=("Queue directory."))
+    sub = p.add_subparsers(dest='command', required=True)
+    init = sub.add_parser('init', help='Add the packages of a CSV file to the queue.')
+    init.add_argument("-i", "--input", required=True, help=("CSV file with package:version pairs."))
+    sub.add_parser('status', help='Print task counts by status.')
+    rq = sub.add_parser('requeue', help='Make finished tasks pending again.')
+    rq.add_argument("--status", default=FAILED, choices=[FAILED, DONE],
+                    help=("Requeue tasks with this status."))
+    args = p.parse_args()
+    utils.setup_logging(args)
+
+    import find_bridges
+    queue = WorkQueue(args.queue)
+    if args.command == 'init':
+        groups = find_bridges.group_packages(utils.load_csv(args.input))
+        print(f"Added {queue.enqueue(groups)} tasks")
+    elif args.command == 'status':
+        print(json.dumps(queue.summary(), indent=2))
+    elif args.command == 'requeue':
+        print(f"Requeued {queue.requeue(args.status)} tasks")
+
+
+if __name__ == "__main__":
+    main()